@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+JOB_SECTION_PREFIX = 'job:'
+
+# Options of the parent run which must not be passed to job processes, with whether they take a value
+BATCH_OPTIONS = {
+    '--configfile': True,
+    '--batch': False,
+    '--no-batch': False,
+    '--batch-workers': True,
+    '--source-host-limit': True,
+    '--target-host-limit': True,
+    '--result-file': True,
+    '--report-file': True,
+    '--prometheus-file': True,
+    '--job-name': True,
+}
+
+def readJobs(config) -> list:
+    """
+    Read jobs from `[job:<name>]` sections of the configuration.
+
+    Keys `backup_<key>` and `restore_<key>` of a job override `<key>` of the `[backup]` and `[restore]` sections.
+    """
+    jobs = []
+    for section in config.sections():
+        if not section.startswith(JOB_SECTION_PREFIX):
+            continue
+
+        job = {'name': section[len(JOB_SECTION_PREFIX):], 'backup': {}, 'restore': {}}
+        for part in ('backup', 'restore'):
+            if config.has_section(part):
+                job[part].update(config.items(part))
+            prefix = part + '_'
+            for key, value in config.items(section):
+                if key.startswith(prefix):
+                    job[part][key[len(prefix):]] = value
+        jobs.append(job)
+
+    return jobs
+
+def stripOptions(argv: list, options: dict) -> list:
+    """
+    Remove options (and their values) from command line arguments.
+    """
+    result = []
+    skipValue = False
+    for argument in argv:
+        if skipValue:
+            skipValue = False
+            continue
+
+        name = argument.split('=', 1)[0]
+        if name in options:
+            skipValue = options[name] and '=' not in argument
+            continue
+        result.append(argument)
+
+    return result
+
+def runJob(script: str, argv: list, job: dict, logDir: str) -> dict:
+    """
+    Run a single job in a separate process of the script, so a failing job can not take the others down.
+    """
+    result = {'name': job['name'], 'status': 'failed', 'returncode': None, 'duration': 0.0, 'bytes': None}
+    logPath = os.path.join(logDir, 'batch-{}.log'.format(job['name']))
+    startedAt = time.monotonic()
+
+    with tempfile.TemporaryDirectory() as directory:
+        configPath = os.path.join(directory, 'job.config')
+        resultPath = os.path.join(directory, 'result.json')
+        with open(os.open(configPath, os.O_WRONLY | os.O_CREAT, 0o600), 'w') as file:
+            for part in ('backup', 'restore'):
+                file.write('[{}]\n'.format(part))
+                for key, value in job[part].items():
+                    # Values were interpolated when read, a literal % must not be interpolated again by the job
+                    file.write('{}={}\n'.format(key, value.replace('%', '%%')))
+
+        args = [sys.executable, script, '--configfile={}'.format(configPath), '--result-file={}'.format(resultPath), '--job-name={}'.format(job['name'])] + argv
+        try:
+            with open(logPath, 'wb') as log:
+                process = subprocess.run(args, stdout=log, stderr=subprocess.STDOUT)
+            result['returncode'] = process.returncode
+            if process.returncode == 0:
+                result['status'] = 'ok'
+            if os.path.exists(resultPath):
+                with open(resultPath) as file:
+                    result.update(json.load(file))
+        except Exception as exception:
+            logging.exception(exception)
+
+    result['duration'] = time.monotonic() - startedAt
+    logging.info('Job "{}" finished with status {} in {:.1f}s, log: {}'.format(job['name'], result['status'], result['duration'], logPath))
+
+    return result
+
+def runBatch(script: str, argv: list, jobs: list, workers: int, sourceHostLimit: int, targetHostLimit: int, logDir: str) -> list:
+    """
+    Run jobs concurrently, at most `workers` at once and at most the given number per source and per target host.
+    A job waiting for a busy host does not hold a worker, the worker picks the next job that can run.
+    """
+    argv = stripOptions(argv, BATCH_OPTIONS)
+    pending = list(jobs)
+    results = []
+    sourceRunning = defaultdict(int)
+    targetRunning = defaultdict(int)
+    condition = threading.Condition()
+
+    def sourceHost(job):
+        return (job['backup'].get('host'), job['backup'].get('port'))
+
+    def targetHost(job):
+        return (job['restore'].get('host'), job['restore'].get('port'))
+
+    def worker():
+        while True:
+            with condition:
+                while True:
+                    if not pending:
+                        return
+                    job = next((job for job in pending if sourceRunning[sourceHost(job)] < sourceHostLimit and targetRunning[targetHost(job)] < targetHostLimit), None)
+                    if job is not None:
+                        break
+                    condition.wait()
+                pending.remove(job)
+                sourceRunning[sourceHost(job)] += 1
+                targetRunning[targetHost(job)] += 1
+
+            logging.info('Starting job "{}"...'.format(job['name']))
+            try:
+                result = runJob(script, argv, job, logDir)
+            finally:
+                with condition:
+                    sourceRunning[sourceHost(job)] -= 1
+                    targetRunning[targetHost(job)] -= 1
+                    condition.notify_all()
+
+            with condition:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker, name='batch-worker-{}'.format(index)) for index in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    order = [job['name'] for job in jobs]
+
+    return sorted(results, key=lambda result: order.index(result['name']))
+
+def formatSummary(results: list) -> str:
+    """
+    Summary table of the batch run.
+    """
+    rows = [('job', 'status', 'duration', 'bytes')]
+    for result in results:
+        rows.append((result['name'], result['status'], '{:.1f}s'.format(result['duration']), '-' if result['bytes'] is None else str(result['bytes'])))
+
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    lines = ['  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    lines.append('{} jobs, {} failed'.format(len(results), failed))
+
+    return '\n'.join(lines)
@@ -0,0 +1,100 @@
+import glob
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+class RestoreError(Exception):
+    pass
+
+def checkpointPath(dumpPath: str) -> str:
+    return dumpPath.rstrip('/') + CHECKPOINT_SUFFIX
+
+class Checkpoint:
+    """
+    Units (tables, chunks, index definitions...) of a restore which are done, recorded next to the dump.
+
+    The file starts with a JSON line describing the restore, every finished unit appends one line.
+    Appending keeps recording cheap for databases with many tables, a line cut short by a crash is ignored.
+    """
+
+    def __init__(self, path: str, info: dict, completed: set = None):
+        self.path = path
+        self.info = info
+        self.completed = completed or set()
+        # Units already done when the checkpoint was loaded, a unit not among them may have been done partly
+        self.resumed = bool(self.completed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, dumpPath: str, source: str, target: str, options: dict = None, listFile: str = None) -> 'Checkpoint':
+        """
+        Start a checkpoint for restoring a finished dump of `source` into `target` with the given table selection
+        options and `pg_restore` list file.
+        """
+        info = {'dump': dumpPath, 'source': source, 'target': target, 'started': datetime.now().isoformat(), 'options': options or {}, 'list_file': listFile}
+        path = checkpointPath(dumpPath)
+        with open(path, 'w') as file:
+            file.write(json.dumps(info) + '\n')
+
+        return cls(path, info)
+
+    @classmethod
+    def load(cls, path: str) -> 'Checkpoint':
+        with open(path) as file:
+            info = json.loads(file.readline())
+            completed = set()
+            for line in file:
+                if line.endswith('\n'):
+                    completed.add(line[:-1])
+
+        return cls(path, info, completed)
+
+    def matchesOptions(self, options: dict) -> bool:
+        """
+        Whether the restore was started with the same options, compared the way they were saved.
+        """
+        return self.info.get('options') == json.loads(json.dumps(options or {}))
+
+    def isDone(self, unit: str) -> bool:
+        with self._lock:
+            return unit in self.completed
+
+    def markDone(self, unit: str) -> None:
+        """
+        Record a finished unit. The line is synced to disk, a unit is never recorded before its work is committed.
+        """
+        self.markAllDone([unit])
+
+    def markAllDone(self, units: list) -> None:
+        """
+        Record units finished together, synced to disk once.
+        """
+        with self._lock:
+            with open(self.path, 'a') as file:
+                file.write(''.join(unit + '\n' for unit in units))
+                file.flush()
+                os.fsync(file.fileno())
+            self.completed.update(units)
+
+def findCheckpoint(directory: str, source: str, target: str) -> Checkpoint:
+    """
+    Find the latest checkpoint of a restore of `source` into `target` whose dump still exists.
+    """
+    candidates = []
+    for path in glob.glob(os.path.join(directory, '*' + CHECKPOINT_SUFFIX)):
+        try:
+            checkpoint = Checkpoint.load(path)
+        except (OSError, ValueError) as exception:
+            logging.warning('Unable to read checkpoint "{}": {}'.format(path, exception))
+            continue
+        if checkpoint.info.get('source') == source and checkpoint.info.get('target') == target and os.path.exists(checkpoint.info['dump']):
+            candidates.append((os.path.getmtime(path), checkpoint))
+
+    if not candidates:
+        return None
+
+    return max(candidates, key=lambda candidate: candidate[0])[1]
@@ -0,0 +1,113 @@
+import logging
+import os
+import shutil
+import time
+
+from pipeline import DEFAULT_BUFFER_SIZE, pipeProcesses
+
+CODECS = ('zstd', 'lz4', 'gzip')
+EXTENSIONS = {
+    'zstd': '.zst',
+    'lz4': '.lz4',
+    'gzip': '.gz',
+}
+
+def gzipTool() -> str:
+    """
+    Prefer pigz which compresses with many threads, plain gzip is single-threaded.
+    """
+    return 'pigz' if shutil.which('pigz') else 'gzip'
+
+def compressorArgs(codec: str, level: int = None, threads: int = None) -> list:
+    """
+    Command compressing stdin to stdout.
+    """
+    threads = threads or os.cpu_count() or 1
+
+    if codec == 'zstd':
+        args = ['zstd', '-c', '-q', '-T{}'.format(threads)]
+        if level is not None and level > 19:
+            args.append('--ultra')
+    elif codec == 'lz4':
+        args = ['lz4', '-c', '-q']
+    elif codec == 'gzip':
+        tool = gzipTool()
+        args = [tool, '-c']
+        if tool == 'pigz':
+            args.extend(['-p', str(threads)])
+    else:
+        raise ValueError('Unknown compression codec "{}"'.format(codec))
+
+    if level is not None:
+        args.append('-{}'.format(level))
+
+    return args
+
+def decompressorArgs(codec: str, srcFile: str) -> list:
+    """
+    Command decompressing a file to stdout.
+    """
+    if codec == 'zstd':
+        return ['zstd', '-d', '-c', '-q', srcFile]
+    elif codec == 'lz4':
+        return ['lz4', '-d', '-c', '-q', srcFile]
+    elif codec == 'gzip':
+        return [gzipTool(), '-d', '-c', srcFile]
+
+    raise ValueError('Unknown compression codec "{}"'.format(codec))
+
+def codecFromFile(path: str) -> str:
+    """
+    Guess the codec from file extension, None for uncompressed files.
+    """
+    for codec, extension in EXTENSIONS.items():
+        if path.endswith(extension):
+            return codec
+
+    return None
+
+def logStats(action: str, stats: dict) -> None:
+    logging.info('{} {} bytes ({} bytes compressed, ratio {:.2f}) in {:.3f}s, {:.1f} MB/s.'.format(
+        action,
+        stats['uncompressed'],
+        stats['compressed'],
+        stats['uncompressed'] / stats['compressed'] if stats['compressed'] else 0,
+        stats['seconds'],
+        stats['uncompressed'] / stats['seconds'] / 1000000 if stats['seconds'] else 0,
+    ))
+
+def compressProcessOutput(producerArgs: list, destFile: str, codec: str, level: int = None, threads: int = None, producerEnv: dict = None, bufferSize: int = DEFAULT_BUFFER_SIZE) -> dict:
+    """
+    Run the producer and compress its output into a file.
+    """
+    startedAt = time.monotonic()
+    with open(destFile, 'wb') as file:
+        uncompressed = pipeProcesses(producerArgs, compressorArgs(codec, level, threads), producerEnv=producerEnv, bufferSize=bufferSize, consumerStdout=file)
+
+    stats = {
+        'codec': codec,
+        'uncompressed': uncompressed,
+        'compressed': os.path.getsize(destFile),
+        'seconds': time.monotonic() - startedAt,
+    }
+    logStats('Compressed', stats)
+
+    return stats
+
+def decompressIntoProcess(srcFile: str, consumerArgs: list, consumerEnv: dict = None, bufferSize: int = DEFAULT_BUFFER_SIZE) -> dict:
+    """
+    Decompress a file on the fly into stdin of the consumer.
+    """
+    codec = codecFromFile(srcFile)
+    startedAt = time.monotonic()
+    uncompressed = pipeProcesses(decompressorArgs(codec, srcFile), consumerArgs, consumerEnv=consumerEnv, bufferSize=bufferSize)
+
+    stats = {
+        'codec': codec,
+        'uncompressed': uncompressed,
+        'compressed': os.path.getsize(srcFile),
+        'seconds': time.monotonic() - startedAt,
+    }
+    logStats('Decompressed', stats)
+
+    return stats
@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+
+class TimedCursor:
+    """
+    Cursor wrapper measuring time spent in execute calls.
+    """
+
+    def __init__(self, manager, cursor):
+        self._manager = manager
+        self._cursor = cursor
+
+    def execute(self, query, params=None):
+        startedAt = time.monotonic()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._manager.recordExecute(time.monotonic() - startedAt)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._cursor.close()
+
+class ConnectionManager:
+    """
+    Keeps one admin connection per (host, port, user, dbname) and thread and reuses it between operations.
+    Steps running in worker threads get their own connections, a connection is never used by two threads at once.
+
+    `connect` opens a new autocommit connection, `isClosed` tells whether a cached one is still usable.
+    """
+
+    def __init__(self, connect, isClosed):
+        self._connect = connect
+        self._isClosed = isClosed
+        self._connections = {}
+        self._lock = threading.Lock()
+        self.connectTime = 0.0
+        self.connectCount = 0
+        self.executeTime = 0.0
+        self.executeCount = 0
+
+    def get(self, host: str, port: int, user: str, password: str, dbname: str):
+        """
+        Get a cached connection or open a new one.
+        """
+        key = (threading.get_ident(), host, str(port), user, dbname)
+        with self._lock:
+            connection = self._connections.get(key)
+
+        if connection is None or self._isClosed(connection):
+            logging.debug('Connecting to "{}" on {}:{} as "{}"...'.format(dbname, host, port, user))
+            startedAt = time.monotonic()
+            connection = self._connect(host, int(port), user, password, dbname)
+            with self._lock:
+                self.connectTime += time.monotonic() - startedAt
+                self.connectCount += 1
+                self._connections[key] = connection
+
+        return connection
+
+    def cursor(self, host: str, port: int, user: str, password: str, dbname: str) -> TimedCursor:
+        """
+        Get a timed cursor on a cached connection.
+        """
+        return TimedCursor(self, self.get(host, port, user, password, dbname).cursor())
+
+    def close(self, host: str, port: int, user: str, dbname: str) -> None:
+        """
+        Close cached connections to a database of every thread, e.g. before the database is dropped or renamed.
+        """
+        with self._lock:
+            keys = [key for key in self._connections if key[1:] == (host, str(port), user, dbname)]
+            closing = [self._connections.pop(key) for key in keys]
+        for connection in closing:
+            if not self._isClosed(connection):
+                connection.close()
+
+    def closeAll(self) -> None:
+        """
+        Close all cached connections.
+        """
+        with self._lock:
+            closing = list(self._connections.values())
+            self._connections.clear()
+        for connection in closing:
+            try:
+                if not self._isClosed(connection):
+                    connection.close()
+            except Exception as exception:
+                logging.warning('Unable to close connection: {}'.format(exception))
+
+    def recordExecute(self, seconds: float) -> None:
+        with self._lock:
+            self.executeTime += seconds
+            self.executeCount += 1
+
+    def logTimings(self) -> None:
+        logging.info('Connections: {} opened in {:.3f}s, {} statements executed in {:.3f}s.'.format(self.connectCount, self.connectTime, self.executeCount, self.executeTime))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closeAll()
@@ -0,0 +1,119 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+DEFAULT_TTL = 7 * 24 * 3600
+
+def pathSize(path: str) -> int:
+    """
+    Size of a dump file or of all files in a directory format dump.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, filename)) for root, _, filenames in os.walk(path) for filename in filenames)
+
+    return os.path.getsize(path)
+
+def removePath(path: str) -> None:
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+class DumpCache:
+    """
+    Index of dumps in the backups directory together with a fingerprint of the source database state at dump time.
+
+    A dump is reused when the source fingerprint did not change since it was taken. Entries expire after `ttl` seconds
+    and the oldest ones are removed, with their dumps, when the cached dumps exceed `maxSize` bytes (0 means no limit).
+    """
+
+    def __init__(self, path: str, ttl: int = DEFAULT_TTL, maxSize: int = 0):
+        self.path = path
+        self.ttl = ttl
+        self.maxSize = maxSize
+
+    @contextmanager
+    def _index(self):
+        """
+        Read the index and write it back, locked against other runs sharing the backups directory.
+        """
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            if os.path.exists(self.path):
+                with open(self.path) as file:
+                    entries = json.load(file)
+
+            yield entries
+
+            temporaryPath = '{}.tmp{}'.format(self.path, os.getpid())
+            with open(temporaryPath, 'w') as file:
+                json.dump(entries, file, indent=2)
+            os.replace(temporaryPath, self.path)
+
+    def lookup(self, key: str, fingerprint: dict) -> str:
+        """
+        Path of a valid dump taken with the same fingerprint, None on a miss.
+        """
+        if fingerprint is None:
+            return None
+
+        now = time.time()
+        with self._index() as entries:
+            for entry in reversed(entries):
+                if entry['key'] == key and entry['fingerprint'] == fingerprint and now - entry['created'] < self.ttl and os.path.exists(entry['path']):
+                    entry['used'] = now
+                    logging.info('Source database is unchanged, reusing dump "{}".'.format(entry['path']))
+                    return entry['path']
+
+        logging.info('No cached dump matches the source database state.')
+
+        return None
+
+    def record(self, key: str, fingerprint: dict, path: str) -> None:
+        if fingerprint is None:
+            return
+
+        now = time.time()
+        with self._index() as entries:
+            entries.append({
+                'key': key,
+                'fingerprint': fingerprint,
+                'path': path,
+                'size': pathSize(path),
+                'created': now,
+                'used': now,
+            })
+
+    def evict(self, keep: str = None) -> None:
+        """
+        Remove expired entries and, over the size limit, least recently used ones. The `keep` dump is never removed.
+        """
+        now = time.time()
+        with self._index() as entries:
+            valid = []
+            for entry in entries:
+                if entry['path'] != keep and (now - entry['created'] >= self.ttl or not os.path.exists(entry['path'])):
+                    logging.info('Evicting expired dump "{}".'.format(entry['path']))
+                    removePath(entry['path'])
+                else:
+                    valid.append(entry)
+
+            if self.maxSize:
+                valid.sort(key=lambda entry: entry['used'])
+                total = sum(entry['size'] for entry in valid)
+                for entry in list(valid):
+                    if total <= self.maxSize:
+                        break
+                    if entry['path'] == keep:
+                        continue
+                    logging.info('Evicting dump "{}" ({} bytes) over the cache size limit.'.format(entry['path'], entry['size']))
+                    removePath(entry['path'])
+                    valid.remove(entry)
+                    total -= entry['size']
+
+            entries[:] = valid
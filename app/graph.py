@@ -0,0 +1,114 @@
+import asyncio
+import inspect
+import logging
+
+from pipeline import cancelled
+
+class StepError(Exception):
+    pass
+
+class Step:
+    """
+    Named unit of work of a run, started once all steps it comes `after` have finished.
+
+    `run` takes no arguments. A coroutine function is awaited in the event loop, any other function
+    (blocking database calls, most of them) runs in a worker thread.
+    """
+
+    def __init__(self, name: str, run, after: tuple = ()):
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+
+def checkGraph(steps: list) -> None:
+    """
+    Raise StepError for duplicate names, unknown dependencies and cycles, which would leave steps waiting forever.
+    """
+    byName = {}
+    for step in steps:
+        if step.name in byName:
+            raise StepError('Step "{}" is defined twice'.format(step.name))
+        byName[step.name] = step
+
+    for step in steps:
+        for dependency in step.after:
+            if dependency not in byName:
+                raise StepError('Step "{}" depends on unknown step "{}"'.format(step.name, dependency))
+
+    done = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [step for step in remaining if all(dependency in done for dependency in step.after)]
+        if not ready:
+            raise StepError('Steps {} depend on each other'.format(', '.join('"{}"'.format(step.name) for step in remaining)))
+        done.update(step.name for step in ready)
+        remaining = [step for step in remaining if step.name not in done]
+
+def callStep(step: Step):
+    """
+    Call a blocking step. exit() of a step must not end the worker thread silently, it becomes a StepError.
+    """
+    try:
+        return step.run()
+    except SystemExit as exception:
+        raise StepError('Step "{}" exited with code {}'.format(step.name, exception.code)) from exception
+
+async def executeGraph(steps: list) -> dict:
+    """
+    Run steps concurrently as their dependencies allow. Returns results of the steps by name.
+
+    When a step fails `cancelled` is set, so running processes are stopped, steps which have not started are
+    cancelled and the error is raised once everything has stopped. Blocking steps can not be interrupted,
+    they are waited for.
+    """
+    checkGraph(steps)
+    tasks = {}
+
+    async def run(step):
+        for dependency in step.after:
+            await tasks[dependency]
+
+        if cancelled.is_set():
+            raise asyncio.CancelledError()
+
+        logging.debug('Starting step "{}"...'.format(step.name))
+        if inspect.iscoroutinefunction(step.run):
+            return await step.run()
+
+        return await asyncio.to_thread(callStep, step)
+
+    for step in steps:
+        tasks[step.name] = asyncio.ensure_future(run(step))
+
+    pending = set(tasks.values())
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+    except BaseException:
+        cancelled.set()
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+
+    return {name: task.result() for name, task in tasks.items()}
+
+def runGraph(steps: list) -> dict:
+    """
+    Run steps with executeGraph in a new event loop.
+
+    A step ended by exit() ends the run the same way once the other steps have stopped.
+    """
+    cancelled.clear()
+    try:
+        return asyncio.run(executeGraph(steps))
+    except StepError as exception:
+        if isinstance(exception.__cause__, SystemExit):
+            raise exception.__cause__
+        raise
+    finally:
+        # Worker threads are done once asyncio.run returns, later processes must not see the flag
+        cancelled.clear()
@@ -0,0 +1,220 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from dumpcache import pathSize
+
+SAMPLE_INTERVAL = 1.0
+
+class Sampler(threading.Thread):
+    """
+    Periodically read counters (e.g. rows and bytes written so far) while a phase is running.
+
+    `sample` returns a dict of monotonic counters. The first and the last sample give the totals of the phase,
+    the samples in between give the peak rate. A `close` method of `sample`, if any, is called when sampling stops.
+    """
+
+    def __init__(self, sample, interval: float = SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self._sample = sample
+        self._interval = interval
+        self._stopped = threading.Event()
+        self.samples = []
+
+    def _take(self) -> None:
+        try:
+            self.samples.append((time.monotonic(), self._sample()))
+        except Exception as exception:
+            logging.debug('Sampling failed: {}'.format(exception))
+
+    def run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self._take()
+
+    def start(self) -> None:
+        self._take()
+        super().start()
+
+    def stop(self) -> dict:
+        """
+        Stop sampling and return totals and peak rates of the counters.
+        """
+        self._stopped.set()
+        self.join()
+        self._take()
+        if hasattr(self._sample, 'close'):
+            self._sample.close()
+
+        result = {}
+        if len(self.samples) < 2:
+            return result
+
+        first, last = self.samples[0][1], self.samples[-1][1]
+        for counter in last:
+            if counter not in first:
+                continue
+            result[counter] = last[counter] - first[counter]
+            peak = 0.0
+            for (previousAt, previous), (currentAt, current) in zip(self.samples, self.samples[1:]):
+                if currentAt > previousAt and counter in previous and counter in current:
+                    peak = max(peak, (current[counter] - previous[counter]) / (currentAt - previousAt))
+            result['{}_per_second_peak'.format(counter)] = peak
+
+        return result
+
+class RunReport:
+    """
+    Timings and throughput of the phases of one run, written as JSON and as a Prometheus textfile.
+    """
+
+    def __init__(self):
+        self.labels = {}
+        self.phases = []
+        self.connections = {}
+        self.startedAt = time.time()
+        self.jsonPath = None
+        self.prometheusPath = None
+
+    @contextmanager
+    def phase(self, name: str, sample=None):
+        """
+        Time a phase. The yielded dict collects its metrics, counters from `sample` are added when it ends.
+        """
+        metrics = {}
+        entry = {'phase': name, 'started': datetime.now().isoformat(), 'status': 'failed', 'metrics': metrics}
+        self.phases.append(entry)
+        sampler = None
+        if sample is not None:
+            sampler = Sampler(sample)
+            sampler.start()
+
+        startedAt = time.monotonic()
+        try:
+            yield metrics
+            entry['status'] = 'ok'
+        finally:
+            entry['seconds'] = time.monotonic() - startedAt
+            if sampler is not None:
+                for counter, value in sampler.stop().items():
+                    metrics.setdefault(counter, value)
+            for counter in ('bytes', 'rows'):
+                if metrics.get(counter) is not None and entry['seconds'] > 0:
+                    metrics['{}_per_second'.format(counter)] = metrics[counter] / entry['seconds']
+            logging.info('Phase "{}" {} in {:.3f}s {}'.format(name, entry['status'], entry['seconds'], json.dumps(metrics)))
+
+    def timed(self, name: str, result=None, sampler=None):
+        """
+        Decorator timing every call of the function as a phase.
+
+        `result` maps the return value to metrics, `sampler` maps the call arguments (by name) to a sample function.
+        """
+        def decorator(function):
+            signature = inspect.signature(function)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                sample = None
+                if sampler is not None:
+                    bound = signature.bind(*args, **kwargs)
+                    bound.apply_defaults()
+                    sample = sampler(bound.arguments)
+
+                with self.phase(name, sample) as metrics:
+                    value = function(*args, **kwargs)
+                    if result is not None and value is not None:
+                        metrics.update(result(value))
+
+                return value
+
+            return wrapper
+
+        return decorator
+
+    def addPhase(self, name: str, seconds: float, status: str, metrics: dict) -> None:
+        self.phases.append({'phase': name, 'started': None, 'status': status, 'seconds': seconds, 'metrics': metrics})
+
+    def addConnections(self, manager) -> None:
+        self.connections = {
+            'connect_count': manager.connectCount,
+            'connect_seconds': manager.connectTime,
+            'execute_count': manager.executeCount,
+            'execute_seconds': manager.executeTime,
+        }
+
+    def toDict(self, succeeded: bool) -> dict:
+        return {
+            'labels': self.labels,
+            'started': datetime.fromtimestamp(self.startedAt).isoformat(),
+            'seconds': time.time() - self.startedAt,
+            'status': 'ok' if succeeded else 'failed',
+            'connections': self.connections,
+            'phases': self.phases,
+        }
+
+    def toPrometheus(self, succeeded: bool) -> str:
+        def labels(extra: dict = None) -> str:
+            values = dict(self.labels, **(extra or {}))
+            return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in sorted(values.items())) + '}'
+
+        lines = [
+            '# TYPE database_manager_run_success gauge',
+            'database_manager_run_success{} {}'.format(labels(), 1 if succeeded else 0),
+            '# TYPE database_manager_run_duration_seconds gauge',
+            'database_manager_run_duration_seconds{} {:.6f}'.format(labels(), time.time() - self.startedAt),
+            '# TYPE database_manager_run_timestamp_seconds gauge',
+            'database_manager_run_timestamp_seconds{} {:.0f}'.format(labels(), self.startedAt),
+        ]
+        for key, value in self.connections.items():
+            lines.append('# TYPE database_manager_connections_{} gauge'.format(key))
+            lines.append('database_manager_connections_{}{} {}'.format(key, labels(), value))
+
+        metricLines = {}
+        occurrences = {}
+        for phase in self.phases:
+            # A phase running more than once in a run (e.g. one restore per batch job) gets a numbered label, series must be unique
+            occurrences[phase['phase']] = occurrences.get(phase['phase'], 0) + 1
+            name = phase['phase'] if occurrences[phase['phase']] == 1 else '{}#{}'.format(phase['phase'], occurrences[phase['phase']])
+            phaseLabels = labels({'phase': name})
+            metricLines.setdefault('phase_duration_seconds', []).append('{} {:.6f}'.format(phaseLabels, phase['seconds']))
+            metricLines.setdefault('phase_success', []).append('{} {}'.format(phaseLabels, 1 if phase['status'] == 'ok' else 0))
+            for key, value in phase['metrics'].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metricLines.setdefault('phase_{}'.format(key), []).append('{} {}'.format(phaseLabels, value))
+
+        for name, values in metricLines.items():
+            lines.append('# TYPE database_manager_{} gauge'.format(name))
+            lines.extend('database_manager_{}{}'.format(name, value) for value in values)
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, succeeded: bool) -> None:
+        """
+        Write the configured report files. Files are replaced atomically, the textfile collector never sees half of one.
+        """
+        outputs = (
+            (self.jsonPath, lambda: json.dumps(self.toDict(succeeded), indent=2)),
+            (self.prometheusPath, lambda: self.toPrometheus(succeeded)),
+        )
+        for path, render in outputs:
+            if path is None:
+                continue
+            temporaryPath = '{}.tmp{}'.format(path, os.getpid())
+            with open(temporaryPath, 'w') as file:
+                file.write(render())
+            os.replace(temporaryPath, path)
+            logging.info('Report written to "{}".'.format(path))
+
+def fileSizeSampler(path: str):
+    """
+    Sample function reporting how many bytes a dump file or directory has grown to.
+    """
+    def sample():
+        return {'bytes': pathSize(path) if os.path.exists(path) else 0}
+
+    return sample
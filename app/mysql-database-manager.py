@@ -3,15 +3,81 @@
 #
 
 import argparse
+import concurrent.futures
 import configparser
+import hashlib
+import json
 import logging
+import os
+import queue
+import re
+import shutil
 import subprocess
+import threading
+import time
 
 import pymysql
 import sys
 from datetime import datetime
 
+from batch import formatSummary, readJobs, runBatch
+from checkpoint import Checkpoint, RestoreError, checkpointPath, findCheckpoint
+from compression import CODECS, EXTENSIONS, compressProcessOutput, decompressIntoProcess
+from connections import ConnectionManager
+from dumpcache import DEFAULT_TTL, DumpCache, pathSize
+from metrics import RunReport, fileSizeSampler
+from graph import Step, runGraph
+from pipeline import DEFAULT_BUFFER_SIZE, PipelineError, feedProcess, pipeProcesses, runProcess
+from selection import SAMPLE_BUCKETS, TableFilter, parseSubsetRule, planSubset
+from store import BackupStore
+
 BACKUP_PATH = './backups/'
+STORE_PATH = BACKUP_PATH + 'store/'
+CACHE_PATH = BACKUP_PATH + 'cache.json'
+MYSQL_CHUNK_ROWS = 1000000
+MYSQL_INSERT_BATCH_SIZE = 1024 * 1024
+MYSQL_CHECKPOINT_BATCH_SIZE = 64 * 1024 * 1024
+MYSQL_INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')
+# Fast load settings with a global value new sessions start with, sql_log_bin has none since MySQL 8.0
+MYSQL_FAST_LOAD_GLOBAL_SETTINGS = ('foreign_key_checks', 'unique_checks')
+MYSQL_SWAP_LOCK_WAIT_TIMEOUT = 5
+MYSQL_SWAP_ATTEMPTS = 5
+MYSQL_LOCK_WAIT_TIMEOUT_ERROR = 1205
+
+# Comments mysqldump writes before every table, view and the routines and events, a dump is restored in these units with a checkpoint
+MYSQL_DUMP_SECTION = re.compile(rb'^-- (Table structure for table|Temporary (?:view|table) structure for view|Final view structure for view|Dumping data for table|Dumping events for database|Dumping routines for database) (.*?)\r?\n?$')
+# Session settings of the dump header, repeated before every unit. Other header statements (GTID_PURGED) run once.
+MYSQL_DUMP_SESSION_SETTING = re.compile(rb'^(/\*!\d+ SET .*\*/;|SET @MYSQLDUMP_TEMP_LOG_BIN = .*;|SET @@SESSION\.SQL_LOG_BIN\s*=.*;)\r?\n?$')
+
+def openConnection(host: str, port: int, user: str, password: str, dbname: str):
+    return pymysql.connect(host=host, port=port, user=user, password=password, db=dbname, autocommit=True)
+
+report = RunReport()
+connections = ConnectionManager(openConnection, lambda connection: not connection.open)
+
+class ServerWriteSampler:
+    """
+    Sample rows inserted and bytes received by the server, to follow a restore running in the mysql client.
+    MySQL has no per-database counters, so these are server-wide.
+    Uses its own connection, the shared ones are not meant to be used from the sampling thread.
+    """
+
+    def __init__(self, host: str, port: int, user: str, password: str, databaseName: str):
+        self._arguments = (host, port, user, password, databaseName)
+        self._connection = None
+
+    def __call__(self) -> dict:
+        if self._connection is None:
+            self._connection = openConnection(*self._arguments)
+        with self._connection.cursor() as cursor:
+            cursor.execute('SHOW GLOBAL STATUS WHERE Variable_name IN (\'Innodb_rows_inserted\', \'Bytes_received\');')
+            status = dict(cursor.fetchall())
+
+        return {'rows': int(status['Innodb_rows_inserted']), 'bytes': int(status['Bytes_received'])}
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
 
 def initLoggers() -> None:
     # STDOUT logger
@@ -26,42 +92,415 @@ def initLoggers() -> None:
     root.addHandler(stdoutHandler)
 
 
+@report.timed('create_user')
 def createDatabseUser(host: str, port: int, user: str, password: str, newUser: str, newUserPassword: str, verbose: bool):
     """
     Create a new database user.
     """
     logging.info('Creating user "{}"...'.format(newUser))
-    connection = pymysql.connect(host=host, port=port, user=user, password=password, db='mysql')
-    with connection.cursor() as cursor:
-        cursor.execute('CREATE USER "{}";'.format(newUser))
+    with connections.cursor(host, port, user, password, 'mysql') as cursor:
+        # Refreshing a database with --swap keeps the user of the active one
+        cursor.execute('CREATE USER IF NOT EXISTS "{}";'.format(newUser))
         cursor.execute('ALTER USER "{0}" IDENTIFIED BY "{1}";'.format(newUser, newUserPassword))
         # cursor.execute('GRANT ALL PRIVILEGES ON *.* TO "{}";'.format(newUser))
 
+@report.timed('create_database')
 def createDatabase(host: str, port: int, user: str, password: str, newUser: str, databaseName: str, verbose: bool):
     """
     Create a new database.
     """
     logging.info('Creating database "{}"...'.format(databaseName))
-    connection = pymysql.connect(host=host, port=port, user=user, password=password, db='mysql')
-    with connection.cursor() as cursor:
+    with connections.cursor(host, port, user, password, 'mysql') as cursor:
         cursor.execute('CREATE DATABASE {0} CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci;'.format(databaseName))
         cursor.execute('GRANT ALL PRIVILEGES ON {0}.* TO \'{1}\'@\'%\';'.format(databaseName, newUser))
 
-def backupMysqlDb(host: str, databaseName: str, port: int, user: str, password: str, destFile: str, verbose: bool) -> bytes:
+def getDatabaseFingerprint(host: str, port: int, user: str, password: str, databaseName: str) -> dict:
+    """
+    Get a cheap fingerprint of the database state: binary log position of the server and table statistics of the database.
+    Without binary logging there is none: statistics (estimated row counts, update times) do not change on every write.
+    """
+    try:
+        with connections.cursor(host, port, user, password, databaseName) as cursor:
+            try:
+                # MySQL 8 caches information_schema statistics for a day by default
+                cursor.execute('SET SESSION information_schema_stats_expiry = 0;')
+            except pymysql.err.MySQLError:
+                pass
+
+            binlog = None
+            for statement in ('SHOW BINARY LOG STATUS;', 'SHOW MASTER STATUS;'):
+                try:
+                    cursor.execute(statement)
+                    row = cursor.fetchone()
+                    binlog = '{}:{}'.format(row[0], row[1]) if row else None
+                    break
+                except pymysql.err.MySQLError:
+                    continue
+
+            if binlog is None:
+                logging.warning('Binary logging is off on the server of database "{}", dump cache disabled.'.format(databaseName))
+                return None
+
+            cursor.execute(
+                'SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH, UPDATE_TIME, CREATE_TIME, CHECKSUM '
+                'FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME;',
+                (databaseName,)
+            )
+            tables = hashlib.sha256(repr(cursor.fetchall()).encode()).hexdigest()
+    except pymysql.err.MySQLError as error:
+        logging.warning('Unable to fingerprint database "{}", dump cache disabled: {}'.format(databaseName, error))
+        return None
+
+    return {
+        'binlog': binlog,
+        'tables': tables,
+    }
+
+def planMysqlSelection(host: str, port: int, user: str, password: str, databaseName: str, filters: TableFilter, rules: list) -> tuple:
+    """
+    Get tables left out by the filters and the row condition of every table copied only partially.
+    Percentages are sampled by a hash of the primary key (of all columns without one), so they are repeatable.
+    """
+    with connections.cursor(host, port, user, password, databaseName) as cursor:
+        cursor.execute('SELECT TABLE_NAME, TABLE_TYPE FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s;', (databaseName,))
+        tableTypes = dict(cursor.fetchall())
+        ignored = sorted(name for name in tableTypes if not filters.tableIncluded(databaseName, name))
+
+        if not rules:
+            return ignored, {}
+
+        cursor.execute('SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME, ORDINAL_POSITION;', (databaseName,))
+        columns = {}
+        for name, column in cursor.fetchall():
+            columns.setdefault(name, []).append(quoteIdentifier(column))
+
+        cursor.execute('SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = %s AND CONSTRAINT_NAME = \'PRIMARY\' ORDER BY TABLE_NAME, ORDINAL_POSITION;', (databaseName,))
+        primaryKeys = {}
+        for name, column in cursor.fetchall():
+            primaryKeys.setdefault(name, []).append(quoteIdentifier(column))
+
+        cursor.execute(
+            'SELECT TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE '
+            'WHERE TABLE_SCHEMA = %s AND REFERENCED_TABLE_SCHEMA = %s ORDER BY TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION;',
+            (databaseName, databaseName)
+        )
+        foreignKeys = {}
+        for name, constraint, column, parent, parentColumn in cursor.fetchall():
+            foreignKey = foreignKeys.setdefault((name, constraint), {'table': name, 'parent': parent, 'columns': [], 'parentColumns': []})
+            foreignKey['columns'].append(quoteIdentifier(column))
+            foreignKey['parentColumns'].append(quoteIdentifier(parentColumn))
+
+    tables = {}
+    for name, tableType in tableTypes.items():
+        if tableType == 'BASE TABLE' and name not in ignored:
+            tables[name] = {'schema': databaseName, 'name': name, 'sql': quoteIdentifier(name), 'keyColumns': primaryKeys.get(name) or columns[name]}
+
+    def sample(table, buckets):
+        return 'CRC32(CONCAT_WS(\'|\', {})) % {} < {}'.format(', '.join(table['keyColumns']), SAMPLE_BUCKETS, buckets)
+
+    subset = planSubset(tables, list(foreignKeys.values()), rules, sample)
+    for name, condition in subset.items():
+        logging.info('Subset of {}: {}'.format(quoteIdentifier(name), condition))
+
+    return ignored, subset
+
+@report.timed('dump', sampler=lambda arguments: fileSizeSampler(arguments['destFile']))
+def backupMysqlDb(host: str, databaseName: str, port: int, user: str, password: str, destFile: str, verbose: bool, ignoredTables: list = None, schemaOnly: bool = False, subset: dict = None) -> None:
     """
     Backup MySQL database to a file.
+
+    With a subset rows of subset tables must match the rows they reference in other tables, so rows of all tables
+    (subset ones selected by their condition) are read in one consistent snapshot instead of by mysqldump runs, between
+    table definitions and triggers, routines and events dumped by mysqldump while the snapshot is taken.
     """
     logging.info('Backing up database "{}"...'.format(databaseName))
+    ignored = ['--ignore-table={}.{}'.format(databaseName, name) for name in ignoredTables or []]
+
+    if not subset:
+        args = ['mysqldump',
+                '--host={}'.format(host),
+                '--port={}'.format(port),
+                '--user={}'.format(user),
+                '--password={}'.format(password),
+                '--single-transaction',
+                '--no-create-db',
+                '--routines',
+                '--triggers',
+                '--events',
+                ] + (['--no-data'] if schemaOnly else []) + ignored + [databaseName]
+
+        if verbose:
+            args.append('-v')
+
+        with open(destFile, 'wb') as file:
+            returncode = runProcess(args, stdout=file)
+
+        if int(returncode) != 0:
+            print('Command failed. Return code : {}'.format(returncode))
+            exit(1)
+        return
+
+    postDataFile = destFile + '.post-data'
+    tables = {}
+
+    def dumpSchema():
+        dumpMysqlSchema(host, databaseName, port, user, password, destFile, ['--skip-triggers'] + ignored, verbose)
+        dumpMysqlSchema(host, databaseName, port, user, password, postDataFile, ['--no-create-info', '--routines', '--triggers', '--events'] + ignored, verbose)
+        with connections.cursor(host, port, user, password, databaseName) as cursor:
+            cursor.execute(
+                'SELECT c.TABLE_NAME, c.COLUMN_NAME FROM information_schema.COLUMNS c '
+                'JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME '
+                'WHERE c.TABLE_SCHEMA = %s AND t.TABLE_TYPE = \'BASE TABLE\' AND c.EXTRA NOT LIKE \'%%GENERATED%%\' ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION;',
+                (databaseName,)
+            )
+            for table, column in cursor.fetchall():
+                if table not in (ignoredTables or []):
+                    tables.setdefault(table, []).append(column)
+
+    connection = openSnapshotConnections(host, port, user, password, databaseName, 1, dumpSchema)[0]
+    try:
+        # TIMESTAMP values are written in UTC like mysqldump does
+        with connection.cursor() as cursor:
+            cursor.execute('SET SESSION time_zone = \'+00:00\';')
+        with open(destFile, 'a', encoding='utf-8', errors='surrogateescape') as file:
+            # Settings of the mysqldump header were reset by its footer
+            file.write('/*!40101 SET NAMES utf8mb4 */;\n/*!40103 SET TIME_ZONE=\'+00:00\' */;\n/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n/*!40014 SET UNIQUE_CHECKS=0 */;\n')
+            for table, columns in tables.items():
+                file.write('\n-- Dumping data for table {}\n\n'.format(quoteIdentifier(table)))
+                rows = writeTableRows(connection, {'table': table, 'columns': columns, 'where': subset.get(table)}, file)
+                if verbose:
+                    logging.info('Dumped {} rows of "{}".'.format(rows, table))
+    finally:
+        connection.close()
+
+    with open(destFile, 'ab') as file, open(postDataFile, 'rb') as postData:
+        shutil.copyfileobj(postData, file, DEFAULT_BUFFER_SIZE)
+    os.remove(postDataFile)
+
+def splitMysqlDump(path: str) -> tuple:
+    """
+    Split a mysqldump file into its header and a unit per table, view, routines and events.
+    Rows dumped right after the definition of their table belong to its unit, rows dumped on their own (`--where` runs) are a unit of their own.
+    Returns session settings of the header and the units with their name, byte range and the table of rows dumped on their own.
+    """
+    prelude = []
+    units = [{'name': 'header', 'start': 0, 'table': None}]
+    offset = 0
+    with open(path, 'rb') as file:
+        for line in file:
+            section = MYSQL_DUMP_SECTION.match(line)
+            if section is not None:
+                kind, name = section.group(1).decode(), section.group(2).decode('utf-8', errors='replace')
+                if kind != 'Dumping data for table' or units[-1]['name'] != 'Table structure for table {}'.format(name):
+                    units[-1]['end'] = offset
+                    units.append({'name': '{} {}'.format(kind, name), 'start': offset, 'table': name if kind == 'Dumping data for table' else None})
+            elif len(units) == 1 and MYSQL_DUMP_SESSION_SETTING.match(line):
+                prelude.append(line)
+            offset += len(line)
+    units[-1]['end'] = offset
+
+    return b''.join(prelude), units
+
+def dropMysqlTriggers(cursor, databaseName: str, table: str = None) -> None:
+    """
+    Drop triggers of a table or of the whole database, a dump creates them without dropping them first.
+    """
+    query = 'SELECT TRIGGER_NAME FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s'
+    params = [databaseName]
+    if table is not None:
+        query += ' AND EVENT_OBJECT_TABLE = %s'
+        params.append(table)
+    cursor.execute(query + ';', params)
+    for (name,) in cursor.fetchall():
+        cursor.execute('DROP TRIGGER IF EXISTS {};'.format(quoteIdentifier(name)))
+
+def feedMysqlUnits(args: list, backup_file: str, checkpoint: Checkpoint, connect, prefix: bytes = b'', suffix: bytes = b'') -> int:
+    """
+    Feed a mysqldump file to mysql in batches of consecutive units, each batch by its own process, and record the units
+    of every finished batch in the checkpoint. A batch ends once it has MYSQL_CHECKPOINT_BATCH_SIZE bytes, so small
+    tables share a process and a large one is a batch of its own.
+
+    Tables and views are dropped by the dump before they are created, so a unit done partly by a failed run is simply
+    run again. Rows dumped on their own are deleted first, together with triggers of their table.
+    `connect` returns a cursor of the restored database. Returns number of bytes fed.
+    """
+    prelude, units = splitMysqlDump(backup_file)
+    batches = []
+    for index, unit in enumerate(units):
+        if checkpoint.isDone('{} {}'.format(unit['start'], unit['name'])):
+            continue
+        batch = batches[-1] if batches else None
+        if batch is None or batch[-1]['index'] != index - 1 or batch[-1]['end'] - batch[0]['start'] >= MYSQL_CHECKPOINT_BATCH_SIZE:
+            batch = []
+            batches.append(batch)
+        batch.append(dict(unit, index=index))
+
+    size = 0
+    with open(backup_file, 'rb') as file:
+        for batch in batches:
+            if checkpoint.resumed:
+                for unit in batch:
+                    if unit['table'] is None:
+                        continue
+                    table = unit['table'].strip('`').replace('``', '`')
+                    with connect() as cursor:
+                        # Rows referencing the table are restored in their own units
+                        cursor.execute('SET SESSION foreign_key_checks = 0;')
+                        cursor.execute('DELETE FROM {};'.format(quoteIdentifier(table)))
+                        cursor.execute('SET SESSION foreign_key_checks = DEFAULT;')
+                        dropMysqlTriggers(cursor, checkpoint.info['target'], table)
+
+            def blocks():
+                yield prefix
+                if batch[0]['name'] != 'header':
+                    yield prelude
+                file.seek(batch[0]['start'])
+                remaining = batch[-1]['end'] - batch[0]['start']
+                while remaining > 0:
+                    block = file.read(min(DEFAULT_BUFFER_SIZE, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    yield block
+                yield suffix
+
+            names = batch[0]['name'] if len(batch) == 1 else '{} to {}'.format(batch[0]['name'], batch[-1]['name'])
+            try:
+                size += feedProcess(args, blocks())
+            except PipelineError as exception:
+                raise RestoreError('Restoring {} failed: {}'.format(names, exception)) from exception
+
+            checkpoint.markAllDone(['{} {}'.format(unit['start'], unit['name']) for unit in batch])
+            logging.info('Restored {} ({}/{}).'.format(names, batch[-1]['index'] + 1, len(units)))
+
+    return size
+
+@report.timed('restore', sampler=lambda arguments: ServerWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restoreMysqlDb(db_host, db, port, user, password, backup_file, verbose, checkpoint=None):
+    """
+    Restore MySQL db from a file.
+    With a checkpoint the file is restored table by table and every finished table is recorded.
+    """
+    logging.info('Restoring database "{}"...'.format(db))
+    args = ['mysql',
+            '--host={}'.format(db_host),
+            '--port={}'.format(port),
+            '--user={}'.format(user),
+            '--password={}'.format(password),
+            '--database={}'.format(db),
+        ]
+
+    if verbose:
+        args.append('-v')
+
+    if checkpoint is not None:
+        feedMysqlUnits(args, backup_file, checkpoint, lambda: connections.cursor(db_host, port, user, password, db))
+        return
+
+    # Statements echoed by -v are not worth logging, errors on stderr are
+    with open(backup_file, 'rb') as f:
+        returncode = runProcess(args, stdin=f, stdout=subprocess.DEVNULL)
+
+    if int(returncode) != 0:
+        raise RestoreError('Restoring database "{}" failed. Return code : {}'.format(db, returncode))
+
+def getGlobalSettings(host: str, port: int, user: str, password: str, databaseName: str) -> dict:
+    """
+    Get global values of fast load settings, which new sessions start with.
+    """
+    with connections.cursor(host, port, user, password, databaseName) as cursor:
+        cursor.execute('SELECT {};'.format(', '.join('@@GLOBAL.{}'.format(name) for name in MYSQL_FAST_LOAD_GLOBAL_SETTINGS)))
+        return dict(zip(MYSQL_FAST_LOAD_GLOBAL_SETTINGS, cursor.fetchone()))
+
+def getFastLoadSettings(host: str, port: int, user: str, password: str, databaseName: str) -> dict:
+    """
+    Get session settings for bulk loading.
+    Disabling the binary log needs SUPER or SESSION_VARIABLES_ADMIN, without it the restore is still logged.
+    """
+    settings = {'foreign_key_checks': 0, 'unique_checks': 0}
+    try:
+        with connections.cursor(host, port, user, password, databaseName) as cursor:
+            cursor.execute('SET SESSION sql_log_bin = 0;')
+            cursor.execute('SET SESSION sql_log_bin = DEFAULT;')
+        settings['sql_log_bin'] = 0
+    except pymysql.MySQLError as error:
+        logging.warning('Unable to disable binary logging, the restore will be logged: {}'.format(error))
+
+    return settings
+
+def sessionSettingsStatement(settings: dict) -> str:
+    return 'SET SESSION {};'.format(', '.join('{} = {}'.format(name, value) for name, value in settings.items()))
+
+def verifyGlobalSettings(host: str, port: int, user: str, password: str, databaseName: str, safeSettings: dict) -> None:
+    """
+    Check that fast load settings were not changed globally during the restore, the restore itself only sets them per session.
+    """
+    settings = getGlobalSettings(host, port, user, password, databaseName)
+    if settings != safeSettings:
+        logging.error('Global settings of the server of database "{}" are {} instead of {}.'.format(databaseName, settings, safeSettings))
+        exit(1)
+
+    logging.info('Global settings of the server of database "{}" are {}.'.format(databaseName, settings))
+
+@report.timed('restore', result=lambda size: {'bytes': size}, sampler=lambda arguments: ServerWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restoreMysqlDbFastLoad(db_host, db, port, user, password, backup_file, verbose, checkpoint=None) -> int:
+    """
+    Restore MySQL db from a file with key checks and binary logging disabled for the session.
+    Autocommit is off, so rows are committed in batches: every table of a mysqldump ends with UNLOCK TABLES, which commits.
+    With a checkpoint every table is restored by its own session with the same settings.
+    """
+    logging.info('Restoring database "{}" in fast load mode...'.format(db))
+    safeSettings = getGlobalSettings(db_host, port, user, password, db)
+    settings = getFastLoadSettings(db_host, port, user, password, db)
+
+    args = ['mysql',
+            '--host={}'.format(db_host),
+            '--port={}'.format(port),
+            '--user={}'.format(user),
+            '--password={}'.format(password),
+            '--database={}'.format(db),
+        ]
+
+    if verbose:
+        args.append('-v')
+
+    prefix = '{}\nSET autocommit = 0;\n'.format(sessionSettingsStatement(settings)).encode()
+    suffix = '\nCOMMIT;\nSET autocommit = 1;\n{}\n'.format(sessionSettingsStatement({name: 'DEFAULT' for name in settings})).encode()
+
+    def blocks():
+        yield prefix
+        with open(backup_file, 'rb') as file:
+            while True:
+                block = file.read(DEFAULT_BUFFER_SIZE)
+                if not block:
+                    break
+                yield block
+        yield suffix
+
+    if checkpoint is not None:
+        size = feedMysqlUnits(args, backup_file, checkpoint, lambda: connections.cursor(db_host, port, user, password, db), prefix, suffix)
+    else:
+        size = feedProcess(args, blocks())
+    verifyGlobalSettings(db_host, port, user, password, db, safeSettings)
+
+    return size
+
+@report.timed('dump', result=lambda stats: {'bytes': stats['uncompressed'], 'compressed_bytes': stats['compressed']})
+def backupMysqlDbCompressed(host: str, databaseName: str, port: int, user: str, password: str, destFile: str, codec: str, level: int, threads: int, verbose: bool) -> dict:
+    """
+    Backup MySQL database to a file compressed by an external multithreaded compressor.
+    """
+    logging.info('Backing up database "{}" compressed with {}...'.format(databaseName, codec))
     args = ['mysqldump',
             '--host={}'.format(host),
             '--port={}'.format(port),
             '--user={}'.format(user),
             '--password={}'.format(password),
-            '--result-file={}'.format(destFile),
             '--routines',
             '--triggers',
             '--events',
             '--single-transaction',
+            '--quick',
             '--no-create-db',
             databaseName,
             ]
@@ -69,20 +508,61 @@ def backupMysqlDb(host: str, databaseName: str, port: int, user: str, password:
     if verbose:
         args.append('-v')
 
-    process = subprocess.Popen(args, stdout=subprocess.PIPE)
-    output = process.communicate()[0]
+    return compressProcessOutput(args, destFile, codec, level, threads)
 
-    if int(process.returncode) != 0:
-        print('Command failed. Return code : {}'.format(process.returncode))
-        exit(1)
+@report.timed('restore', result=lambda stats: {'bytes': stats['uncompressed'], 'compressed_bytes': stats['compressed']}, sampler=lambda arguments: ServerWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restoreMysqlDbCompressed(db_host, db, port, user, password, backup_file, verbose) -> dict:
+    """
+    Restore MySQL db from a compressed file, decompressing it on the fly.
+    """
+    logging.info('Restoring database "{}"...'.format(db))
+    args = ['mysql',
+            '--host={}'.format(db_host),
+            '--port={}'.format(port),
+            '--user={}'.format(user),
+            '--password={}'.format(password),
+            '--database={}'.format(db),
+        ]
+
+    if verbose:
+        args.append('-v')
 
-    return output
+    return decompressIntoProcess(backup_file, args)
 
-def restoreMysqlDb(db_host, db, port, user, password, backup_file, verbose):
+@report.timed('dump', result=lambda manifest: {'bytes': manifest['size'], 'chunks': len(manifest['chunks'])})
+def backupMysqlDbToStore(host: str, databaseName: str, port: int, user: str, password: str, store: BackupStore, name: str, verbose: bool) -> dict:
     """
-    Restore postgres db from a file.
+    Backup MySQL database into the deduplicating store.
+    One INSERT per row keeps unchanged rows byte-identical between runs, so they deduplicate.
     """
-    logging.info('Restoring database "{}"...'.format(db))
+    logging.info('Backing up database "{}" into store...'.format(databaseName))
+    args = ['mysqldump',
+            '--host={}'.format(host),
+            '--port={}'.format(port),
+            '--user={}'.format(user),
+            '--password={}'.format(password),
+            '--routines',
+            '--triggers',
+            '--events',
+            '--single-transaction',
+            '--quick',
+            '--skip-extended-insert',
+            '--skip-dump-date',
+            '--no-create-db',
+            databaseName,
+            ]
+
+    if verbose:
+        args.append('-v')
+
+    return store.backupProcess(args, name, databaseName)
+
+@report.timed('restore', result=lambda size: {'bytes': size}, sampler=lambda arguments: ServerWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restoreMysqlDbFromStore(db_host, db, port, user, password, store, name, verbose) -> int:
+    """
+    Restore MySQL db streaming a backup from the store.
+    """
+    logging.info('Restoring database "{}" from "{}"...'.format(db, name))
     args = ['mysql',
             '--host={}'.format(db_host),
             '--port={}'.format(port),
@@ -94,15 +574,470 @@ def restoreMysqlDb(db_host, db, port, user, password, backup_file, verbose):
     if verbose:
         args.append('-v')
 
-    with open(backup_file, 'rb') as f:
-        process = subprocess.Popen(args, stdin=f, stdout=subprocess.PIPE)
-        output = process.communicate()[0]
+    return store.restoreProcess(name, args)
+
+@report.timed('stream', result=lambda size: {'bytes': size}, sampler=lambda arguments: ServerWriteSampler(arguments['restore_host'], arguments['restore_port'], arguments['restore_user'], arguments['restore_password'], arguments['restore_db']))
+def streamMysqlDb(backup_host, backup_db, backup_port, backup_user, backup_password, restore_host, restore_db, restore_port, restore_user, restore_password, tee_file, buffer_size, verbose):
+    """
+    Pipe mysqldump straight into mysql without an intermediate file.
+    """
+    logging.info('Streaming database "{}" into "{}"...'.format(backup_db, restore_db))
+    dumpArgs = ['mysqldump',
+            '--host={}'.format(backup_host),
+            '--port={}'.format(backup_port),
+            '--user={}'.format(backup_user),
+            '--password={}'.format(backup_password),
+            '--routines',
+            '--triggers',
+            '--events',
+            '--single-transaction',
+            '--quick',
+            '--no-create-db',
+            backup_db,
+            ]
+    restoreArgs = ['mysql',
+            '--host={}'.format(restore_host),
+            '--port={}'.format(restore_port),
+            '--user={}'.format(restore_user),
+            '--password={}'.format(restore_password),
+            '--database={}'.format(restore_db),
+        ]
+
+    if verbose:
+        dumpArgs.append('-v')
+        restoreArgs.append('-v')
+
+    return pipeProcesses(dumpArgs, restoreArgs, teeFile=tee_file, bufferSize=buffer_size)
+
+def quoteIdentifier(name: str) -> str:
+    return '`{}`'.format(name.replace('`', '``'))
+
+def dumpMysqlSchema(host: str, databaseName: str, port: int, user: str, password: str, destFile: str, options: list, verbose: bool) -> None:
+    """
+    Dump part of the database definition (no table data) with mysqldump.
+    """
+    args = ['mysqldump',
+            '--host={}'.format(host),
+            '--port={}'.format(port),
+            '--user={}'.format(user),
+            '--password={}'.format(password),
+            '--result-file={}'.format(destFile),
+            '--single-transaction',
+            '--no-create-db',
+            '--no-data',
+            ] + options + [databaseName]
 
-    if int(process.returncode) != 0:
-        print('Command failed. Return code : {}'.format(process.returncode))
-        # TODO: raise exception or something like that
+    if verbose:
+        args.append('-v')
+
+    returncode = runProcess(args)
+
+    if int(returncode) != 0:
+        print('Command failed. Return code : {}'.format(returncode))
+        exit(1)
+
+def openSnapshotConnections(host: str, port: int, user: str, password: str, databaseName: str, count: int, whileLocked=None) -> list:
+    """
+    Open worker connections which all see the same consistent snapshot of the database.
+
+    The snapshot transactions are started while a global read lock is held, so no write can land in between.
+    `whileLocked` runs after that, before the lock is released, so no DDL can land between the snapshot and what it
+    reads (table definitions dumped by mysqldump). Without RELOAD privilege the lock is skipped and every worker gets
+    its own snapshot.
+    """
+    workers = [pymysql.connect(host=host, port=port, user=user, password=password, db=databaseName) for _ in range(count)]
+    with connections.cursor(host, port, user, password, databaseName) as cursor:
+        locked = False
+        try:
+            cursor.execute('FLUSH TABLES WITH READ LOCK;')
+            locked = True
+        except pymysql.err.OperationalError as error:
+            logging.warning('Unable to lock tables, workers will not share a snapshot: {}'.format(error))
+
+        try:
+            for worker in workers:
+                with worker.cursor() as workerCursor:
+                    workerCursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+                    workerCursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY;')
+            if whileLocked is not None:
+                whileLocked()
+        finally:
+            if locked:
+                cursor.execute('UNLOCK TABLES;')
+
+    return workers
+
+def listTableChunks(host: str, port: int, user: str, password: str, databaseName: str, chunkRows: int) -> list:
+    """
+    Split base tables into chunks. Tables with a single integer primary key and more than chunkRows rows
+    are split into primary key ranges, the others are dumped whole.
+    """
+    chunks = []
+    with connections.cursor(host, port, user, password, databaseName) as cursor:
+        cursor.execute('SELECT TABLE_NAME, COALESCE(TABLE_ROWS, 0) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = \'BASE TABLE\' ORDER BY DATA_LENGTH DESC;', (databaseName,))
+        tables = cursor.fetchall()
+
+        for table, estimatedRows in tables:
+            cursor.execute('SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND EXTRA NOT LIKE \'%%GENERATED%%\' ORDER BY ORDINAL_POSITION;', (databaseName, table))
+            columns = [row[0] for row in cursor.fetchall()]
+
+            cursor.execute(
+                'SELECT k.COLUMN_NAME, c.DATA_TYPE FROM information_schema.KEY_COLUMN_USAGE k '
+                'JOIN information_schema.COLUMNS c ON c.TABLE_SCHEMA = k.TABLE_SCHEMA AND c.TABLE_NAME = k.TABLE_NAME AND c.COLUMN_NAME = k.COLUMN_NAME '
+                'WHERE k.TABLE_SCHEMA = %s AND k.TABLE_NAME = %s AND k.CONSTRAINT_NAME = \'PRIMARY\';',
+                (databaseName, table)
+            )
+            primaryKey = cursor.fetchall()
+
+            if estimatedRows <= chunkRows or len(primaryKey) != 1 or primaryKey[0][1] not in MYSQL_INTEGER_TYPES:
+                chunks.append({'table': table, 'columns': columns, 'where': None})
+                continue
+
+            keyColumn = quoteIdentifier(primaryKey[0][0])
+            cursor.execute('SELECT MIN({0}), MAX({0}) FROM {1};'.format(keyColumn, quoteIdentifier(table)))
+            low, high = cursor.fetchone()
+            if low is None:
+                chunks.append({'table': table, 'columns': columns, 'where': None})
+                continue
+
+            # First and last ranges are open-ended to catch rows written before the snapshot was taken
+            step = max(1, (high - low + 1) * chunkRows // estimatedRows)
+            bounds = list(range(low + step, high + 1, step))
+            conditions = ['{} < {}'.format(keyColumn, bounds[0])] if bounds else []
+            conditions += ['{0} >= {1} AND {0} < {2}'.format(keyColumn, start, end) for start, end in zip(bounds, bounds[1:])]
+            conditions.append('{} >= {}'.format(keyColumn, bounds[-1]) if bounds else None)
+            for condition in conditions:
+                chunks.append({'table': table, 'columns': columns, 'where': condition})
+
+    return chunks
+
+def dumpTableChunk(connection, chunk: dict, destFile: str) -> int:
+    """
+    Write rows of a chunk as multi-row INSERT statements, one statement per line.
+    Binary values are escaped by pymysql into surrogates, hence the surrogateescape file encoding.
+    """
+    with open(destFile, 'w', encoding='utf-8', errors='surrogateescape') as file:
+        return writeTableRows(connection, chunk, file)
+
+def writeTableRows(connection, chunk: dict, file) -> int:
+    """
+    Write rows of a chunk read by the connection to a text file, see dumpTableChunk. Returns number of rows.
+    """
+    columns = ', '.join(quoteIdentifier(column) for column in chunk['columns'])
+    insert = 'INSERT INTO {} ({}) VALUES '.format(quoteIdentifier(chunk['table']), columns)
+    query = 'SELECT {} FROM {}'.format(columns, quoteIdentifier(chunk['table']))
+    if chunk['where']:
+        query += ' WHERE {}'.format(chunk['where'])
+
+    rows = 0
+    with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute(query)
+        batch = []
+        batchSize = 0
+        for row in cursor:
+            values = '({})'.format(', '.join(connection.escape(value) for value in row))
+            batch.append(values)
+            batchSize += len(values)
+            rows += 1
+            if batchSize >= MYSQL_INSERT_BATCH_SIZE:
+                file.write(insert + ', '.join(batch) + ';\n')
+                batch = []
+                batchSize = 0
+
+        if batch:
+            file.write(insert + ', '.join(batch) + ';\n')
+
+    return rows
+
+@report.timed('dump', result=lambda manifest: {'rows': sum(chunk['rows'] for chunk in manifest['chunks']), 'chunks': len(manifest['chunks'])}, sampler=lambda arguments: fileSizeSampler(arguments['destDir']))
+def backupMysqlDbParallel(host: str, databaseName: str, port: int, user: str, password: str, destDir: str, jobs: int, verbose: bool) -> dict:
+    """
+    Backup MySQL database to a directory with table data dumped in chunks by parallel workers.
+    """
+    logging.info('Backing up database "{}" with {} jobs...'.format(databaseName, jobs))
+    os.makedirs(os.path.join(destDir, 'data'))
+
+    chunks = []
+
+    def dumpSchema():
+        # Writes are blocked meanwhile, definitions and columns of the chunks match the rows of the snapshot
+        dumpMysqlSchema(host, databaseName, port, user, password, os.path.join(destDir, 'tables.sql'), ['--skip-triggers'], verbose)
+        dumpMysqlSchema(host, databaseName, port, user, password, os.path.join(destDir, 'post-data.sql'), ['--no-create-info', '--routines', '--triggers', '--events'], verbose)
+        chunks.extend(listTableChunks(host, port, user, password, databaseName, MYSQL_CHUNK_ROWS))
+
+    workers = openSnapshotConnections(host, port, user, password, databaseName, jobs, dumpSchema)
+    for index, chunk in enumerate(chunks):
+        chunk['file'] = os.path.join('data', '{:06d}.sql'.format(index))
+    idle = queue.Queue()
+    for worker in workers:
+        idle.put(worker)
+
+    def dumpChunk(chunk):
+        worker = idle.get()
+        try:
+            chunk['rows'] = dumpTableChunk(worker, chunk, os.path.join(destDir, chunk['file']))
+            if verbose:
+                logging.info('Dumped {} rows of "{}" into {}.'.format(chunk['rows'], chunk['table'], chunk['file']))
+        finally:
+            idle.put(worker)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in concurrent.futures.as_completed([executor.submit(dumpChunk, chunk) for chunk in chunks]):
+                future.result()
+    finally:
+        for worker in workers:
+            worker.close()
+
+    manifest = {'database': databaseName, 'chunks': chunks}
+    with open(os.path.join(destDir, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+    logging.info('Dumped {} rows from {} chunks.'.format(sum(chunk['rows'] for chunk in chunks), len(chunks)))
+
+    return manifest
+
+def loadTableChunk(connection, srcFile: str, clear: str = None) -> None:
+    """
+    Execute a chunk file written by dumpTableChunk and commit it.
+    `clear` runs in the same transaction first, e.g. to delete rows of the chunk loaded by a failed run.
+    """
+    with connection.cursor() as cursor, open(srcFile, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        if clear is not None:
+            cursor.execute(clear)
+        for statement in file:
+            cursor.execute(statement)
+    connection.commit()
+
+@report.timed('restore', sampler=lambda arguments: ServerWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restoreMysqlDbParallel(db_host, db, port, user, password, backup_dir, jobs, verbose, fastLoad=False, checkpoint=None):
+    """
+    Restore MySQL db from a directory written by backupMysqlDbParallel.
+    Tables are created first, chunks are loaded by parallel workers, routines, triggers and events are restored last.
+    In fast load mode workers also skip unique checks and binary logging, every chunk is still one commit.
+    With a checkpoint every loaded chunk is recorded, a resumed chunk deletes its rows in the transaction loading them.
+    """
+    logging.info('Restoring database "{}" with {} jobs...'.format(db, jobs))
+    # Chunks of related tables are loaded in any order
+    settings = {'foreign_key_checks': 0}
+    if fastLoad:
+        safeSettings = getGlobalSettings(db_host, port, user, password, db)
+        settings = getFastLoadSettings(db_host, port, user, password, db)
+    with open(os.path.join(backup_dir, 'manifest.json')) as file:
+        manifest = json.load(file)
+
+    if checkpoint is None or not checkpoint.isDone('tables'):
+        restoreMysqlDb(db_host, db, port, user, password, os.path.join(backup_dir, 'tables.sql'), verbose)
+        if checkpoint is not None:
+            checkpoint.markDone('tables')
+
+    local = threading.local()
+    workers = []
+    workersLock = threading.Lock()
+
+    def loadChunk(chunk):
+        if not hasattr(local, 'connection'):
+            local.connection = pymysql.connect(host=db_host, port=port, user=user, password=password, db=db)
+            with local.connection.cursor() as cursor:
+                cursor.execute(sessionSettingsStatement(settings))
+            with workersLock:
+                workers.append(local.connection)
+        clear = None
+        if checkpoint is not None and checkpoint.resumed:
+            clear = 'DELETE FROM {}{};'.format(quoteIdentifier(chunk['table']), ' WHERE {}'.format(chunk['where']) if chunk['where'] else '')
+        loadTableChunk(local.connection, os.path.join(backup_dir, chunk['file']), clear)
+        if checkpoint is not None:
+            checkpoint.markDone('chunk:{}'.format(chunk['file']))
+        if verbose:
+            logging.info('Loaded {} rows of "{}" from {}.'.format(chunk['rows'], chunk['table'], chunk['file']))
+
+    chunks = [chunk for chunk in manifest['chunks'] if checkpoint is None or not checkpoint.isDone('chunk:{}'.format(chunk['file']))]
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in concurrent.futures.as_completed([executor.submit(loadChunk, chunk) for chunk in chunks]):
+                future.result()
+    finally:
+        for worker in workers:
+            worker.close()
+
+    if checkpoint is None or not checkpoint.isDone('post-data'):
+        if checkpoint is not None and checkpoint.resumed:
+            with connections.cursor(db_host, port, user, password, db) as cursor:
+                dropMysqlTriggers(cursor, db)
+        restoreMysqlDb(db_host, db, port, user, password, os.path.join(backup_dir, 'post-data.sql'), verbose)
+        if checkpoint is not None:
+            checkpoint.markDone('post-data')
+
+    if fastLoad:
+        verifyGlobalSettings(db_host, port, user, password, db, safeSettings)
+
+def getTriggerDefinitions(cursor, databaseName: str) -> list:
+    cursor.execute('SELECT TRIGGER_NAME FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s ORDER BY EVENT_OBJECT_TABLE, ACTION_ORDER;', (databaseName,))
+    definitions = []
+    for (name,) in cursor.fetchall():
+        cursor.execute('SHOW CREATE TRIGGER {}.{};'.format(quoteIdentifier(databaseName), quoteIdentifier(name)))
+        row = cursor.fetchone()
+        definitions.append({'kind': 'TRIGGER', 'name': name, 'sqlMode': row[1], 'statement': row[2]})
+
+    return definitions
+
+def getObjectDefinitions(cursor, databaseName: str) -> list:
+    """
+    Get definitions of views, routines and events, which stay in their database when its tables are renamed.
+    Read from the database itself, so names of its tables in view definitions are not qualified.
+    """
+    cursor.execute('SELECT TABLE_NAME FROM information_schema.VIEWS WHERE TABLE_SCHEMA = %s;', (databaseName,))
+    objects = [('VIEW', name) for (name,) in cursor.fetchall()]
+    cursor.execute('SELECT ROUTINE_TYPE, ROUTINE_NAME FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = %s;', (databaseName,))
+    objects.extend(cursor.fetchall())
+    cursor.execute('SELECT \'EVENT\', EVENT_NAME FROM information_schema.EVENTS WHERE EVENT_SCHEMA = %s;', (databaseName,))
+    objects.extend(cursor.fetchall())
+
+    definitions = []
+    cursor.execute('USE {};'.format(quoteIdentifier(databaseName)))
+    try:
+        for kind, name in objects:
+            cursor.execute('SHOW CREATE {} {};'.format(kind, quoteIdentifier(name)))
+            row = cursor.fetchone()
+            if kind == 'VIEW':
+                definitions.append({'kind': kind, 'name': name, 'sqlMode': None, 'statement': row[1]})
+            else:
+                definitions.append({'kind': kind, 'name': name, 'sqlMode': row[1], 'statement': row[3 if kind == 'EVENT' else 2]})
+    finally:
+        cursor.execute('USE mysql;')
+
+    return definitions
+
+def dropObjects(cursor, databaseName: str, definitions: list) -> None:
+    for definition in definitions:
+        cursor.execute('DROP {} IF EXISTS {}.{};'.format(definition['kind'], quoteIdentifier(databaseName), quoteIdentifier(definition['name'])))
+
+def createObjects(cursor, databaseName: str, definitions: list) -> None:
+    """
+    Create objects from their definitions in the database.
+    Views may use views created after them, those failing are tried again while any other succeeds.
+    """
+    cursor.execute('USE {};'.format(quoteIdentifier(databaseName)))
+    try:
+        pending = list(definitions)
+        while pending:
+            failed = []
+            error = None
+            for definition in pending:
+                if definition['sqlMode'] is not None:
+                    cursor.execute('SET SESSION sql_mode = %s;', (definition['sqlMode'],))
+                try:
+                    cursor.execute(definition['statement'])
+                except pymysql.MySQLError as exception:
+                    if definition['kind'] != 'VIEW':
+                        raise
+                    failed.append(definition)
+                    error = exception
+            if len(failed) == len(pending):
+                raise error
+            pending = failed
+    finally:
+        cursor.execute('SET SESSION sql_mode = DEFAULT;')
+        cursor.execute('USE mysql;')
+
+def rollBackSwap(cursor, restore_database: str, active_database: str, old_database: str, tables: dict, newDefinitions: list, oldDefinitions: list) -> None:
+    """
+    Move tables renamed by a swap back and put back triggers, views, routines and events of both databases.
+    Raises RestoreError naming the objects which may be missing when that fails too.
+    """
+    try:
+        dropObjects(cursor, active_database, newDefinitions + [definition for definition in oldDefinitions if definition['kind'] != 'TRIGGER'])
+        renames = ['{0}.{2} TO {1}.{2}'.format(quoteIdentifier(active_database), quoteIdentifier(restore_database), quoteIdentifier(name)) for name in tables[restore_database]]
+        renames += ['{0}.{2} TO {1}.{2}'.format(quoteIdentifier(old_database), quoteIdentifier(active_database), quoteIdentifier(name)) for name in tables[active_database]]
+        if renames:
+            cursor.execute('RENAME TABLE {};'.format(', '.join(renames)))
+        createObjects(cursor, active_database, oldDefinitions)
+        createObjects(cursor, restore_database, [definition for definition in newDefinitions if definition['kind'] == 'TRIGGER'])
+    except pymysql.MySQLError as error:
+        missing = ', '.join('{} {}'.format(definition['kind'], definition['name']) for definition in oldDefinitions)
+        raise RestoreError('Rolling back the swap of database "{}" failed, its tables may be in "{}" and these objects may be missing: {}. Error: {}'.format(active_database, old_database, missing or 'none', error)) from error
+
+@report.timed('swap', result=lambda downtime: {'downtime_seconds': downtime})
+def swapRestoreActive(db_host, restore_database, active_database, old_database, db_port, user_name, user_password, new_user) -> float:
+    """
+    Put tables of the restored database in place of the tables of the active one, which are moved to old_database.
+
+    MySQL can not rename databases, so all tables are moved by one RENAME TABLE statement, which is atomic: clients
+    see either the old or the new tables. Tables with triggers can not be moved to another database, their triggers
+    are dropped before and created again after the rename. Views, routines and events stay in their database and are
+    replaced in the active one after the rename. Returns the time from dropping the first trigger of the active tables
+    to creating the last view, routine or event of the restored database, during which clients may miss some of them.
+    """
+    logging.info('Swapping active databases...')
+    connections.close(db_host, db_port, user_name, restore_database)
+    connections.close(db_host, db_port, user_name, active_database)
+
+    with connections.cursor(db_host, db_port, user_name, user_password, 'mysql') as cursor:
+        cursor.execute('CREATE DATABASE IF NOT EXISTS {} CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci;'.format(quoteIdentifier(active_database)))
+        cursor.execute('GRANT ALL PRIVILEGES ON {}.* TO \'{}\'@\'%\';'.format(quoteIdentifier(active_database), new_user))
+        cursor.execute('CREATE DATABASE {} CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci;'.format(quoteIdentifier(old_database)))
+
+        tables = {}
+        for database in (restore_database, active_database):
+            cursor.execute('SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = \'BASE TABLE\';', (database,))
+            tables[database] = [name for (name,) in cursor.fetchall()]
+
+        newTriggers = getTriggerDefinitions(cursor, restore_database)
+        dropObjects(cursor, restore_database, newTriggers)
+        newObjects = getObjectDefinitions(cursor, restore_database)
+        oldObjects = getObjectDefinitions(cursor, active_database)
+
+        renames = ['{0}.{2} TO {1}.{2}'.format(quoteIdentifier(active_database), quoteIdentifier(old_database), quoteIdentifier(name)) for name in tables[active_database]]
+        renames += ['{0}.{2} TO {1}.{2}'.format(quoteIdentifier(restore_database), quoteIdentifier(active_database), quoteIdentifier(name)) for name in tables[restore_database]]
+
+        # A rename waiting for a long transaction would block every client behind it, it gives up and is tried again instead
+        cursor.execute('SET SESSION lock_wait_timeout = {};'.format(MYSQL_SWAP_LOCK_WAIT_TIMEOUT))
+        renamed = False
+        try:
+            for attempt in range(MYSQL_SWAP_ATTEMPTS):
+                oldTriggers = getTriggerDefinitions(cursor, active_database)
+                startedAt = time.monotonic()
+                dropObjects(cursor, active_database, oldTriggers)
+                try:
+                    if renames:
+                        cursor.execute('RENAME TABLE {};'.format(', '.join(renames)))
+                    renamed = True
+                    break
+                except pymysql.err.OperationalError as error:
+                    createObjects(cursor, active_database, oldTriggers)
+                    if error.args[0] != MYSQL_LOCK_WAIT_TIMEOUT_ERROR or attempt == MYSQL_SWAP_ATTEMPTS - 1:
+                        raise
+                    logging.warning('Tables of database "{}" are locked, trying the swap again...'.format(active_database))
+            try:
+                createObjects(cursor, active_database, newTriggers)
+                dropObjects(cursor, active_database, oldObjects)
+                createObjects(cursor, active_database, newObjects)
+            except pymysql.MySQLError as error:
+                logging.error('Unable to create objects of the restored database in "{}", rolling the swap back: {}'.format(active_database, error))
+                rollBackSwap(cursor, restore_database, active_database, old_database, tables, newTriggers + newObjects, oldTriggers + oldObjects)
+                raise RestoreError('Swapping database "{}" failed and was rolled back: {}'.format(active_database, error)) from error
+            downtime = time.monotonic() - startedAt
+        except BaseException:
+            if not renamed:
+                # The restored tables stay where they are, so do their triggers
+                createObjects(cursor, restore_database, newTriggers)
+            raise
+        finally:
+            cursor.execute('SET SESSION lock_wait_timeout = DEFAULT;')
+        logging.info('Tables of database "{}" were swapped in {:.3f}s.'.format(active_database, downtime))
+
+        # Events of the old database would keep running against the old tables
+        createObjects(cursor, old_database, oldTriggers + [definition for definition in oldObjects if definition['kind'] != 'EVENT'])
+        cursor.execute('DROP DATABASE {};'.format(quoteIdentifier(restore_database)))
+
+    return downtime
 
-    return output
+@report.timed('delete_database')
+def deleteDatabase(db_host, database, db_port, user_name, user_password):
+    logging.info('Deleting database "{}"...'.format(database))
+    connections.close(db_host, db_port, user_name, database)
+    with connections.cursor(db_host, db_port, user_name, user_password, 'mysql') as cursor:
+        cursor.execute('DROP DATABASE IF EXISTS {};'.format(quoteIdentifier(database)))
 
 def main():
     args_parser = argparse.ArgumentParser(description='Postgres database management')
@@ -111,9 +1046,27 @@ def main():
                              help="Database configuration file")
     args_parser.add_argument("--action",
                              metavar="action",
-                             choices=['restore', 'delete', 'create'],
+                             choices=['restore', 'delete', 'create', 'prune', 'gc'],
                              help="Action to perform",
                              required=True)
+    args_parser.add_argument("--keep-old",
+                             metavar="keep_old",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Keep the previously active tables in <user_new>_old after --swap, for a rollback",
+                             required=False)
+    args_parser.add_argument("--checkpoint",
+                             metavar="checkpoint",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Restore a dump file in batches of tables (chunk by chunk with --parallel) and record progress in a checkpoint next to the dump",
+                             required=False)
+    args_parser.add_argument("--resume",
+                             metavar="resume",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Continue the last failed restore from its checkpoint instead of starting over, implies --checkpoint",
+                             required=False)
     args_parser.add_argument("--swap",
                              metavar="swap",
                              default=False,
@@ -126,11 +1079,194 @@ def main():
                              action=argparse.BooleanOptionalAction,
                              help="Berbose output",
                              required=False)
+    args_parser.add_argument("--stream",
+                             metavar="stream",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Pipe the dump straight into the restore without an intermediate file",
+                             required=False)
+    args_parser.add_argument("--tee",
+                             metavar="tee",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="In stream mode also write the dump to the backups directory",
+                             required=False)
+    args_parser.add_argument("--buffer-size",
+                             type=int,
+                             default=DEFAULT_BUFFER_SIZE,
+                             help="Stream buffer size in bytes",
+                             required=False)
+    args_parser.add_argument("--parallel",
+                             metavar="parallel",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Dump and load tables in chunks with parallel workers",
+                             required=False)
+    args_parser.add_argument("--jobs",
+                             type=int,
+                             default=None,
+                             help="Number of parallel workers (implies --parallel, default is CPU count)",
+                             required=False)
+    args_parser.add_argument("--fast-load",
+                             metavar="fast_load",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Restore with key checks and binary logging disabled for the session and batched commits",
+                             required=False)
+    args_parser.add_argument("--include-table",
+                             action="append",
+                             default=None,
+                             help="Restore only tables matching the pattern (can be repeated)",
+                             required=False)
+    args_parser.add_argument("--exclude-table",
+                             action="append",
+                             default=None,
+                             help="Do not restore tables matching the pattern (can be repeated)",
+                             required=False)
+    args_parser.add_argument("--schema-only",
+                             metavar="schema_only",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Restore the database definition without data",
+                             required=False)
+    args_parser.add_argument("--subset",
+                             action="append",
+                             type=parseSubsetRule,
+                             default=None,
+                             help="Copy only part of matching tables, `table=10%%` or `table=<WHERE clause>` (can be repeated)",
+                             required=False)
+    args_parser.add_argument("--compress",
+                             choices=CODECS,
+                             default=None,
+                             help="Compress the dump written to the backups directory",
+                             required=False)
+    args_parser.add_argument("--compress-level",
+                             type=int,
+                             default=None,
+                             help="Compression level (default depends on the codec)",
+                             required=False)
+    args_parser.add_argument("--compress-threads",
+                             type=int,
+                             default=None,
+                             help="Compression threads for zstd and pigz (default is CPU count)",
+                             required=False)
+    args_parser.add_argument("--store",
+                             metavar="store",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Keep the dump in the deduplicating backup store",
+                             required=False)
+    args_parser.add_argument("--keep",
+                             type=int,
+                             default=30,
+                             help="Number of backups of the database kept by the prune action",
+                             required=False)
+    args_parser.add_argument("--cache",
+                             metavar="cache",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Reuse the last dump when the source database did not change",
+                             required=False)
+    args_parser.add_argument("--force-dump",
+                             metavar="force_dump",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Dump the source database even when a cached dump is valid",
+                             required=False)
+    args_parser.add_argument("--cache-ttl",
+                             type=int,
+                             default=DEFAULT_TTL,
+                             help="Seconds after which cached dumps expire and are removed",
+                             required=False)
+    args_parser.add_argument("--cache-max-size",
+                             type=int,
+                             default=0,
+                             help="Maximum total size in bytes of cached dumps (0 means no limit)",
+                             required=False)
+    args_parser.add_argument("--batch",
+                             metavar="batch",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Run every [job:<name>] section of the configuration file as a separate job",
+                             required=False)
+    args_parser.add_argument("--batch-workers",
+                             type=int,
+                             default=4,
+                             help="Number of jobs running at once in batch mode",
+                             required=False)
+    args_parser.add_argument("--source-host-limit",
+                             type=int,
+                             default=2,
+                             help="Number of jobs running at once against one source host in batch mode",
+                             required=False)
+    args_parser.add_argument("--target-host-limit",
+                             type=int,
+                             default=2,
+                             help="Number of jobs running at once against one target host in batch mode",
+                             required=False)
+    args_parser.add_argument("--result-file",
+                             default=None,
+                             help=argparse.SUPPRESS,
+                             required=False)
+    args_parser.add_argument("--job-name",
+                             default=None,
+                             help=argparse.SUPPRESS,
+                             required=False)
+    args_parser.add_argument("--report-file",
+                             default=None,
+                             help="Write timings and throughput of the run phases as JSON to this file",
+                             required=False)
+    args_parser.add_argument("--prometheus-file",
+                             default=None,
+                             help="Write timings and throughput of the run phases as a Prometheus textfile to this file",
+                             required=False)
     args = args_parser.parse_args()
 
+    report.jsonPath = args.report_file
+    report.prometheusPath = args.prometheus_file
+
+    if args.jobs is not None:
+        args.parallel = True
+
+    if args.resume is True:
+        args.checkpoint = True
+
+    if args.stream is True and args.parallel is True:
+        args_parser.error('--stream can not be combined with --parallel/--jobs')
+
+    if args.compress is not None and (args.stream is True or args.parallel is True):
+        args_parser.error('--compress can not be combined with --stream or --parallel/--jobs')
+
+    if args.store is True and (args.stream is True or args.parallel is True or args.compress is not None):
+        args_parser.error('--store can not be combined with --stream, --parallel/--jobs or --compress')
+
+    if args.fast_load is True and (args.stream is True or args.store is True or args.compress is not None):
+        args_parser.error('--fast-load can not be combined with --stream, --store or --compress')
+
+    filters = TableFilter(includeTables=args.include_table, excludeTables=args.exclude_table, schemaOnly=args.schema_only)
+    if (not filters.isEmpty() or args.subset) and (args.parallel is True or args.stream is True or args.store is True or args.compress is not None):
+        args_parser.error('--include-table, --exclude-table, --schema-only and --subset can not be combined with --parallel/--jobs, --stream, --store or --compress')
+
+    if args.subset and args.schema_only is True:
+        args_parser.error('--subset can not be combined with --schema-only')
+
+    if args.checkpoint is True and (args.stream is True or args.store is True or args.compress is not None):
+        args_parser.error('--checkpoint and --resume need a dump file, they can not be combined with --stream, --store or --compress')
+
     config = configparser.ConfigParser()
     config.read(args.configfile)
 
+    report.labels = {'script': os.path.basename(__file__), 'action': args.action}
+
+    if args.batch is True:
+        results = runBatch(os.path.abspath(__file__), sys.argv[1:], readJobs(config), args.batch_workers, args.source_host_limit, args.target_host_limit, BACKUP_PATH)
+        for result in results:
+            report.addPhase('job:{}'.format(result['name']), result['duration'], result['status'], {'bytes': result['bytes']})
+        logging.info('Batch summary:\n{}'.format(formatSummary(results)))
+        if any(result['status'] != 'ok' for result in results):
+            exit(1)
+        return
+
     host_backup = config.get('backup', 'host')
     port_backup = int(config.get('backup', 'port'))
     db_backup = config.get('backup', 'db')
@@ -144,33 +1280,176 @@ def main():
     new_user_restore = config.get('restore', 'user_new')
     new_password_restore = config.get('restore', 'password_new')
 
+    report.labels['database'] = db_backup
+
     if args.action == 'restore':
+        # With --swap the database is restored next to the active one and swapped with it at the end
+        db_restore = '{}_restore'.format(db_backup) if args.swap is True else new_user_restore
         timestr = datetime.now().strftime('%Y%m%d-%H%M%S')
-        filename = 'backup-{}-{}.sql'.format(timestr, db_backup)
+        # Jobs of a batch restoring the same database at the same second must not share files
+        backup_name = 'backup-{}-{}'.format(timestr, db_backup) if args.job_name is None else 'backup-{}-{}-{}'.format(timestr, args.job_name, db_backup)
+        filename = '{}.sql'.format(backup_name)
         local_file_path = '{}{}'.format(BACKUP_PATH, filename)
 
-        backupMysqlDb(host_backup, db_backup, port_backup, user_backup, password_backup, filename, args.verbose)
-        createDatabseUser(host_restore, port_restore, user_restore, password_restore, new_user_restore, new_password_restore, args.verbose)
-        createDatabase(host_restore, port_restore, user_restore, password_restore, new_user_restore, new_user_restore, args.verbose)
-        # createDatabase(host_restore, port_restore, user_restore, password_restore, new_user_restore, db_restore, args.verbose)
-        restoreMysqlDb(host_restore, new_user_restore, port_restore, user_restore, password_restore, local_file_path, args.verbose)
-        # swapRestoreActive(host_restore, db_restore, db_backup, port_restore, user_restore, password_restore)
-        # swapRestoreNew(host_restore, db_restore, new_user_restore, port_restore, user_restore, password_restore)
+        dump_bytes = None
+        cache = None
+        cached_file_path = None
+        ignored_tables = []
+        subset = {}
+        checkpoint = None
+        # Units recorded in a checkpoint depend on the tables left out of the dump
+        restore_options = {
+            'include_table': args.include_table,
+            'exclude_table': args.exclude_table,
+            'schema_only': args.schema_only,
+            'subset': args.subset,
+        }
+        if args.resume is True:
+            checkpoint = findCheckpoint(BACKUP_PATH, db_backup, db_restore)
+            if checkpoint is None:
+                logging.info('No checkpoint of a restore of "{}" into "{}" found, starting over.'.format(db_backup, db_restore))
+            elif not checkpoint.matchesOptions(restore_options):
+                args_parser.error('--resume needs the table selection of the resumed restore: {}'.format(json.dumps(checkpoint.info.get('options'))))
+            else:
+                logging.info('Resuming the restore of "{}" into "{}" from "{}", {} units are done.'.format(db_backup, db_restore, checkpoint.path, len(checkpoint.completed)))
+
+        if (not filters.isEmpty() or args.subset) and checkpoint is None:
+            ignored_tables, subset = planMysqlSelection(host_backup, port_backup, user_backup, password_backup, db_backup, filters, args.subset)
+
+        # A subset depends on the rules, not only on the source state
+        if args.cache is True and args.stream is False and args.store is False and not args.subset and checkpoint is None:
+            cache = DumpCache(CACHE_PATH, args.cache_ttl, args.cache_max_size)
+            fingerprint = getDatabaseFingerprint(host_backup, port_backup, user_backup, password_backup, db_backup)
+            cache_key = 'mysql://{}:{}/{}#{}'.format(host_backup, port_backup, db_backup, 'parallel' if args.parallel else args.compress or 'sql')
+            if not filters.isEmpty():
+                cache_key += '?' + json.dumps({'ignored': ignored_tables, 'schema_only': filters.schemaOnly}, sort_keys=True)
+            if args.force_dump is False:
+                cached_file_path = cache.lookup(cache_key, fingerprint)
+
+        jobs = None
+        if args.parallel is True:
+            local_file_path = '{}{}.parallel'.format(BACKUP_PATH, backup_name)
+            jobs = args.jobs or os.cpu_count() or 1
+        elif args.compress is not None:
+            local_file_path += EXTENSIONS[args.compress]
+        if cached_file_path is not None:
+            local_file_path = cached_file_path
+        if checkpoint is not None:
+            local_file_path = checkpoint.info['dump']
+            # The resumed dump decides how it is restored
+            args.parallel = os.path.isdir(local_file_path)
+            jobs = (args.jobs or os.cpu_count() or 1) if args.parallel else None
+
+        def prepareDatabase():
+            if checkpoint is not None:
+                if checkpoint.resumed:
+                    return
+                # Nothing is recorded, the failed run may have left anything behind
+                deleteDatabase(host_restore, db_restore, port_restore, user_restore, password_restore)
+            createDatabase(host_restore, port_restore, user_restore, password_restore, new_user_restore, db_restore, args.verbose)
+
+        # Steps run as soon as the steps they come after are done, the target is provisioned while the source is dumped
+        steps = [
+            Step('create_user', lambda: createDatabseUser(host_restore, port_restore, user_restore, password_restore, new_user_restore, new_password_restore, args.verbose)),
+            Step('create_database', prepareDatabase, after=['create_user']),
+        ]
+
+        def dump():
+            if cached_file_path is not None or checkpoint is not None:
+                return
+            if args.parallel is True:
+                backupMysqlDbParallel(host_backup, db_backup, port_backup, user_backup, password_backup, local_file_path, jobs, args.verbose)
+            elif args.compress is not None:
+                backupMysqlDbCompressed(host_backup, db_backup, port_backup, user_backup, password_backup, local_file_path, args.compress, args.compress_level, args.compress_threads, args.verbose)
+            else:
+                backupMysqlDb(host_backup, db_backup, port_backup, user_backup, password_backup, local_file_path, args.verbose, ignored_tables, filters.schemaOnly, subset)
+            if cache is not None:
+                cache.record(cache_key, fingerprint, local_file_path)
+
+        if args.stream is True:
+            steps.append(Step('restore', lambda: streamMysqlDb(host_backup, db_backup, port_backup, user_backup, password_backup, host_restore, db_restore, port_restore, user_restore, password_restore, local_file_path if args.tee else None, args.buffer_size, args.verbose), after=['create_database']))
+        elif args.store is True:
+            store = BackupStore(STORE_PATH)
+            steps.append(Step('dump', lambda: backupMysqlDbToStore(host_backup, db_backup, port_backup, user_backup, password_backup, store, backup_name, args.verbose)['size']))
+            steps.append(Step('restore', lambda: restoreMysqlDbFromStore(host_restore, db_restore, port_restore, user_restore, password_restore, store, backup_name, args.verbose), after=['dump', 'create_database']))
+        else:
+            def restore():
+                # The dump is complete from here on, a failed restore can be resumed without dumping again
+                restore_checkpoint = checkpoint
+                if args.checkpoint is True and restore_checkpoint is None:
+                    restore_checkpoint = Checkpoint.create(local_file_path, db_backup, db_restore, restore_options)
+                if args.parallel is True:
+                    restoreMysqlDbParallel(host_restore, db_restore, port_restore, user_restore, password_restore, local_file_path, jobs, args.verbose, args.fast_load, restore_checkpoint)
+                elif args.compress is not None:
+                    restoreMysqlDbCompressed(host_restore, db_restore, port_restore, user_restore, password_restore, local_file_path, args.verbose)
+                elif args.fast_load is True:
+                    restoreMysqlDbFastLoad(host_restore, db_restore, port_restore, user_restore, password_restore, local_file_path, args.verbose, restore_checkpoint)
+                else:
+                    restoreMysqlDb(host_restore, db_restore, port_restore, user_restore, password_restore, local_file_path, args.verbose, restore_checkpoint)
+
+            steps.append(Step('dump', dump))
+            steps.append(Step('restore', restore, after=['dump', 'create_database']))
+
         # fixDatabaseOwner(host_restore, port_restore, user_restore, password_restore, new_user_restore)
+
+        if args.swap is True:
+            db_old = '{}_old'.format(new_user_restore)
+            # Old tables kept by the previous run
+            steps.append(Step('delete_old', lambda: deleteDatabase(host_restore, db_old, port_restore, user_restore, password_restore), after=['restore']))
+            steps.append(Step('swap', lambda: swapRestoreActive(host_restore, db_restore, new_user_restore, db_old, port_restore, user_restore, password_restore, new_user_restore), after=['restore', 'delete_old']))
+            if args.keep_old is False:
+                steps.append(Step('drop_old', lambda: deleteDatabase(host_restore, db_old, port_restore, user_restore, password_restore), after=['swap']))
+
+        try:
+            results = runGraph(steps)
+        except BaseException:
+            if os.path.exists(checkpointPath(local_file_path)):
+                logging.error('Progress of the restore is kept in "{}", run again with --resume to continue it.'.format(checkpointPath(local_file_path)))
+            raise
+
+        if os.path.exists(checkpointPath(local_file_path)):
+            os.remove(checkpointPath(local_file_path))
+
+        # Stream and store runs know how much they copied
+        if args.stream is True:
+            dump_bytes = results['restore']
+        elif args.store is True:
+            dump_bytes = results['dump']
+        if dump_bytes is None:
+            dump_bytes = pathSize(local_file_path)
+
+        if args.result_file is not None:
+            with open(args.result_file, 'w') as file:
+                json.dump({'bytes': dump_bytes}, file)
+
+        if cache is not None:
+            cache.evict(local_file_path)
+    elif args.action == 'prune':
+        store = BackupStore(STORE_PATH)
+        store.prune(db_backup, args.keep)
+        store.gc()
+    elif args.action == 'gc':
+        BackupStore(STORE_PATH).gc()
     elif args.action == 'create':
         createDatabseUser(host_restore, port_restore, user_restore, password_restore, new_user_restore, new_password_restore, args.verbose)
         createDatabase(host_restore, port_restore, user_restore, password_restore, new_user_restore, new_user_restore, args.verbose)
 
 if __name__ == '__main__':
+    succeeded = False
     try:
         startedAt = datetime.now()
         initLoggers()
         logging.info('Started at %s', startedAt.strftime('%Y-%m-%d %H:%M:%S'))
         main()
+        succeeded = True
     except Exception as exception:
         logging.exception(exception)
         raise exception
     finally:
+        connections.closeAll()
+        connections.logTimings()
+        report.addConnections(connections)
+        report.write(succeeded)
         endedAt = datetime.now()
         logging.info('Ended at %s', endedAt.strftime('%Y-%m-%d %H:%M:%S'))
         logging.info('Total time: %s', endedAt - startedAt)
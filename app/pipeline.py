@@ -0,0 +1,240 @@
+import asyncio
+import fcntl
+import logging
+import os
+import subprocess
+import threading
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+CANCEL_POLL_INTERVAL = 0.2
+STOP_TIMEOUT = 10
+LOG_LINE_LIMIT = 4096
+
+# Set when a run is being cancelled, processes started by runProcess are stopped
+cancelled = threading.Event()
+
+# F_SETPIPE_SZ is exposed by the fcntl module since Python 3.10, 1031 is the Linux value
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+class PipelineError(Exception):
+    pass
+
+def resizePipe(fileObject, size: int) -> None:
+    """
+    Try to grow the kernel pipe buffer. Not every platform supports it, so failures are ignored.
+    """
+    try:
+        fcntl.fcntl(fileObject.fileno(), F_SETPIPE_SZ, size)
+    except OSError as error:
+        logging.debug('Unable to resize pipe to {} bytes: {}'.format(size, error))
+
+def stopProcess(process: subprocess.Popen) -> None:
+    """
+    Kill the process if it is still running and reap it.
+    """
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+
+def pipeProcesses(producerArgs: list, consumerArgs: list, producerEnv: dict = None, consumerEnv: dict = None, teeFile: str = None, bufferSize: int = DEFAULT_BUFFER_SIZE, consumerStdout=None) -> int:
+    """
+    Stream stdout of the producer process into stdin of the consumer process, optionally copying it to a file.
+
+    Writes to the consumer block when its pipe is full, so a slow consumer throttles the producer.
+    If either side fails the other one is killed and PipelineError is raised.
+    Returns number of bytes transferred.
+    """
+    producer = subprocess.Popen(producerArgs, stdout=subprocess.PIPE, env=producerEnv, bufsize=bufferSize)
+    try:
+        consumer = subprocess.Popen(consumerArgs, stdin=subprocess.PIPE, stdout=consumerStdout, env=consumerEnv, bufsize=bufferSize)
+    except Exception:
+        stopProcess(producer)
+        raise
+
+    resizePipe(producer.stdout, bufferSize)
+    resizePipe(consumer.stdin, bufferSize)
+
+    tee = open(teeFile, 'wb') if teeFile else None
+    buffer = bytearray(bufferSize)
+    view = memoryview(buffer)
+    transferred = 0
+
+    try:
+        while True:
+            size = producer.stdout.readinto1(view)
+            if not size:
+                break
+
+            try:
+                consumer.stdin.write(view[:size])
+            except BrokenPipeError:
+                stopProcess(producer)
+                consumer.wait()
+                raise PipelineError('Consumer "{}" exited early. Return code : {}'.format(consumerArgs[0], consumer.returncode))
+
+            if tee is not None:
+                tee.write(view[:size])
+            transferred += size
+
+        producer.wait()
+        if producer.returncode != 0:
+            # Do not let the consumer commit a truncated stream
+            stopProcess(consumer)
+            raise PipelineError('Producer "{}" failed. Return code : {}'.format(producerArgs[0], producer.returncode))
+
+        try:
+            consumer.stdin.close()
+        except BrokenPipeError:
+            pass
+        consumer.wait()
+        if consumer.returncode != 0:
+            raise PipelineError('Consumer "{}" failed. Return code : {}'.format(consumerArgs[0], consumer.returncode))
+    except BaseException:
+        stopProcess(producer)
+        stopProcess(consumer)
+        raise
+    finally:
+        if tee is not None:
+            tee.close()
+
+    logging.info('Streamed {} bytes from "{}" to "{}".'.format(transferred, producerArgs[0], consumerArgs[0]))
+
+    return transferred
+
+def readProcess(producerArgs: list, sink, producerEnv: dict = None, bufferSize: int = DEFAULT_BUFFER_SIZE) -> int:
+    """
+    Run the producer and pass its stdout to sink block by block.
+    The block is a view into a reused buffer, the sink has to copy what it keeps.
+    Returns number of bytes read.
+    """
+    producer = subprocess.Popen(producerArgs, stdout=subprocess.PIPE, env=producerEnv, bufsize=bufferSize)
+    resizePipe(producer.stdout, bufferSize)
+
+    buffer = bytearray(bufferSize)
+    view = memoryview(buffer)
+    transferred = 0
+
+    try:
+        while True:
+            size = producer.stdout.readinto1(view)
+            if not size:
+                break
+            sink(view[:size])
+            transferred += size
+
+        producer.wait()
+        if producer.returncode != 0:
+            raise PipelineError('Producer "{}" failed. Return code : {}'.format(producerArgs[0], producer.returncode))
+    except BaseException:
+        stopProcess(producer)
+        raise
+
+    return transferred
+
+def feedProcess(consumerArgs: list, blocks, consumerEnv: dict = None, bufferSize: int = DEFAULT_BUFFER_SIZE) -> int:
+    """
+    Write blocks from an iterable into stdin of the consumer.
+    Returns number of bytes written.
+    """
+    consumer = subprocess.Popen(consumerArgs, stdin=subprocess.PIPE, env=consumerEnv, bufsize=bufferSize)
+    resizePipe(consumer.stdin, bufferSize)
+    transferred = 0
+
+    try:
+        for block in blocks:
+            try:
+                consumer.stdin.write(block)
+            except BrokenPipeError:
+                consumer.wait()
+                raise PipelineError('Consumer "{}" exited early. Return code : {}'.format(consumerArgs[0], consumer.returncode))
+            transferred += len(block)
+
+        try:
+            consumer.stdin.close()
+        except BrokenPipeError:
+            pass
+        consumer.wait()
+        if consumer.returncode != 0:
+            raise PipelineError('Consumer "{}" failed. Return code : {}'.format(consumerArgs[0], consumer.returncode))
+    except BaseException:
+        stopProcess(consumer)
+        raise
+
+    return transferred
+
+async def stopProcessAsync(process: asyncio.subprocess.Process) -> None:
+    """
+    Ask the process to terminate, kill it if it does not within STOP_TIMEOUT, and reap it.
+    """
+    if process.returncode is None:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+    await process.wait()
+
+async def runProcessAsync(args: list, env: dict = None, stdin=None, stdout=None) -> int:
+    """
+    Run a process and log its output line by line while it runs, instead of collecting it until it exits.
+    stdout is logged too unless it is redirected to a file. Lines longer than LOG_LINE_LIMIT are cut short in the log.
+
+    The process is stopped when the task is cancelled or `cancelled` is set, PipelineError is raised in the latter case.
+    Returns the return code.
+    """
+    name = os.path.basename(args[0])
+    process = await asyncio.create_subprocess_exec(*args, stdin=stdin, stdout=asyncio.subprocess.PIPE if stdout is None else stdout, stderr=asyncio.subprocess.PIPE, env=env)
+
+    def log(line):
+        text = line[:LOG_LINE_LIMIT].decode(errors='replace').rstrip()
+        logging.info('[{}] {}{}'.format(name, text, ' ...' if len(line) > LOG_LINE_LIMIT else ''))
+
+    async def forward(stream):
+        # Read in blocks, a line may be any length (a long statement echoed by a client)
+        pending = b''
+        skipping = False
+        while True:
+            block = await stream.read(DEFAULT_BUFFER_SIZE)
+            if not block:
+                break
+            *lines, pending = (pending + block).split(b'\n')
+            for line in lines:
+                if skipping:
+                    skipping = False
+                    continue
+                log(line)
+            if len(pending) > LOG_LINE_LIMIT:
+                if not skipping:
+                    log(pending)
+                    skipping = True
+                pending = b''
+        if pending and not skipping:
+            log(pending)
+
+    async def watch():
+        while not cancelled.is_set():
+            await asyncio.sleep(CANCEL_POLL_INTERVAL)
+
+    streams = [process.stderr] if stdout is not None else [process.stdout, process.stderr]
+    finished = asyncio.ensure_future(asyncio.gather(*(forward(stream) for stream in streams), process.wait()))
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await asyncio.wait((finished, watcher), return_when=asyncio.FIRST_COMPLETED)
+        if not finished.done():
+            raise PipelineError('Process "{}" was cancelled.'.format(name))
+        finished.result()
+    except BaseException:
+        finished.cancel()
+        await stopProcessAsync(process)
+        await asyncio.gather(finished, return_exceptions=True)
+        raise
+    finally:
+        watcher.cancel()
+
+    return process.returncode
+
+def runProcess(args: list, env: dict = None, stdin=None, stdout=None) -> int:
+    """
+    Blocking runProcessAsync, for code running in a worker thread or outside of an event loop.
+    """
+    return asyncio.run(runProcessAsync(args, env, stdin, stdout))
@@ -4,15 +4,145 @@
 
 import os
 import argparse
+import asyncio
+import concurrent.futures
 import configparser
+import itertools
+import json
 import logging
+import re
 import subprocess
+import tempfile
+import threading
+import time
 
 import psycopg2
+from psycopg2 import errorcodes, sql
 import sys
 from datetime import datetime
 
+from batch import formatSummary, readJobs, runBatch
+from checkpoint import Checkpoint, RestoreError, checkpointPath, findCheckpoint
+from compression import CODECS, EXTENSIONS, compressProcessOutput, decompressIntoProcess
+from connections import ConnectionManager
+from dumpcache import DEFAULT_TTL, DumpCache, pathSize
+from metrics import RunReport, fileSizeSampler
+from graph import Step, runGraph
+from pipeline import DEFAULT_BUFFER_SIZE, pipeProcesses, resizePipe, runProcess, runProcessAsync
+from selection import SAMPLE_BUCKETS, TableFilter, parseSubsetRule, planSubset
+from store import BackupStore
+
 BACKUP_PATH = './backups/'
+STORE_PATH = BACKUP_PATH + 'store/'
+CACHE_PATH = BACKUP_PATH + 'cache.json'
+PARALLEL_TABLE_MIN_SIZE = 64 * 1024 * 1024
+FAST_LOAD_MAINTENANCE_WORK_MEM = '1GB'
+CLONE_STRATEGIES = ('auto', 'file_copy', 'wal_log')
+CLONE_FILE_COPY_MIN_SIZE = 1024 * 1024 * 1024
+SWAP_ATTEMPTS = 5
+SWAP_RETRY_DELAY = 0.2
+FAST_LOAD_SETTINGS = ('synchronous_commit', 'maintenance_work_mem')
+RESTORE_BATCH_ENTRIES = 100
+
+# `pg_restore -l` entry: dump id, catalog table oid, object oid, then type, schema, name and owner separated by spaces
+TOC_ENTRY = re.compile(r'^(\d+); \d+ \d+ (.*)$')
+TOC_DEPENDENCIES = re.compile(r'^;\s+depends on:((?: \d+)*)$')
+# Types made of more than one word, the first word of any other entry is its type
+TOC_MULTI_WORD_TYPES = sorted([
+    'TABLE DATA', 'TABLE ATTACH', 'INDEX ATTACH', 'SEQUENCE SET', 'SEQUENCE OWNED BY', 'MATERIALIZED VIEW', 'MATERIALIZED VIEW DATA',
+    'FOREIGN TABLE', 'FOREIGN DATA WRAPPER', 'FK CONSTRAINT', 'CHECK CONSTRAINT', 'DEFAULT ACL', 'ACCESS METHOD', 'OPERATOR CLASS',
+    'OPERATOR FAMILY', 'TEXT SEARCH CONFIGURATION', 'TEXT SEARCH DICTIONARY', 'TEXT SEARCH PARSER', 'TEXT SEARCH TEMPLATE',
+    'USER MAPPING', 'EVENT TRIGGER', 'ROW SECURITY', 'SECURITY LABEL', 'PUBLICATION TABLE', 'PUBLICATION TABLES IN SCHEMA',
+    'LARGE OBJECT', 'LARGE OBJECTS', 'BLOB DATA', 'BLOB METADATA', 'DATABASE PROPERTIES', 'SHELL TYPE', 'PROCEDURAL LANGUAGE',
+], key=len, reverse=True)
+TOC_RELATION_TYPES = ('TABLE', 'TABLE DATA', 'VIEW', 'MATERIALIZED VIEW', 'MATERIALIZED VIEW DATA', 'SEQUENCE', 'SEQUENCE SET', 'SEQUENCE OWNED BY', 'FOREIGN TABLE')
+TOC_DATA_TYPES = ('TABLE DATA', 'SEQUENCE SET', 'MATERIALIZED VIEW DATA', 'BLOBS', 'BLOB DATA', 'LARGE OBJECTS')
+
+# Server-side loop executing ALTER ... OWNER statements produced by a query, the new owner is read from a session setting
+OWNER_FIX_BLOCK = '''
+DO $$
+DECLARE
+    target name := current_setting('database_manager.owner');
+    target_oid oid := (SELECT oid FROM pg_roles WHERE rolname = target);
+    statement text;
+    changed bigint := 0;
+BEGIN
+    FOR statement IN {} LOOP
+        EXECUTE statement;
+        changed := changed + 1;
+    END LOOP;
+    RAISE NOTICE 'owner_fix_changed=%', changed;
+END
+$$;
+'''
+
+OWNER_FIX_SYSTEM_SCHEMAS = "n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg\\_toast%' AND n.nspname NOT LIKE 'pg\\_temp%'"
+
+# Objects that belong to an extension are left alone
+OWNER_FIX_NOT_EXTENSION = "NOT EXISTS (SELECT 1 FROM pg_depend d WHERE d.classid = '{}'::regclass AND d.objid = {} AND d.deptype = 'e')"
+
+OWNER_FIX_BATCHES = [
+    ('schemas', '''
+        SELECT format('ALTER SCHEMA %I OWNER TO %I', n.nspname, target)
+        FROM pg_namespace n
+        WHERE {} AND n.nspowner <> target_oid AND {}
+    '''.format(OWNER_FIX_SYSTEM_SCHEMAS, OWNER_FIX_NOT_EXTENSION.format('pg_namespace', 'n.oid'))),
+    # Sequences owned by a column follow their table and can not be changed on their own
+    ('tables, views and sequences', '''
+        SELECT format('ALTER %s %s OWNER TO %I',
+            CASE c.relkind WHEN 'S' THEN 'SEQUENCE' WHEN 'v' THEN 'VIEW' WHEN 'm' THEN 'MATERIALIZED VIEW' WHEN 'f' THEN 'FOREIGN TABLE' ELSE 'TABLE' END,
+            c.oid::regclass, target)
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p', 'v', 'm', 'S', 'f') AND {} AND c.relowner <> target_oid AND {}
+            AND NOT (c.relkind = 'S' AND EXISTS (SELECT 1 FROM pg_depend d WHERE d.classid = 'pg_class'::regclass AND d.objid = c.oid AND d.refclassid = 'pg_class'::regclass AND d.deptype IN ('a', 'i')))
+    '''.format(OWNER_FIX_SYSTEM_SCHEMAS, OWNER_FIX_NOT_EXTENSION.format('pg_class', 'c.oid'))),
+    ('functions and procedures', '''
+        SELECT format('ALTER ROUTINE %s OWNER TO %I', p.oid::regprocedure, target)
+        FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace
+        WHERE {} AND p.proowner <> target_oid AND {}
+    '''.format(OWNER_FIX_SYSTEM_SCHEMAS, OWNER_FIX_NOT_EXTENSION.format('pg_proc', 'p.oid'))),
+    # Row types of tables, array types and multirange types follow their base object
+    ('types and domains', '''
+        SELECT format('ALTER %s %s OWNER TO %I', CASE t.typtype WHEN 'd' THEN 'DOMAIN' ELSE 'TYPE' END, t.oid::regtype, target)
+        FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace
+        WHERE {} AND t.typowner <> target_oid AND {}
+            AND (t.typrelid = 0 OR (SELECT c.relkind FROM pg_class c WHERE c.oid = t.typrelid) = 'c')
+            AND NOT EXISTS (SELECT 1 FROM pg_type e WHERE e.oid = t.typelem AND e.typarray = t.oid)
+            AND t.typtype <> 'm'
+    '''.format(OWNER_FIX_SYSTEM_SCHEMAS, OWNER_FIX_NOT_EXTENSION.format('pg_type', 't.oid'))),
+]
+
+def openConnection(host: str, port: int, user: str, password: str, dbname: str):
+    connection = psycopg2.connect(host=host, port=port, user=user, password=password, dbname=dbname)
+    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+    return connection
+
+report = RunReport()
+connections = ConnectionManager(openConnection, lambda connection: connection.closed != 0)
+
+class DatabaseWriteSampler:
+    """
+    Sample rows inserted into the database and its size, to follow a restore running in pg_restore.
+    Uses its own connection, the shared ones are not meant to be used from the sampling thread.
+    """
+
+    def __init__(self, host: str, port: int, user: str, password: str, databaseName: str):
+        self._arguments = (host, port, user, password, databaseName)
+        self._connection = None
+
+    def __call__(self) -> dict:
+        if self._connection is None:
+            self._connection = openConnection(*self._arguments)
+        with self._connection.cursor() as cursor:
+            cursor.execute('SELECT tup_inserted, pg_database_size(datname) FROM pg_stat_database WHERE datname = current_database();')
+            rows, size = cursor.fetchone()
+
+        return {'rows': rows, 'bytes': size}
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
 
 def initLoggers() -> None:
     # STDOUT logger
@@ -27,173 +157,953 @@ def initLoggers() -> None:
     root.addHandler(stdoutHandler)
 
 
+@report.timed('create_user')
 def createDatabseUser(host: str, port: int, user: str, password: str, newUser: str, newUserPassword: str, verbose: bool):
     """
     Create a new database user.
     """
     logging.info('Creating user "{}"...'.format(newUser))
-    connection = psycopg2.connect(host=host, port=port, user=user, password=password, dbname='postgres')
-    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-    with connection.cursor() as cursor:
+    with connections.cursor(host, port, user, password, 'postgres') as cursor:
+        # Refreshing a database with --swap keeps the user of the active one
+        cursor.execute('SELECT 1 FROM pg_roles WHERE rolname = %s;', (newUser,))
+        if cursor.fetchone() is not None:
+            logging.info('User "{}" already exists.'.format(newUser))
+            return
         cursor.execute('CREATE USER "{}" WITH PASSWORD \'{}\';'.format(newUser, newUserPassword))
 
+@report.timed('create_database')
 def createDatabase(host: str, port: int, user: str, password: str, newUser: str, databaseName: str, verbose: bool):
     """
     Create a new database.
     """
     logging.info('Creating database "{}"...'.format(databaseName))
-    connection = psycopg2.connect(host=host, port=port, user=user, password=password, dbname='postgres')
-    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-    with connection.cursor() as cursor:
+    with connections.cursor(host, port, user, password, 'postgres') as cursor:
         cursor.execute('CREATE DATABASE "{}";'.format(databaseName))
         cursor.execute('REVOKE CONNECT ON DATABASE "{}" FROM PUBLIC;'.format(databaseName))
         cursor.execute('GRANT ALL PRIVILEGES ON DATABASE "{}" TO "{}";'.format(databaseName, newUser))
 
-def backupPostgresDb(host: str, database_name: str, port: int, user: str, password: str, dest_file: str, verbose: bool) -> bytes:
+@report.timed('clone', result=lambda size: {'bytes': size})
+def cloneDatabase(host: str, port: int, user: str, password: str, newUser: str, sourceDatabase: str, databaseName: str, strategy: str, verbose: bool) -> int:
+    """
+    Create a new database as a copy of a database on the same server, without dumping it.
+
+    The source can not have other sessions while it is copied, so new connections to it are refused and existing ones
+    are terminated for the duration of the copy. WAL_LOG copies through the WAL and suits small databases, FILE_COPY
+    copies the files and checkpoints, which is faster for big ones. Servers before 15 always copy files.
+    """
+    connections.close(host, port, user, sourceDatabase)
+    with connections.cursor(host, port, user, password, 'postgres') as cursor:
+        cursor.execute('SELECT current_setting(\'server_version_num\')::int, pg_database_size(datname), datallowconn FROM pg_database WHERE datname = %s;', (sourceDatabase,))
+        version, size, allowConnections = cursor.fetchone()
+
+        clause = ''
+        if version >= 150000:
+            if strategy == 'auto':
+                strategy = 'file_copy' if size >= CLONE_FILE_COPY_MIN_SIZE else 'wal_log'
+            clause = ' STRATEGY = {}'.format(strategy.upper())
+        logging.info('Cloning database "{}" ({} bytes) into "{}"{}...'.format(sourceDatabase, size, databaseName, clause))
+
+        startedAt = time.monotonic()
+        cursor.execute('ALTER DATABASE "{}" ALLOW_CONNECTIONS false;'.format(sourceDatabase))
+        try:
+            cursor.execute('SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity WHERE pid <> pg_backend_pid() AND datname = %s;', (sourceDatabase,))
+            terminated = cursor.fetchone()[0]
+            if verbose:
+                logging.info('Terminated {} sessions of database "{}".'.format(terminated, sourceDatabase))
+            cursor.execute('CREATE DATABASE "{}" TEMPLATE "{}"{};'.format(databaseName, sourceDatabase, clause))
+        finally:
+            if allowConnections:
+                cursor.execute('ALTER DATABASE "{}" ALLOW_CONNECTIONS true;'.format(sourceDatabase))
+            logging.info('Database "{}" refused connections for {:.3f}s.'.format(sourceDatabase, time.monotonic() - startedAt))
+
+        cursor.execute('REVOKE CONNECT ON DATABASE "{}" FROM PUBLIC;'.format(databaseName))
+        cursor.execute('GRANT ALL PRIVILEGES ON DATABASE "{}" TO "{}";'.format(databaseName, newUser))
+
+    return size
+
+def getDatabaseStats(host: str, port: int, user: str, password: str, databaseName: str) -> tuple:
+    """
+    Get number of user tables and their total size.
+    """
+    with connections.cursor(host, port, user, password, databaseName) as cursor:
+        cursor.execute(
+            'SELECT count(*), coalesce(sum(pg_total_relation_size(c.oid)), 0) '
+            'FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace '
+            'WHERE c.relkind IN (\'r\', \'m\') AND n.nspname NOT IN (\'pg_catalog\', \'information_schema\') AND n.nspname NOT LIKE \'pg_toast%\';'
+        )
+        return cursor.fetchone()
+
+def defaultJobCount(host: str, port: int, user: str, password: str, databaseName: str) -> int:
+    """
+    Pick number of pg_dump/pg_restore workers from CPU count and number and total size of source tables.
+
+    Workers split the work per table, so there is no point in running more of them than there are tables,
+    nor more than there are PARALLEL_TABLE_MIN_SIZE parts of the database to keep a worker busy.
+    """
+    tableCount, totalSize = getDatabaseStats(host, port, user, password, databaseName)
+    jobs = max(1, min(os.cpu_count() or 1, tableCount, max(1, totalSize // PARALLEL_TABLE_MIN_SIZE)))
+    logging.info('Database "{}" has {} tables ({} bytes), using {} jobs.'.format(databaseName, tableCount, totalSize, jobs))
+
+    return jobs
+
+def getDatabaseFingerprint(host: str, port: int, user: str, password: str, databaseName: str) -> dict:
+    """
+    Get a cheap fingerprint of the database state: WAL position of the cluster and write counters of the database.
+    Any write anywhere in the cluster moves the WAL position, so an unchanged fingerprint means unchanged data.
+    """
+    try:
+        with connections.cursor(host, port, user, password, databaseName) as cursor:
+            cursor.execute(
+                'SELECT (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END)::text, '
+                'tup_inserted, tup_updated, tup_deleted, stats_reset::text '
+                'FROM pg_stat_database WHERE datname = current_database();'
+            )
+            lsn, inserted, updated, deleted, statsReset = cursor.fetchone()
+    except psycopg2.Error as error:
+        logging.warning('Unable to fingerprint database "{}", dump cache disabled: {}'.format(databaseName, error))
+        return None
+
+    return {
+        'lsn': lsn,
+        'inserted': inserted,
+        'updated': updated,
+        'deleted': deleted,
+        'stats_reset': statsReset,
+    }
+
+def planPostgresSubset(host: str, port: int, user: str, password: str, databaseName: str, rules: list, filters: TableFilter) -> list:
+    """
+    Get tables of the database copied only partially, with the columns to copy and the row condition.
+    Percentages are sampled by a hash of the primary key (of all columns without one), so they are repeatable.
+    """
+    with connections.cursor(host, port, user, password, databaseName) as cursor:
+        cursor.execute('''
+            SELECT format('%I.%I', n.nspname, c.relname), n.nspname, c.relname,
+                ARRAY(SELECT quote_ident(a.attname) FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = '' ORDER BY a.attnum),
+                ARRAY(SELECT quote_ident(a.attname) FROM pg_index i CROSS JOIN unnest(i.indkey::int2[]) WITH ORDINALITY k(attnum, position) JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum WHERE i.indrelid = c.oid AND i.indisprimary ORDER BY k.position)
+            FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind = 'r' AND {};
+        '''.format(OWNER_FIX_SYSTEM_SCHEMAS))
+        tables = {}
+        for key, schema, name, columns, primaryKey in cursor.fetchall():
+            if filters.tableIncluded(schema, name):
+                tables[key] = {'schema': schema, 'name': name, 'sql': key, 'columns': columns, 'keyColumns': primaryKey or columns}
+
+        cursor.execute('''
+            SELECT format('%I.%I', cn.nspname, c.relname), format('%I.%I', pn.nspname, p.relname),
+                ARRAY(SELECT quote_ident(a.attname) FROM unnest(con.conkey) WITH ORDINALITY k(attnum, position) JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum ORDER BY k.position),
+                ARRAY(SELECT quote_ident(a.attname) FROM unnest(con.confkey) WITH ORDINALITY k(attnum, position) JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.attnum ORDER BY k.position)
+            FROM pg_constraint con
+            JOIN pg_class c ON c.oid = con.conrelid JOIN pg_namespace cn ON cn.oid = c.relnamespace
+            JOIN pg_class p ON p.oid = con.confrelid JOIN pg_namespace pn ON pn.oid = p.relnamespace
+            WHERE con.contype = 'f';
+        ''')
+        foreignKeys = [{'table': table, 'parent': parent, 'columns': columns, 'parentColumns': parentColumns} for table, parent, columns, parentColumns in cursor.fetchall()]
+
+    def sample(table, buckets):
+        return '(hashtext(concat_ws(\'|\', {})) & 2147483647) % {} < {}'.format(', '.join(table['keyColumns']), SAMPLE_BUCKETS, buckets)
+
+    subset = []
+    for key, condition in planSubset(tables, foreignKeys, rules, sample).items():
+        table = tables[key]
+        subset.append({'schema': table['schema'], 'name': table['name'], 'sql': key, 'columns': table['columns'], 'condition': condition})
+        logging.info('Subset of {}: {}'.format(key, condition))
+
+    return subset
+
+def dumpPostgresSubset(connection, subset: list, destDir: str) -> dict:
+    """
+    Copy rows of partially copied tables to files, in the transaction open on the connection.
+    """
+    os.makedirs(destDir, exist_ok=True)
+    manifest = {'tables': []}
+    with connection.cursor() as cursor:
+        for index, table in enumerate(subset):
+            filename = '{:06d}.copy'.format(index)
+            path = os.path.join(destDir, filename)
+            with open(path, 'wb') as file:
+                cursor.copy_expert('COPY (SELECT {} FROM {} WHERE {}) TO STDOUT;'.format(', '.join(table['columns']), table['sql'], table['condition']), file)
+            manifest['tables'].append(dict(table, file=filename))
+            logging.info('Copied subset of {} ({} bytes).'.format(table['sql'], os.path.getsize(path)))
+
+    with open(os.path.join(destDir, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file)
+
+    return manifest
+
+def readToc(backup_file: str, options: list = None) -> tuple:
+    """
+    Read the table of contents of a dump with `pg_restore -l`.
+    Returns its lines and its entries with their dump id, type, schema, tag, line and (with `-v`) ids of entries they depend on.
+    """
+    process = subprocess.run(['pg_restore', '-l'] + (options or []) + [backup_file], stdout=subprocess.PIPE, check=True)
+    lines = process.stdout.decode('utf-8', errors='surrogateescape').splitlines()
+
+    entries = []
+    for line in lines:
+        entry = TOC_ENTRY.match(line)
+        if entry is None:
+            depends = TOC_DEPENDENCIES.match(line)
+            if depends is not None and entries:
+                entries[-1]['dependencies'] = set(depends.group(1).split())
+            continue
+
+        entryId, rest = entry.groups()
+        entryType = next((candidate for candidate in TOC_MULTI_WORD_TYPES if rest.startswith(candidate + ' ')), rest.split(' ', 1)[0])
+        schema, _, tagAndOwner = rest[len(entryType) + 1:].partition(' ')
+        entries.append({'id': entryId, 'type': entryType, 'schema': schema, 'tag': tagAndOwner.rsplit(' ', 1)[0], 'line': line, 'dependencies': set()})
+
+    return lines, entries
+
+def writeRestoreList(backup_file: str, filters: TableFilter, list_file: str) -> int:
+    """
+    Write the table of contents of a dump for `pg_restore -L` with the entries left out by the filters commented out.
+    Entries depending on a left out entry (indexes, constraints, views, comments...) are left out as well.
+    """
+    lines, entries = readToc(backup_file, ['-v'])
+
+    dropped = set()
+    dependencies = {}
+    for entry in entries:
+        dependencies[entry['id']] = entry['dependencies']
+        entryType, schema, tag = entry['type'], entry['schema'], entry['tag']
+
+        if entryType == 'SCHEMA':
+            included = filters.schemaIncluded(tag)
+        elif schema == '-':
+            included = True
+        elif entryType in TOC_RELATION_TYPES:
+            included = filters.tableIncluded(schema, tag)
+        else:
+            included = filters.schemaIncluded(schema)
+
+        if not included or (filters.schemaOnly and entryType in TOC_DATA_TYPES):
+            dropped.add(entry['id'])
+
+    changed = True
+    while changed:
+        changed = False
+        for entryId, depends in dependencies.items():
+            if entryId not in dropped and depends & dropped:
+                dropped.add(entryId)
+                changed = True
+
+    with open(list_file, 'w', encoding='utf-8', errors='surrogateescape') as file:
+        for line in lines:
+            entry = TOC_ENTRY.match(line)
+            if entry is not None and entry.group(1) in dropped:
+                line = ';' + line
+            file.write(line + '\n')
+
+    logging.info('Left out {} entries of "{}", restore list written to "{}".'.format(len(dropped), backup_file, list_file))
+
+    return len(dropped)
+
+@report.timed('dump', sampler=lambda arguments: fileSizeSampler(arguments['dest_file']))
+def backupPostgresDb(host: str, database_name: str, port: int, user: str, password: str, dest_file: str, verbose: bool, jobs: int = None, subset: list = None) -> None:
     """
     Backup postgres database to a file.
+    With jobs the backup is written by parallel workers to a directory format dump.
+    Rows of subset tables are copied by their condition to `<dest_file>.subset` instead, in the snapshot of the dump.
     """
 
     logging.info('Backing up database "{}"...'.format(database_name))
-    os.environ["PGPASSWORD"] = password
 
-    if verbose:
-        args = [
-            'pg_dump',
-            f'--dbname={database_name}',
-            f'--host={host}',
-            f'--port={port}',
-            f'--username={user}',
-            '-Fc',
-            '-f', dest_file,
-            '-v'
-        ]
+    args = [
+        'pg_dump',
+        f'--dbname={database_name}',
+        f'--host={host}',
+        f'--port={port}',
+        f'--username={user}',
+    ]
+
+    if jobs:
+        args.extend(['-Fd', '-j', str(jobs)])
     else:
-        args = [
-            'pg_dump',
-            f'--dbname={database_name}',
-            f'--host={host}',
-            f'--port={port}',
-            f'--username={user}',
-            '-Fc',
-            '-f', dest_file
-        ]
+        args.append('-Fc')
 
-    process = subprocess.Popen(args, stdout=subprocess.PIPE)
-    output = process.communicate()[0]
-    os.environ["PGPASSWORD"] = ""
+    args.extend(['-f', dest_file])
 
-    if int(process.returncode) != 0:
-        print('Command failed. Return code : {}'.format(process.returncode))
-        exit(1)
+    if verbose:
+        args.append('-v')
+
+    snapshotConnection = None
+    if subset:
+        snapshotConnection = openConnection(host, port, user, password, database_name)
+        with snapshotConnection.cursor() as cursor:
+            cursor.execute('BEGIN ISOLATION LEVEL REPEATABLE READ, READ ONLY;')
+            cursor.execute('SELECT pg_export_snapshot();')
+            args.append('--snapshot={}'.format(cursor.fetchone()[0]))
+        args.extend('--exclude-table-data={}'.format(table['sql']) for table in subset)
+
+    async def dump():
+        process = asyncio.ensure_future(runProcessAsync(args, dict(os.environ, PGPASSWORD=password)))
+        try:
+            # The subset is copied while pg_dump runs, both read the same snapshot
+            if subset:
+                await asyncio.to_thread(dumpPostgresSubset, snapshotConnection, subset, '{}.subset'.format(dest_file))
+            return await process
+        except BaseException:
+            process.cancel()
+            await asyncio.gather(process, return_exceptions=True)
+            raise
 
-    return output
+    try:
+        returncode = asyncio.run(dump())
+    finally:
+        if snapshotConnection is not None:
+            snapshotConnection.close()
+
+    if int(returncode) != 0:
+        print('Command failed. Return code : {}'.format(returncode))
+        exit(1)
 
-def restorePostgresDb(db_host, db, port, user, password, backup_file, verbose):
+@report.timed('restore', sampler=lambda arguments: DatabaseWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restorePostgresDb(db_host, db, port, user, password, backup_file, verbose, jobs=None, list_file=None):
     """
     Restore postgres db from a file.
+    Directory format dumps can be restored by parallel workers.
+    A list file written by writeRestoreList restores only the entries it selects.
     """
 
     logging.info('Restoring database "{}"...'.format(db))
-    os.environ["PGPASSWORD"] = password
+
+    args = [
+        'pg_restore',
+        '--no-owner',
+        f'--dbname={db}',
+        f'--host={db_host}',
+        f'--port={port}',
+        f'--username={user}',
+    ]
+
+    if jobs:
+        args.extend(['-j', str(jobs)])
+
+    if list_file:
+        args.append(f'--use-list={list_file}')
 
     if verbose:
+        args.append('-v')
+
+    args.append(backup_file)
+
+    returncode = runProcess(args, dict(os.environ, PGPASSWORD=password))
+
+    if int(returncode) != 0:
+        raise RestoreError('Restoring database "{}" failed. Return code : {}'.format(db, returncode))
+
+@report.timed('restore_subset', result=lambda size: {'bytes': size})
+def loadPostgresSubset(host: str, port: int, user: str, password: str, databaseName: str, subsetDir: str, filters: TableFilter = None, checkpoint: Checkpoint = None) -> int:
+    """
+    Load rows of subset tables copied by dumpPostgresSubset, except tables left out by the filters.
+    With a checkpoint every table is recorded when loaded, a resumed table is emptied first.
+    """
+    with open(os.path.join(subsetDir, 'manifest.json')) as file:
+        manifest = json.load(file)
+
+    size = 0
+    with connections.cursor(host, port, user, password, databaseName) as cursor:
+        for table in manifest['tables']:
+            if filters is not None and (filters.schemaOnly or not filters.tableIncluded(table['schema'], table['name'])):
+                continue
+            unit = 'subset:{}'.format(table['file'])
+            if checkpoint is not None and checkpoint.isDone(unit):
+                continue
+            if checkpoint is not None and checkpoint.resumed:
+                cursor.execute('TRUNCATE ONLY {};'.format(table['sql']))
+            path = os.path.join(subsetDir, table['file'])
+            with open(path, 'rb') as file:
+                cursor.copy_expert('COPY {} ({}) FROM STDIN;'.format(table['sql'], ', '.join(table['columns'])), file)
+            size += os.path.getsize(path)
+            if checkpoint is not None:
+                checkpoint.markDone(unit)
+            logging.info('Loaded subset of {}.'.format(table['sql']))
+
+    return size
+
+def planRestoreBatches(entries: list, done: set, size: int) -> list:
+    """
+    Split entries of a table of contents which are not done into batches restored one after the other.
+    A batch holds at most `size` entries of one dependency level, so everything an entry depends on is done or in an earlier batch.
+    Dependencies outside of `entries` are taken as done.
+    """
+    byId = {entry['id']: entry for entry in entries if entry['id'] not in done}
+    levels = {}
+
+    def level(entry):
+        if entry['id'] not in levels:
+            levels[entry['id']] = -1
+            levels[entry['id']] = 1 + max((level(byId[dependency]) for dependency in entry['dependencies'] if dependency in byId), default=-1)
+        elif levels[entry['id']] < 0:
+            raise RestoreError('Entry {} depends on itself'.format(entry['id']))
+
+        return levels[entry['id']]
+
+    byLevel = {}
+    for entry in byId.values():
+        byLevel.setdefault(level(entry), []).append(entry)
+
+    batches = []
+    for _, levelEntries in sorted(byLevel.items()):
+        batches.extend(levelEntries[start:start + size] for start in range(0, len(levelEntries), size))
+
+    return batches
+
+def restorePostgresEntries(db_host, db, port, user, password, backup_file, section, verbose, jobs, env, list_file, checkpoint):
+    """
+    Restore the entries of a section batch by batch, each batch by one `pg_restore -j` with its own list, recording
+    the entries of every finished batch in the checkpoint. Within a batch pg_restore keeps entries locking the same table
+    from running at once, batches do not overlap.
+
+    Entries which are not recorded may have been restored partly by the failed run: table data is truncated first,
+    indexes, constraints and other objects are dropped and created again.
+    """
+    _, allEntries = readToc(backup_file, ['-v'])
+    byId = {entry['id']: entry for entry in allEntries}
+    # The listing without -v only has entries pg_restore would restore with these options
+    _, selected = readToc(backup_file, ['--section={}'.format(section)] + (['--use-list={}'.format(list_file)] if list_file else []))
+    entries = [byId[entry['id']] for entry in selected]
+    done = {entry['id'] for entry in entries if checkpoint.isDone('entry:{}'.format(entry['id']))}
+    batches = planRestoreBatches(entries, done, RESTORE_BATCH_ENTRIES)
+    logging.info('Restoring {} of {} {} entries of database "{}" in {} batches...'.format(len(entries) - len(done), len(entries), section, db, len(batches)))
+
+    restored = len(done)
+    with tempfile.TemporaryDirectory() as directory:
+        listFile = os.path.join(directory, 'batch.list')
+        for index, batch in enumerate(batches):
+            with open(listFile, 'w', encoding='utf-8', errors='surrogateescape') as file:
+                file.write(''.join(entry['line'] + '\n' for entry in batch))
+
+            args = [
+                'pg_restore',
+                '--no-owner',
+                '--exit-on-error',
+                '-j', str(jobs),
+                f'--use-list={listFile}',
+                f'--dbname={db}',
+                f'--host={db_host}',
+                f'--port={port}',
+                f'--username={user}',
+            ]
+
+            if checkpoint.resumed:
+                tables = [sql.SQL('{}.{}').format(sql.Identifier(entry['schema']), sql.Identifier(entry['tag'])) for entry in batch if entry['type'] == 'TABLE DATA']
+                if tables:
+                    with connections.cursor(db_host, port, user, password, db) as cursor:
+                        cursor.execute(sql.SQL('TRUNCATE ONLY {};').format(sql.SQL(', ').join(tables)))
+                if any(entry['type'] not in TOC_DATA_TYPES for entry in batch):
+                    args.extend(['--clean', '--if-exists'])
+
+            if verbose:
+                args.append('-v')
+
+            args.append(backup_file)
+
+            returncode = runProcess(args, env)
+            if int(returncode) != 0:
+                raise RestoreError('Restoring batch {} of {} entries of database "{}" failed. Return code : {}'.format(index + 1, section, db, returncode))
+
+            checkpoint.markAllDone(['entry:{}'.format(entry['id']) for entry in batch])
+            restored += len(batch)
+            logging.info('Restored batch {}/{} of {} entries ({}/{}).'.format(index + 1, len(batches), section, restored, len(entries)))
+
+def getNewSessionSettings(host: str, port: int, user: str, password: str, databaseName: str, names: tuple) -> dict:
+    """
+    Get settings a new session of the database starts with.
+    A pooled connection would show the settings its session started with, so a separate one is used.
+    """
+    connection = openConnection(host, port, user, password, databaseName)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT name, setting FROM pg_settings WHERE name = ANY(%s);', (list(names),))
+            return dict(cursor.fetchall())
+    finally:
+        connection.close()
+
+@report.timed('restore', sampler=lambda arguments: DatabaseWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restorePostgresDbInSections(db_host, db, port, user, password, backup_file, verbose, jobs, fast_load=False, maintenance_work_mem=FAST_LOAD_MAINTENANCE_WORK_MEM, list_file=None, subset_dir=None, filters=None, checkpoint=None):
+    """
+    Restore postgres db from a file in three passes: schema, data and then indexes and constraints built by parallel workers.
+    Rows of subset tables are loaded after the data, before constraints are created.
+    In fast load mode bulk load settings are given to the pg_restore sessions only, so they end with them. New sessions are checked afterwards.
+    With a checkpoint the schema is one unit, table data and the objects created after it are restored and recorded in batches of entries.
+    """
+    logging.info('Restoring database "{}" in sections{} with {} jobs...'.format(db, ' in fast load mode' if fast_load else '', jobs))
+    env = dict(os.environ, PGPASSWORD=password)
+    if fast_load:
+        safeSettings = getNewSessionSettings(db_host, port, user, password, db, FAST_LOAD_SETTINGS)
+        # Every worker building an index may use maintenance_work_mem
+        options = '-c synchronous_commit=off -c maintenance_work_mem={}'.format(maintenance_work_mem)
+        env['PGOPTIONS'] = ' '.join(filter(None, [os.environ.get('PGOPTIONS'), options]))
+
+    for section in ('pre-data', 'data', 'post-data'):
+        if checkpoint is not None and section != 'pre-data':
+            with report.phase('restore_{}'.format(section.replace('-', '_'))):
+                restorePostgresEntries(db_host, db, port, user, password, backup_file, section, verbose, jobs, env, list_file, checkpoint)
+            if section == 'data' and subset_dir is not None:
+                loadPostgresSubset(db_host, port, user, password, db, subset_dir, filters, checkpoint)
+            continue
+
+        if checkpoint is not None and checkpoint.isDone(section):
+            continue
+
         args = [
             'pg_restore',
             '--no-owner',
+            f'--section={section}',
             f'--dbname={db}',
             f'--host={db_host}',
             f'--port={port}',
             f'--username={user}',
-            '-v',
-            backup_file
-        ]
-    else:
-        args = [
-            'pg_restore',
-            '--no-owner',
-            f'--dbname={db}',
-            f'--host={db_host}',
-            f'--port={port}',
-            f'--username={user}',
-            backup_file
         ]
 
-    process = subprocess.Popen(args, stdout=subprocess.PIPE)
-    output = process.communicate()[0]
-    os.environ["PGPASSWORD"] = ""
+        # Schema statements depend on each other and are cheap, workers pay off for table data, indexes and constraints
+        if section != 'pre-data':
+            args.extend(['-j', str(jobs)])
 
-    if int(process.returncode) != 0:
-        print('Command failed. Return code : {}'.format(process.returncode))
-        # TODO: raise exception or something like that
+        if list_file:
+            args.append(f'--use-list={list_file}')
 
-    return output
+        if verbose:
+            args.append('-v')
 
-def fixDatabaseOwner(db_host, db_port, user_name, user_password, db_user, db_name):
+        args.append(backup_file)
+
+        with report.phase('restore_{}'.format(section.replace('-', '_'))):
+            returncode = runProcess(args, env)
+            if int(returncode) != 0:
+                raise RestoreError('Restoring {} of database "{}" failed. Return code : {}'.format(section, db, returncode))
+
+        if checkpoint is not None:
+            checkpoint.markDone(section)
+
+        if section == 'data' and subset_dir is not None:
+            loadPostgresSubset(db_host, port, user, password, db, subset_dir, filters)
+
+    if not fast_load:
+        return
+
+    settings = getNewSessionSettings(db_host, port, user, password, db, FAST_LOAD_SETTINGS)
+    if settings != safeSettings:
+        logging.error('New sessions of database "{}" start with {} instead of {}.'.format(db, settings, safeSettings))
+        exit(1)
+
+    logging.info('New sessions of database "{}" start with {}.'.format(db, settings))
+
+@report.timed('dump', result=lambda stats: {'bytes': stats['uncompressed'], 'compressed_bytes': stats['compressed']})
+def backupPostgresDbCompressed(host: str, database_name: str, port: int, user: str, password: str, dest_file: str, codec: str, level: int, threads: int, verbose: bool) -> dict:
     """
-    Fix database owner.
+    Backup postgres database to a file compressed by an external multithreaded compressor.
+    Built-in pg_dump compression is disabled so it does not compress twice.
     """
-    logging.info('Fixing database objects owner...')
-    connection = None
+    logging.info('Backing up database "{}" compressed with {}...'.format(database_name, codec))
+
+    args = [
+        'pg_dump',
+        f'--dbname={database_name}',
+        f'--host={host}',
+        f'--port={port}',
+        f'--username={user}',
+        '-Fc',
+        '-Z0',
+    ]
+
+    if verbose:
+        args.append('-v')
+
+    return compressProcessOutput(args, dest_file, codec, level, threads, producerEnv=dict(os.environ, PGPASSWORD=password))
+
+@report.timed('restore', result=lambda stats: {'bytes': stats['uncompressed'], 'compressed_bytes': stats['compressed']}, sampler=lambda arguments: DatabaseWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restorePostgresDbCompressed(db_host, db, port, user, password, backup_file, verbose) -> dict:
+    """
+    Restore postgres db from a compressed file, decompressing it on the fly.
+    """
+    logging.info('Restoring database "{}"...'.format(db))
+
+    args = [
+        'pg_restore',
+        '--no-owner',
+        f'--dbname={db}',
+        f'--host={db_host}',
+        f'--port={port}',
+        f'--username={user}',
+    ]
+
+    if verbose:
+        args.append('-v')
+
+    return decompressIntoProcess(backup_file, args, consumerEnv=dict(os.environ, PGPASSWORD=password))
+
+@report.timed('dump', result=lambda manifest: {'bytes': manifest['size'], 'chunks': len(manifest['chunks'])})
+def backupPostgresDbToStore(host: str, database_name: str, port: int, user: str, password: str, store: BackupStore, name: str, verbose: bool) -> dict:
+    """
+    Backup postgres database into the deduplicating store.
+    The dump is not compressed, compressed data would not deduplicate between runs.
+    """
+    logging.info('Backing up database "{}" into store...'.format(database_name))
+
+    args = [
+        'pg_dump',
+        f'--dbname={database_name}',
+        f'--host={host}',
+        f'--port={port}',
+        f'--username={user}',
+        '-Fc',
+        '-Z0',
+    ]
+
+    if verbose:
+        args.append('-v')
+
+    return store.backupProcess(args, name, database_name, producerEnv=dict(os.environ, PGPASSWORD=password))
+
+@report.timed('restore', result=lambda size: {'bytes': size}, sampler=lambda arguments: DatabaseWriteSampler(arguments['db_host'], arguments['port'], arguments['user'], arguments['password'], arguments['db']))
+def restorePostgresDbFromStore(db_host, db, port, user, password, store, name, verbose) -> int:
+    """
+    Restore postgres db streaming a backup from the store.
+    """
+    logging.info('Restoring database "{}" from "{}"...'.format(db, name))
+
+    args = [
+        'pg_restore',
+        '--no-owner',
+        f'--dbname={db}',
+        f'--host={db_host}',
+        f'--port={port}',
+        f'--username={user}',
+    ]
+
+    if verbose:
+        args.append('-v')
+
+    return store.restoreProcess(name, args, consumerEnv=dict(os.environ, PGPASSWORD=password))
+
+@report.timed('stream', result=lambda size: {'bytes': size}, sampler=lambda arguments: DatabaseWriteSampler(arguments['restore_host'], arguments['restore_port'], arguments['restore_user'], arguments['restore_password'], arguments['restore_db']))
+def streamPostgresDb(backup_host, backup_db, backup_port, backup_user, backup_password, restore_host, restore_db, restore_port, restore_user, restore_password, tee_file, buffer_size, verbose):
+    """
+    Pipe pg_dump straight into pg_restore without an intermediate file.
+    """
+    logging.info('Streaming database "{}" into "{}"...'.format(backup_db, restore_db))
+
+    dumpArgs = [
+        'pg_dump',
+        f'--dbname={backup_db}',
+        f'--host={backup_host}',
+        f'--port={backup_port}',
+        f'--username={backup_user}',
+        '-Fc',
+    ]
+    restoreArgs = [
+        'pg_restore',
+        '--no-owner',
+        f'--dbname={restore_db}',
+        f'--host={restore_host}',
+        f'--port={restore_port}',
+        f'--username={restore_user}',
+    ]
+
+    if verbose:
+        dumpArgs.append('-v')
+        restoreArgs.append('-v')
+
+    return pipeProcesses(
+        dumpArgs,
+        restoreArgs,
+        producerEnv=dict(os.environ, PGPASSWORD=backup_password),
+        consumerEnv=dict(os.environ, PGPASSWORD=restore_password),
+        teeFile=tee_file,
+        bufferSize=buffer_size,
+    )
+
+def pipeSchemaSection(backup_host, backup_db, backup_port, backup_user, backup_password, restore_host, restore_db, restore_port, restore_user, restore_password, section, snapshot, verbose) -> int:
+    """
+    Pipe one section of the schema from pg_dump, in the given snapshot, into pg_restore.
+    """
+    dumpArgs = [
+        'pg_dump',
+        f'--dbname={backup_db}',
+        f'--host={backup_host}',
+        f'--port={backup_port}',
+        f'--username={backup_user}',
+        f'--section={section}',
+        f'--snapshot={snapshot}',
+        '-Fc',
+    ]
+    restoreArgs = [
+        'pg_restore',
+        '--no-owner',
+        '--exit-on-error',
+        f'--dbname={restore_db}',
+        f'--host={restore_host}',
+        f'--port={restore_port}',
+        f'--username={restore_user}',
+    ]
+
+    if verbose:
+        dumpArgs.append('-v')
+        restoreArgs.append('-v')
+
+    return pipeProcesses(dumpArgs, restoreArgs, producerEnv=dict(os.environ, PGPASSWORD=backup_password), consumerEnv=dict(os.environ, PGPASSWORD=restore_password))
+
+def listCopyTables(cursor) -> list:
+    """
+    List tables holding rows (no partitioned parents, views or extension members), largest first so they do not end the copy alone.
+
+    Binary COPY of arrays and composite values carries type oids, which differ between servers for types created in the database,
+    tables with such columns are copied in text format.
+    """
+    cursor.execute('''
+        SELECT format('%I.%I', n.nspname, c.relname),
+            array_agg(quote_ident(a.attname) ORDER BY a.attnum),
+            bool_or(t.oid >= 16384 AND t.typcategory IN ('A', 'C')),
+            pg_relation_size(c.oid)
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = ''
+        JOIN pg_type t ON t.oid = a.atttypid
+        WHERE c.relkind = 'r' AND {} AND {}
+        GROUP BY c.oid, n.nspname, c.relname
+        ORDER BY pg_relation_size(c.oid) DESC;
+    '''.format(OWNER_FIX_SYSTEM_SCHEMAS, OWNER_FIX_NOT_EXTENSION.format('pg_class', 'c.oid')))
+
+    return [{'sql': name, 'columns': columns, 'format': 'text' if textFormat else 'binary', 'size': size} for name, columns, textFormat, size in cursor.fetchall()]
+
+class CountingReader:
+    """
+    File-like reader counting bytes read, for COPY ... FROM STDIN.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.size += len(data)
+        return data
+
+    def close(self) -> None:
+        self._file.close()
+
+def copyTable(sourceConnection, targetConnection, table: dict, bufferSize: int) -> tuple:
+    """
+    Stream rows of a table from COPY TO STDOUT on the source into COPY FROM STDIN on the target.
+
+    Rows go through a pipe: the source side writes them into a buffered writer which flushes full buffers,
+    the target side reads full buffers, both buffers are reused for the whole table. A slow target throttles the source.
+    Returns number of rows and bytes copied.
+    """
+    columns = ', '.join(table['columns'])
+    readFd, writeFd = os.pipe()
+    writer = open(writeFd, 'wb', buffering=bufferSize)
+    reader = CountingReader(open(readFd, 'rb', buffering=bufferSize))
+    resizePipe(writer, bufferSize)
+    produced = {}
+
+    def produce():
+        try:
+            with sourceConnection.cursor() as cursor:
+                cursor.copy_expert('COPY {} ({}) TO STDOUT (FORMAT {});'.format(table['sql'], columns, table['format']), writer, size=bufferSize)
+                produced['rows'] = cursor.rowcount
+        except BaseException as exception:
+            produced['error'] = exception
+        finally:
+            try:
+                writer.close()
+            except BrokenPipeError:
+                pass
+
+    producer = threading.Thread(target=produce, name='copy-source', daemon=True)
+    producer.start()
     try:
-        connection = psycopg2.connect(host=db_host, port=db_port, user=user_name, password=user_password, dbname=db_name)
-        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        with connection.cursor() as cursor:
-            cursor.execute('SELECT \'ALTER TABLE \'|| schemaname || \'."\' || tablename ||\'" OWNER TO "{}";\' FROM pg_tables WHERE NOT schemaname IN (\'pg_catalog\', \'information_schema\') ORDER BY schemaname, tablename;'.format(db_user))
-            for row in cursor.fetchall():
-                cursor.execute(row[0])
+        with targetConnection.cursor() as cursor:
+            cursor.copy_expert('COPY {} ({}) FROM STDIN (FORMAT {});'.format(table['sql'], columns, table['format']), reader, size=bufferSize)
+            rows = cursor.rowcount
+    finally:
+        # A failed target stops the source with a broken pipe
+        reader.close()
+        producer.join()
 
-            cursor.execute('SELECT \'ALTER SEQUENCE \'|| sequence_schema || \'."\' || sequence_name ||\'" OWNER TO "{}";\' FROM information_schema.sequences WHERE NOT sequence_schema IN (\'pg_catalog\', \'information_schema\') ORDER BY sequence_schema, sequence_name;'.format(db_user))
-            for row in cursor.fetchall():
-                cursor.execute(row[0])
+    if 'error' in produced:
+        raise RestoreError('Reading {} from the source failed: {}'.format(table['sql'], produced['error'])) from produced['error']
+    if produced['rows'] != rows:
+        raise RestoreError('{} rows of {} were read but {} written'.format(produced['rows'], table['sql'], rows))
 
-            cursor.execute('SELECT \'ALTER VIEW \'|| table_schema || \'."\' || table_name ||\'" OWNER TO "{}";\' FROM information_schema.views WHERE NOT table_schema IN (\'pg_catalog\', \'information_schema\') ORDER BY table_schema, table_name;'.format(db_user))
-            for row in cursor.fetchall():
-                cursor.execute(row[0])
+    return rows, reader.size
 
-            cursor.execute('SELECT \'ALTER TABLE \'|| oid::regclass::text ||\' OWNER TO "{}";\' FROM pg_class WHERE relkind = \'m\' ORDER BY oid;'.format(db_user))
-            for row in cursor.fetchall():
-                cursor.execute(row[0])
+def openSnapshotConnection(host: str, port: int, user: str, password: str, databaseName: str, snapshot: str = None):
+    """
+    Open a read only repeatable read transaction, in the given exported snapshot or in a new one.
+    """
+    connection = openConnection(host, port, user, password, databaseName)
+    with connection.cursor() as cursor:
+        cursor.execute('BEGIN ISOLATION LEVEL REPEATABLE READ, READ ONLY;')
+        if snapshot is not None:
+            cursor.execute('SET TRANSACTION SNAPSHOT %s;', (snapshot,))
 
-    except Exception as exception:
-        logging.exception(exception)
-        exit(1)
+    return connection
 
-def swapRestoreActive(db_host, restore_database, active_database, db_port, user_name, user_password):
-    logging.info('Swapping active databases...')
-    connection = None
+@report.timed('copy', result=lambda stats: stats, sampler=lambda arguments: DatabaseWriteSampler(arguments['restore_host'], arguments['restore_port'], arguments['restore_user'], arguments['restore_password'], arguments['restore_db']))
+def copyPostgresDb(backup_host, backup_db, backup_port, backup_user, backup_password, restore_host, restore_db, restore_port, restore_user, restore_password, jobs, buffer_size, verbose) -> dict:
+    """
+    Copy a database between servers without pg_dump data or files: the schema is piped by pg_dump and pg_restore,
+    rows of every table are streamed by COPY on a pool of worker connection pairs, indexes and constraints are created last.
+    Everything is read in one snapshot of the source. Large objects are not copied.
+    """
+    logging.info('Copying database "{}" into "{}" with {} jobs...'.format(backup_db, restore_db, jobs))
+    snapshotConnection = openSnapshotConnection(backup_host, backup_port, backup_user, backup_password, backup_db)
+    local = threading.local()
+    workers = []
+    workersLock = threading.Lock()
     try:
-        connection = psycopg2.connect(host=db_host, port=db_port, user=user_name, password=user_password, dbname='postgres')
-        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        with connection.cursor() as cursor:
-            cursor.execute('SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE pid <> pg_backend_pid() AND datname = \'{}\';'.format(active_database))
-            cursor.execute('DROP DATABASE "{}"'.format(active_database))
-            cursor.execute('ALTER DATABASE "{}" RENAME TO "{}";'.format(restore_database, active_database))
+        with snapshotConnection.cursor() as cursor:
+            cursor.execute('SELECT pg_export_snapshot();')
+            snapshot = cursor.fetchone()[0]
+            tables = listCopyTables(cursor)
+            cursor.execute('SELECT format(\'%I.%I\', schemaname, sequencename), last_value FROM pg_sequences WHERE last_value IS NOT NULL;')
+            sequences = cursor.fetchall()
+            cursor.execute('SELECT count(*) FROM pg_largeobject_metadata;')
+            if cursor.fetchone()[0]:
+                logging.warning('Large objects of database "{}" are not copied.'.format(backup_db))
+
+        with report.phase('copy_pre_data'):
+            pipeSchemaSection(backup_host, backup_db, backup_port, backup_user, backup_password, restore_host, restore_db, restore_port, restore_user, restore_password, 'pre-data', snapshot, verbose)
+
+        copied = itertools.count(1)
+
+        def copyWorkerTable(table):
+            if not hasattr(local, 'connections'):
+                local.connections = (
+                    openSnapshotConnection(backup_host, backup_port, backup_user, backup_password, backup_db, snapshot),
+                    openConnection(restore_host, restore_port, restore_user, restore_password, restore_db),
+                )
+                with workersLock:
+                    workers.extend(local.connections)
+            startedAt = time.monotonic()
+            rows, size = copyTable(local.connections[0], local.connections[1], table, buffer_size)
+            seconds = time.monotonic() - startedAt
+            logging.info('Copied {}: {} rows, {} bytes in {:.1f}s ({:.0f} rows/s) [{}/{}].'.format(table['sql'], rows, size, seconds, rows / seconds if seconds > 0 else 0, next(copied), len(tables)))
+
+            return rows, size
+
+        with report.phase('copy_data') as metrics:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(copyWorkerTable, table) for table in tables]
+                try:
+                    results = [future.result() for future in futures]
+                except BaseException:
+                    # Tables not started yet are not worth copying
+                    for future in futures:
+                        future.cancel()
+                    raise
+            metrics['rows'] = sum(rows for rows, _ in results)
+            metrics['bytes'] = sum(size for _, size in results)
+            metrics['tables'] = len(tables)
+
+        with connections.cursor(restore_host, restore_port, restore_user, restore_password, restore_db) as cursor:
+            for name, value in sequences:
+                cursor.execute('SELECT setval(%s, %s, true);', (name, value))
+
+        with report.phase('copy_post_data'):
+            pipeSchemaSection(backup_host, backup_db, backup_port, backup_user, backup_password, restore_host, restore_db, restore_port, restore_user, restore_password, 'post-data', snapshot, verbose)
+    finally:
+        for worker in workers:
+            worker.close()
+        snapshotConnection.close()
+
+    return {'rows': metrics['rows'], 'bytes': metrics['bytes'], 'tables': len(tables)}
+
+@report.timed('owner_fix', result=lambda total: {'objects': total})
+def fixDatabaseOwner(db_host, db_port, user_name, user_password, db_user, db_name) -> int:
+    """
+    Fix database owner.
+    Every batch is a single DO block executed server-side, so there is one round trip per object kind instead of per object.
+    """
+    logging.info('Fixing database objects owner...')
+    total = 0
+    try:
+        connection = connections.get(db_host, db_port, user_name, user_password, db_name)
+        with connections.cursor(db_host, db_port, user_name, user_password, db_name) as cursor:
+            cursor.execute('SELECT set_config(\'database_manager.owner\', %s, false);', (db_user,))
+            for kind, query in OWNER_FIX_BATCHES:
+                del connection.notices[:]
+                startedAt = time.monotonic()
+                cursor.execute(OWNER_FIX_BLOCK.format(query))
+                elapsed = time.monotonic() - startedAt
+                changed = sum(int(match) for notice in connection.notices for match in re.findall(r'owner_fix_changed=(\d+)', notice))
+                total += changed
+                logging.info('Changed owner of {} {} in {:.3f}s.'.format(changed, kind, elapsed))
+
+        logging.info('Changed owner of {} objects in total.'.format(total))
 
     except Exception as exception:
         logging.exception(exception)
         exit(1)
 
-def swapRestoreNew(db_host, restore_database, new_database, db_port, user_name, user_password):
-    logging.info('Swapping new databases...')
-    connection = None
+    return total
+
+@report.timed('swap', result=lambda downtime: {'downtime_seconds': downtime})
+def swapRestoreActive(db_host, restore_database, active_database, old_database, db_port, user_name, user_password) -> float:
+    """
+    Put the restored database in place of the active one, which is renamed to old_database.
+
+    Clients can not connect only while the two databases are renamed, the old one is dropped or kept for a rollback
+    by the caller afterwards. Returns the time clients could not connect.
+    """
+    logging.info('Swapping active databases...')
+    for database in (active_database, restore_database):
+        connections.close(db_host, db_port, user_name, database)
+
+    downtime = 0.0
     try:
-        connection = psycopg2.connect(host=db_host, port=db_port, user=user_name, password=user_password, dbname='postgres')
-        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        with connection.cursor() as cursor:
-            cursor.execute('ALTER DATABASE "{}" RENAME TO "{}";'.format(restore_database, new_database))
+        with connections.cursor(db_host, db_port, user_name, user_password, 'postgres') as cursor:
+            cursor.execute('SELECT datallowconn FROM pg_database WHERE datname = %s;', (active_database,))
+            active = cursor.fetchone()
+            if active is None:
+                cursor.execute('ALTER DATABASE "{}" RENAME TO "{}";'.format(restore_database, active_database))
+                logging.info('There was no active database "{}", renamed the restored one.'.format(active_database))
+                return downtime
+
+            startedAt = time.monotonic()
+            cursor.execute('ALTER DATABASE "{}" ALLOW_CONNECTIONS false;'.format(active_database))
+            swapped = False
+            try:
+                # Sessions which connected before connections were refused are terminated, the rename waits until they are gone
+                for attempt in range(SWAP_ATTEMPTS):
+                    cursor.execute('SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE pid <> pg_backend_pid() AND datname = %s;', (active_database,))
+                    try:
+                        cursor.execute('ALTER DATABASE "{}" RENAME TO "{}";'.format(active_database, old_database))
+                        break
+                    except psycopg2.Error as error:
+                        if error.pgcode != errorcodes.OBJECT_IN_USE or attempt == SWAP_ATTEMPTS - 1:
+                            raise
+                        time.sleep(SWAP_RETRY_DELAY)
+                try:
+                    cursor.execute('ALTER DATABASE "{}" RENAME TO "{}";'.format(restore_database, active_database))
+                    swapped = True
+                except psycopg2.Error:
+                    cursor.execute('ALTER DATABASE "{}" RENAME TO "{}";'.format(old_database, active_database))
+                    raise
+                downtime = time.monotonic() - startedAt
+            finally:
+                if active[0]:
+                    cursor.execute('ALTER DATABASE "{}" ALLOW_CONNECTIONS true;'.format(old_database if swapped else active_database))
+
+        logging.info('Database "{}" was not available for {:.3f}s.'.format(active_database, downtime))
 
     except Exception as exception:
         logging.exception(exception)
         exit(1)
 
+    return downtime
+
+@report.timed('delete_database')
 def deleteDatabase(db_host, database, db_port, user_name, user_password):
     logging.info('Deleting database...')
-    connection = None
+    connections.close(db_host, db_port, user_name, database)
     try:
-        connection = psycopg2.connect(host=db_host, port=db_port, user=user_name, password=user_password, dbname='postgres')
-        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        with connection.cursor() as cursor:
+        with connections.cursor(db_host, db_port, user_name, user_password, 'postgres') as cursor:
             cursor.execute('SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE pid <> pg_backend_pid() AND datname = \'{}\';'.format(database))
             cursor.execute('DROP DATABASE IF EXISTS "{}"'.format(database))
 
@@ -201,13 +1111,11 @@ def deleteDatabase(db_host, database, db_port, user_name, user_password):
         logging.exception(exception)
         exit(1)
 
+@report.timed('delete_user')
 def deleteUser(db_host, db_port, user_name, user_password, user_to_delete):
     logging.info('Deleting user...')
-    connection = None
     try:
-        connection = psycopg2.connect(host=db_host, port=db_port, user=user_name, password=user_password, dbname='postgres')
-        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        with connection.cursor() as cursor:
+        with connections.cursor(db_host, db_port, user_name, user_password, 'postgres') as cursor:
             cursor.execute('DROP USER IF EXISTS "{}"'.format(user_to_delete))
 
     except Exception as exception:
@@ -221,7 +1129,7 @@ def main():
                              help="Database configuration file")
     args_parser.add_argument("--action",
                              metavar="action",
-                             choices=['restore', 'delete', 'create'],
+                             choices=['restore', 'delete', 'create', 'prune', 'gc'],
                              help="Action to perform",
                              required=True)
     args_parser.add_argument("--swap",
@@ -230,17 +1138,255 @@ def main():
                              action=argparse.BooleanOptionalAction,
                              help="Swap active and new databases",
                              required=False)
+    args_parser.add_argument("--keep-old",
+                             metavar="keep_old",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Keep the previously active database as <db_new>_old after --swap, for a rollback",
+                             required=False)
+    args_parser.add_argument("--checkpoint",
+                             metavar="checkpoint",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Restore a dump file in batches of entries and record progress in a checkpoint next to the dump",
+                             required=False)
+    args_parser.add_argument("--resume",
+                             metavar="resume",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Continue the last failed restore from its checkpoint instead of starting over, implies --checkpoint",
+                             required=False)
     args_parser.add_argument("--verbose",
                              metavar="verbose",
                              default=False,
                              action=argparse.BooleanOptionalAction,
                              help="Berbose output",
                              required=False)
+    args_parser.add_argument("--stream",
+                             metavar="stream",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Pipe the dump straight into the restore without an intermediate file",
+                             required=False)
+    args_parser.add_argument("--tee",
+                             metavar="tee",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="In stream mode also write the dump to the backups directory",
+                             required=False)
+    args_parser.add_argument("--buffer-size",
+                             type=int,
+                             default=DEFAULT_BUFFER_SIZE,
+                             help="Stream buffer size in bytes",
+                             required=False)
+    args_parser.add_argument("--parallel",
+                             metavar="parallel",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Dump and restore with parallel workers using directory format",
+                             required=False)
+    args_parser.add_argument("--jobs",
+                             type=int,
+                             default=None,
+                             help="Number of parallel workers (implies --parallel, default depends on CPU count and source tables)",
+                             required=False)
+    args_parser.add_argument("--copy",
+                             metavar="copy",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Copy table rows with COPY between the servers by parallel workers, the schema is piped by pg_dump and pg_restore",
+                             required=False)
+    args_parser.add_argument("--clone",
+                             metavar="clone",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Copy the database with CREATE DATABASE ... TEMPLATE when source and target are the same server",
+                             required=False)
+    args_parser.add_argument("--clone-strategy",
+                             choices=CLONE_STRATEGIES,
+                             default='auto',
+                             help="CREATE DATABASE strategy of --clone (auto picks file_copy for databases of at least 1 GB)",
+                             required=False)
+    args_parser.add_argument("--fast-load",
+                             metavar="fast_load",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Restore schema, data and indexes/constraints in separate passes with bulk load session settings",
+                             required=False)
+    args_parser.add_argument("--maintenance-work-mem",
+                             default=FAST_LOAD_MAINTENANCE_WORK_MEM,
+                             help="maintenance_work_mem of every restore worker in fast load mode",
+                             required=False)
+    args_parser.add_argument("--include-schema",
+                             action="append",
+                             default=None,
+                             help="Restore only schemas matching the pattern (can be repeated)",
+                             required=False)
+    args_parser.add_argument("--exclude-schema",
+                             action="append",
+                             default=None,
+                             help="Do not restore schemas matching the pattern (can be repeated)",
+                             required=False)
+    args_parser.add_argument("--include-table",
+                             action="append",
+                             default=None,
+                             help="Restore only tables matching the pattern, `table` or `schema.table` (can be repeated)",
+                             required=False)
+    args_parser.add_argument("--exclude-table",
+                             action="append",
+                             default=None,
+                             help="Do not restore tables matching the pattern, `table` or `schema.table` (can be repeated)",
+                             required=False)
+    args_parser.add_argument("--schema-only",
+                             metavar="schema_only",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Restore the database definition without data",
+                             required=False)
+    args_parser.add_argument("--subset",
+                             action="append",
+                             type=parseSubsetRule,
+                             default=None,
+                             help="Copy only part of matching tables, `table=10%%` or `table=<WHERE clause>` (can be repeated)",
+                             required=False)
+    args_parser.add_argument("--compress",
+                             choices=CODECS,
+                             default=None,
+                             help="Compress the dump written to the backups directory",
+                             required=False)
+    args_parser.add_argument("--compress-level",
+                             type=int,
+                             default=None,
+                             help="Compression level (default depends on the codec)",
+                             required=False)
+    args_parser.add_argument("--compress-threads",
+                             type=int,
+                             default=None,
+                             help="Compression threads for zstd and pigz (default is CPU count)",
+                             required=False)
+    args_parser.add_argument("--store",
+                             metavar="store",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Keep the dump in the deduplicating backup store",
+                             required=False)
+    args_parser.add_argument("--keep",
+                             type=int,
+                             default=30,
+                             help="Number of backups of the database kept by the prune action",
+                             required=False)
+    args_parser.add_argument("--cache",
+                             metavar="cache",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Reuse the last dump when the source database did not change",
+                             required=False)
+    args_parser.add_argument("--force-dump",
+                             metavar="force_dump",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Dump the source database even when a cached dump is valid",
+                             required=False)
+    args_parser.add_argument("--cache-ttl",
+                             type=int,
+                             default=DEFAULT_TTL,
+                             help="Seconds after which cached dumps expire and are removed",
+                             required=False)
+    args_parser.add_argument("--cache-max-size",
+                             type=int,
+                             default=0,
+                             help="Maximum total size in bytes of cached dumps (0 means no limit)",
+                             required=False)
+    args_parser.add_argument("--batch",
+                             metavar="batch",
+                             default=False,
+                             action=argparse.BooleanOptionalAction,
+                             help="Run every [job:<name>] section of the configuration file as a separate job",
+                             required=False)
+    args_parser.add_argument("--batch-workers",
+                             type=int,
+                             default=4,
+                             help="Number of jobs running at once in batch mode",
+                             required=False)
+    args_parser.add_argument("--source-host-limit",
+                             type=int,
+                             default=2,
+                             help="Number of jobs running at once against one source host in batch mode",
+                             required=False)
+    args_parser.add_argument("--target-host-limit",
+                             type=int,
+                             default=2,
+                             help="Number of jobs running at once against one target host in batch mode",
+                             required=False)
+    args_parser.add_argument("--result-file",
+                             default=None,
+                             help=argparse.SUPPRESS,
+                             required=False)
+    args_parser.add_argument("--job-name",
+                             default=None,
+                             help=argparse.SUPPRESS,
+                             required=False)
+    args_parser.add_argument("--report-file",
+                             default=None,
+                             help="Write timings and throughput of the run phases as JSON to this file",
+                             required=False)
+    args_parser.add_argument("--prometheus-file",
+                             default=None,
+                             help="Write timings and throughput of the run phases as a Prometheus textfile to this file",
+                             required=False)
     args = args_parser.parse_args()
 
+    report.jsonPath = args.report_file
+    report.prometheusPath = args.prometheus_file
+
+    if args.jobs is not None:
+        args.parallel = True
+
+    if args.resume is True:
+        args.checkpoint = True
+
+    if args.stream is True and args.parallel is True:
+        args_parser.error('--stream can not be combined with --parallel/--jobs')
+
+    if args.compress is not None and (args.stream is True or args.parallel is True):
+        args_parser.error('--compress can not be combined with --stream or --parallel/--jobs')
+
+    if args.store is True and (args.stream is True or args.parallel is True or args.compress is not None):
+        args_parser.error('--store can not be combined with --stream, --parallel/--jobs or --compress')
+
+    if args.fast_load is True and (args.stream is True or args.store is True or args.compress is not None):
+        args_parser.error('--fast-load can not be combined with --stream, --store or --compress')
+
+    filters = TableFilter(args.include_schema, args.exclude_schema, args.include_table, args.exclude_table, args.schema_only)
+    if (not filters.isEmpty() or args.subset) and (args.stream is True or args.store is True or args.compress is not None):
+        args_parser.error('--include-*, --exclude-*, --schema-only and --subset can not be combined with --stream, --store or --compress')
+
+    if args.subset and args.schema_only is True:
+        args_parser.error('--subset can not be combined with --schema-only')
+
+    if args.clone is True and (args.stream is True or args.parallel is True or args.compress is not None or args.store is True or args.fast_load is True or not filters.isEmpty() or args.subset):
+        args_parser.error('--clone can not be combined with options of dump and restore')
+
+    if args.copy is True and (args.stream is True or args.compress is not None or args.store is True or args.clone is True or args.fast_load is True or not filters.isEmpty() or args.subset):
+        args_parser.error('--copy can not be combined with --stream, --compress, --store, --clone, --fast-load, filters or --subset')
+
+    if args.checkpoint is True and (args.copy is True or args.clone is True or args.stream is True or args.store is True or args.compress is not None):
+        args_parser.error('--checkpoint and --resume need a dump file, they can not be combined with --copy, --clone, --stream, --store or --compress')
+
     config = configparser.ConfigParser()
     config.read(args.configfile)
 
+    report.labels = {'script': os.path.basename(__file__), 'action': args.action}
+
+    if args.batch is True:
+        results = runBatch(os.path.abspath(__file__), sys.argv[1:], readJobs(config), args.batch_workers, args.source_host_limit, args.target_host_limit, BACKUP_PATH)
+        for result in results:
+            report.addPhase('job:{}'.format(result['name']), result['duration'], result['status'], {'bytes': result['bytes']})
+        logging.info('Batch summary:\n{}'.format(formatSummary(results)))
+        if any(result['status'] != 'ok' for result in results):
+            exit(1)
+        return
+
     postgres_host_backup = config.get('backup', 'host')
     postgres_port_backup = config.get('backup', 'port')
     postgres_db_backup = config.get('backup', 'db')
@@ -249,6 +1395,7 @@ def main():
 
     postgres_host_restore = config.get('restore', 'host')
     postgres_db_restore = "{}_restore".format(postgres_db_backup)
+    postgres_db_active = config.get('restore', 'db_new')
     postgres_port_restore = config.get('restore', 'port')
     postgres_user_restore = config.get('restore', 'user')
     postgres_password_restore = config.get('restore', 'password')
@@ -258,39 +1405,191 @@ def main():
     if args.swap is False:
         postgres_db_restore = config.get('restore', 'db_new')
 
+    report.labels['database'] = postgres_db_backup
+
+    same_server = (postgres_host_backup, postgres_port_backup) == (postgres_host_restore, postgres_port_restore)
+    if args.clone is True and not same_server:
+        args_parser.error('--clone needs the [backup] and [restore] sections to point to the same server')
+
+    if args.action == 'restore' and same_server and args.clone is False:
+        logging.info('Source and target are the same server, --clone would copy the database without dumping it.')
+
     if args.action == 'restore':
         timestr = datetime.now().strftime('%Y%m%d-%H%M%S')
-        filename = 'backup-{}-{}.dump'.format(timestr, postgres_db_backup)
+        # Jobs of a batch restoring the same database at the same second must not share files
+        backup_name = 'backup-{}-{}'.format(timestr, postgres_db_backup) if args.job_name is None else 'backup-{}-{}-{}'.format(timestr, args.job_name, postgres_db_backup)
+        filename = '{}.dump'.format(backup_name)
+        jobs = None
+
+        if args.parallel is True:
+            filename = '{}.dir'.format(backup_name)
+            jobs = args.jobs or defaultJobCount(postgres_host_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, postgres_db_backup)
+
         local_file_path = '{}{}'.format(BACKUP_PATH, filename)
 
-        backupPostgresDb(postgres_host_backup, postgres_db_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, local_file_path, args.verbose)
-        createDatabseUser(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_new_password_restore, args.verbose)
-        # createDatabase(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_new_user_restore, args.verbose)
-        createDatabase(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_db_restore, args.verbose)
-        restorePostgresDb(postgres_host_restore, postgres_db_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, local_file_path, args.verbose)
+        dump_bytes = None
+        cache = None
+        cached_file_path = None
+        subset = None
+        checkpoint = None
+        # Entries and units recorded in a checkpoint depend on the selected tables
+        restore_options = {
+            'include_schema': args.include_schema,
+            'exclude_schema': args.exclude_schema,
+            'include_table': args.include_table,
+            'exclude_table': args.exclude_table,
+            'schema_only': args.schema_only,
+            'subset': args.subset,
+        }
+        if args.resume is True:
+            checkpoint = findCheckpoint(BACKUP_PATH, postgres_db_backup, postgres_db_restore)
+            if checkpoint is None:
+                logging.info('No checkpoint of a restore of "{}" into "{}" found, starting over.'.format(postgres_db_backup, postgres_db_restore))
+            elif not checkpoint.matchesOptions(restore_options):
+                args_parser.error('--resume needs the table selection of the resumed restore: {}'.format(json.dumps(checkpoint.info.get('options'))))
+            else:
+                local_file_path = checkpoint.info['dump']
+                logging.info('Resuming the restore of "{}" into "{}" from "{}", {} units are done.'.format(postgres_db_backup, postgres_db_restore, checkpoint.path, len(checkpoint.completed)))
+
+        if args.subset and checkpoint is None:
+            subset = planPostgresSubset(postgres_host_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, postgres_db_backup, args.subset, filters)
+
+        # A subset depends on the rules, not only on the source state
+        if args.cache is True and args.clone is False and args.copy is False and args.stream is False and args.store is False and not args.subset and checkpoint is None:
+            cache = DumpCache(CACHE_PATH, args.cache_ttl, args.cache_max_size)
+            fingerprint = getDatabaseFingerprint(postgres_host_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, postgres_db_backup)
+            cache_key = 'postgres://{}:{}/{}#{}'.format(postgres_host_backup, postgres_port_backup, postgres_db_backup, 'directory' if args.parallel else args.compress or 'custom')
+            if args.force_dump is False:
+                cached_file_path = cache.lookup(cache_key, fingerprint)
+
+        if args.compress is not None:
+            local_file_path += EXTENSIONS[args.compress]
+        if cached_file_path is not None:
+            local_file_path = cached_file_path
+
+        # Steps run as soon as the steps they come after are done, the target is provisioned while the source is dumped
+        steps = [
+            Step('create_user', lambda: createDatabseUser(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_new_password_restore, args.verbose)),
+        ]
+
+        def prepareDatabase():
+            if checkpoint is not None:
+                if checkpoint.resumed:
+                    return
+                # Nothing is recorded, the failed run may have left anything behind
+                deleteDatabase(postgres_host_restore, postgres_db_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore)
+            createDatabase(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_db_restore, args.verbose)
+
+        if args.clone is False:
+            steps.append(Step('create_database', prepareDatabase, after=['create_user']))
+
+        def dump():
+            if cached_file_path is not None or checkpoint is not None:
+                return
+            if args.compress is not None:
+                backupPostgresDbCompressed(postgres_host_backup, postgres_db_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, local_file_path, args.compress, args.compress_level, args.compress_threads, args.verbose)
+            else:
+                backupPostgresDb(postgres_host_backup, postgres_db_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, local_file_path, args.verbose, jobs, subset)
+            if cache is not None:
+                cache.record(cache_key, fingerprint, local_file_path)
+
+        def restore():
+            subset_dir = '{}.subset'.format(local_file_path) if args.subset else None
+            list_file = None
+            if not filters.isEmpty():
+                list_file = checkpoint.info['list_file'] if checkpoint is not None else '{}{}.list'.format(BACKUP_PATH, backup_name)
+                writeRestoreList(local_file_path, filters, list_file)
+            # The dump is complete from here on, a failed restore can be resumed without dumping again
+            restore_checkpoint = checkpoint
+            if args.checkpoint is True and restore_checkpoint is None:
+                restore_checkpoint = Checkpoint.create(local_file_path, postgres_db_backup, postgres_db_restore, restore_options, list_file)
+            if restore_checkpoint is not None or args.fast_load is True or subset_dir is not None:
+                restorePostgresDbInSections(postgres_host_restore, postgres_db_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, local_file_path, args.verbose, jobs or os.cpu_count() or 1, args.fast_load, args.maintenance_work_mem, list_file, subset_dir, filters, restore_checkpoint)
+            else:
+                restorePostgresDb(postgres_host_restore, postgres_db_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, local_file_path, args.verbose, jobs, list_file)
+
+        if args.clone is True:
+            steps.append(Step('restore', lambda: cloneDatabase(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_db_backup, postgres_db_restore, args.clone_strategy, args.verbose), after=['create_user']))
+        elif args.copy is True:
+            copy_jobs = jobs or defaultJobCount(postgres_host_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, postgres_db_backup)
+            steps.append(Step('restore', lambda: copyPostgresDb(postgres_host_backup, postgres_db_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, postgres_host_restore, postgres_db_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, copy_jobs, args.buffer_size, args.verbose)['bytes'], after=['create_database']))
+        elif args.stream is True:
+            steps.append(Step('restore', lambda: streamPostgresDb(postgres_host_backup, postgres_db_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, postgres_host_restore, postgres_db_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, local_file_path if args.tee else None, args.buffer_size, args.verbose), after=['create_database']))
+        elif args.store is True:
+            store = BackupStore(STORE_PATH)
+            steps.append(Step('dump', lambda: backupPostgresDbToStore(postgres_host_backup, postgres_db_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, store, backup_name, args.verbose)['size']))
+            steps.append(Step('restore', lambda: restorePostgresDbFromStore(postgres_host_restore, postgres_db_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, store, backup_name, args.verbose), after=['dump', 'create_database']))
+        elif args.compress is not None:
+            steps.append(Step('dump', dump))
+            steps.append(Step('restore', lambda: restorePostgresDbCompressed(postgres_host_restore, postgres_db_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, local_file_path, args.verbose), after=['dump', 'create_database']))
+        else:
+            steps.append(Step('dump', dump))
+            steps.append(Step('restore', restore, after=['dump', 'create_database']))
+
+        # Owners are fixed before the swap, the database is ready when clients get it
+        steps.append(Step('owner_fix', lambda: fixDatabaseOwner(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_db_restore), after=['restore']))
 
         if args.swap is True:
-            # swapRestoreActive(postgres_host_restore, postgres_db_restore, postgres_db_backup, postgres_port_restore, postgres_user_restore, postgres_password_restore)
-            swapRestoreNew(postgres_host_restore, postgres_db_restore, postgres_new_user_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore)
+            postgres_db_old = '{}_old'.format(postgres_db_active)
+            # An old database kept by the previous run
+            steps.append(Step('delete_old', lambda: deleteDatabase(postgres_host_restore, postgres_db_old, postgres_port_restore, postgres_user_restore, postgres_password_restore), after=['owner_fix']))
+            steps.append(Step('swap', lambda: swapRestoreActive(postgres_host_restore, postgres_db_restore, postgres_db_active, postgres_db_old, postgres_port_restore, postgres_user_restore, postgres_password_restore), after=['owner_fix', 'delete_old']))
+            if args.keep_old is False:
+                steps.append(Step('drop_old', lambda: deleteDatabase(postgres_host_restore, postgres_db_old, postgres_port_restore, postgres_user_restore, postgres_password_restore), after=['swap']))
+
+        try:
+            results = runGraph(steps)
+        except BaseException:
+            if os.path.exists(checkpointPath(local_file_path)):
+                logging.error('Progress of the restore is kept in "{}", run again with --resume to continue it.'.format(checkpointPath(local_file_path)))
+            raise
+
+        if os.path.exists(checkpointPath(local_file_path)):
+            os.remove(checkpointPath(local_file_path))
+
+        # Clone, copy, stream and store runs know how much they copied
+        if args.clone is True or args.copy is True or args.stream is True:
+            dump_bytes = results['restore']
+        elif args.store is True:
+            dump_bytes = results['dump']
+        if dump_bytes is None:
+            dump_bytes = pathSize(local_file_path)
+
+        if args.result_file is not None:
+            with open(args.result_file, 'w') as file:
+                json.dump({'bytes': dump_bytes}, file)
 
-        fixDatabaseOwner(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_db_restore)
+        if cache is not None:
+            cache.evict(local_file_path)
     elif args.action == 'delete':
         deleteDatabase(postgres_host_backup, postgres_db_restore, postgres_port_backup, postgres_user_backup, postgres_password_backup)
         deleteUser(postgres_host_backup, postgres_port_backup, postgres_user_backup, postgres_password_backup, postgres_new_user_restore)
+    elif args.action == 'prune':
+        store = BackupStore(STORE_PATH)
+        store.prune(postgres_db_backup, args.keep)
+        store.gc()
+    elif args.action == 'gc':
+        BackupStore(STORE_PATH).gc()
     elif args.action == 'create':
         createDatabseUser(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_new_password_restore, args.verbose)
         createDatabase(postgres_host_restore, postgres_port_restore, postgres_user_restore, postgres_password_restore, postgres_new_user_restore, postgres_db_restore, args.verbose)
 
 if __name__ == '__main__':
+    succeeded = False
     try:
         startedAt = datetime.now()
         initLoggers()
         logging.info('Started at %s', startedAt.strftime('%Y-%m-%d %H:%M:%S'))
         main()
+        succeeded = True
     except Exception as exception:
         logging.exception(exception)
         raise exception
     finally:
+        connections.closeAll()
+        connections.logTimings()
+        report.addConnections(connections)
+        report.write(succeeded)
         endedAt = datetime.now()
         logging.info('Ended at %s', endedAt.strftime('%Y-%m-%d %H:%M:%S'))
         logging.info('Total time: %s', endedAt - startedAt)
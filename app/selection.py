@@ -0,0 +1,123 @@
+import fnmatch
+import logging
+import re
+
+PERCENTAGE = re.compile(r'^(\d+(?:\.\d+)?)%$')
+SAMPLE_BUCKETS = 10000
+
+def matchTable(pattern: str, schema: str, name: str) -> bool:
+    """
+    Match a table against a pattern with `*` and `?` wildcards, either `schema.table` or `table` in any schema.
+    """
+    if '.' in pattern:
+        return fnmatch.fnmatchcase('{}.{}'.format(schema, name), pattern)
+
+    return fnmatch.fnmatchcase(name, pattern)
+
+class TableFilter:
+    """
+    Schemas and tables selected for a restore.
+    """
+
+    def __init__(self, includeSchemas: list = None, excludeSchemas: list = None, includeTables: list = None, excludeTables: list = None, schemaOnly: bool = False):
+        self.includeSchemas = includeSchemas or []
+        self.excludeSchemas = excludeSchemas or []
+        self.includeTables = includeTables or []
+        self.excludeTables = excludeTables or []
+        self.schemaOnly = schemaOnly
+
+    def isEmpty(self) -> bool:
+        return not (self.includeSchemas or self.excludeSchemas or self.includeTables or self.excludeTables or self.schemaOnly)
+
+    def schemaIncluded(self, schema: str) -> bool:
+        if self.includeSchemas and not any(fnmatch.fnmatchcase(schema, pattern) for pattern in self.includeSchemas):
+            return False
+
+        return not any(fnmatch.fnmatchcase(schema, pattern) for pattern in self.excludeSchemas)
+
+    def tableIncluded(self, schema: str, name: str) -> bool:
+        if not self.schemaIncluded(schema):
+            return False
+        if self.includeTables and not any(matchTable(pattern, schema, name) for pattern in self.includeTables):
+            return False
+
+        return not any(matchTable(pattern, schema, name) for pattern in self.excludeTables)
+
+def parseSubsetRule(value: str) -> tuple:
+    """
+    Parse a `table=10%` or `table=<WHERE clause>` rule into a table pattern, a percentage and a condition.
+    """
+    pattern, separator, condition = value.partition('=')
+    pattern = pattern.strip()
+    condition = condition.strip()
+    if not separator or not pattern or not condition:
+        raise ValueError('Subset rule "{}" is not "<table>=<percentage>%" or "<table>=<condition>"'.format(value))
+
+    match = PERCENTAGE.match(condition)
+    if match is None:
+        return pattern, None, condition
+
+    percentage = float(match.group(1))
+    if percentage > 100:
+        raise ValueError('Subset rule "{}" has a percentage over 100'.format(value))
+
+    return pattern, percentage, None
+
+def planSubset(tables: dict, foreignKeys: list, rules: list, sample) -> dict:
+    """
+    Get the row condition of every table which is not copied whole.
+
+    `tables` maps a table key to a dict with its `schema`, `name`, quoted `sql` name and quoted `keyColumns`,
+    `foreignKeys` are dicts with `table`, `columns`, `parent` and `parentColumns`, `sample(table, buckets)` returns
+    a condition selecting `buckets` out of SAMPLE_BUCKETS by a hash of the key columns, so the same rows are picked
+    wherever the condition is repeated.
+
+    Rows referencing a parent row which is left out are left out as well, so foreign keys still hold in the subset.
+    Self-referencing foreign keys and cycles can not be followed this way and are only reported.
+    """
+    explicit = {}
+    for pattern, percentage, condition in rules:
+        matched = [key for key, table in tables.items() if matchTable(pattern, table['schema'], table['name'])]
+        if not matched:
+            logging.warning('Subset rule "{}" matches no table.'.format(pattern))
+        for key in matched:
+            if percentage is not None:
+                condition = sample(tables[key], round(percentage * SAMPLE_BUCKETS / 100))
+            explicit.setdefault(key, []).append(condition)
+
+    references = {}
+    for foreignKey in foreignKeys:
+        if foreignKey['table'] in tables and foreignKey['parent'] in tables:
+            references.setdefault(foreignKey['table'], []).append(foreignKey)
+
+    conditions = {}
+
+    def resolve(key, path):
+        if key in conditions:
+            return conditions[key]
+
+        parts = list(explicit.get(key, []))
+        for foreignKey in references.get(key, []):
+            parent = foreignKey['parent']
+            if parent == key or parent in path:
+                if parent in explicit or parent in conditions:
+                    logging.warning('Foreign key of {} to {} is part of a cycle and is not followed, the subset may violate it.'.format(tables[key]['sql'], tables[parent]['sql']))
+                continue
+
+            parentCondition = resolve(parent, path | {key})
+            if parentCondition is None:
+                continue
+
+            columns = foreignKey['columns']
+            nullCheck = ' OR '.join('{} IS NULL'.format(column) for column in columns)
+            target = columns[0] if len(columns) == 1 else '({})'.format(', '.join(columns))
+            parts.append('{} OR {} IN (SELECT {} FROM {} WHERE {})'.format(nullCheck, target, ', '.join(foreignKey['parentColumns']), tables[parent]['sql'], parentCondition))
+
+        conditions[key] = ' AND '.join('({})'.format(part) for part in parts) if parts else None
+
+        return conditions[key]
+
+    for key in tables:
+        resolve(key, frozenset())
+
+    return {key: condition for key, condition in conditions.items() if condition is not None}
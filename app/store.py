@@ -0,0 +1,220 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from pipeline import DEFAULT_BUFFER_SIZE, feedProcess, readProcess
+
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 8 * 1024 * 1024
+
+class ContentChunker:
+    """
+    Split a byte stream into content-defined chunks.
+
+    Dumps are line oriented (INSERT statements, COPY rows), so candidate boundaries are line ends. A line ends a chunk
+    when its CRC32 falls below a threshold proportional to the line length, which gives CHUNK_AVG_SIZE chunks on average.
+    Boundaries depend only on the content, so an insert or delete early in the dump does not shift every following chunk.
+    """
+
+    def __init__(self, emit, minSize: int = CHUNK_MIN_SIZE, avgSize: int = CHUNK_AVG_SIZE, maxSize: int = CHUNK_MAX_SIZE):
+        self._emit = emit
+        self._minSize = minSize
+        self._avgSize = avgSize
+        self._maxSize = maxSize
+        self._pending = bytearray()
+        self._lineStart = 0
+
+    def _cut(self, size: int) -> None:
+        self._emit(bytes(self._pending[:size]))
+        del self._pending[:size]
+        self._lineStart = 0
+
+    def write(self, block) -> None:
+        pending = self._pending
+        pending.extend(block)
+
+        while True:
+            end = pending.find(b'\n', self._lineStart)
+            if end < 0 or end >= self._maxSize:
+                if len(pending) >= self._maxSize:
+                    self._cut(self._maxSize)
+                    continue
+                break
+
+            end += 1
+            if end >= self._minSize and zlib.crc32(pending[self._lineStart:end]) * self._avgSize < (end - self._lineStart) << 32:
+                self._cut(end)
+            else:
+                self._lineStart = end
+
+    def flush(self) -> None:
+        if self._pending:
+            self._cut(len(self._pending))
+
+class BackupStore:
+    """
+    Content-addressed, deduplicating backup repository.
+
+    Chunks are stored once under chunks/<sha256[:2]>/<sha256>, every backup is a manifest in manifests/ listing its chunks.
+    Backups and restores hold a shared lock of the store, prune and gc an exclusive one: a chunk written by a backup
+    is not referenced by any manifest until the backup finishes and gc would remove it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.chunksPath = os.path.join(path, 'chunks')
+        self.manifestsPath = os.path.join(path, 'manifests')
+        os.makedirs(self.chunksPath, exist_ok=True)
+        os.makedirs(self.manifestsPath, exist_ok=True)
+
+    @contextmanager
+    def _locked(self, operation: int):
+        with open(os.path.join(self.path, 'store.lock'), 'w') as lock:
+            fcntl.flock(lock, operation)
+            yield
+
+    def chunkPath(self, digest: str) -> str:
+        return os.path.join(self.chunksPath, digest[:2], digest)
+
+    def manifestPath(self, name: str) -> str:
+        return os.path.join(self.manifestsPath, '{}.json'.format(name))
+
+    def putChunk(self, data: bytes) -> tuple:
+        """
+        Store a chunk unless it is already there. Returns its digest and whether it was new.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunkPath(digest)
+        if os.path.exists(path):
+            return digest, False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporaryPath = '{}.tmp{}'.format(path, os.getpid())
+        with open(temporaryPath, 'wb') as file:
+            file.write(data)
+        os.replace(temporaryPath, path)
+
+        return digest, True
+
+    def readChunk(self, digest: str) -> bytes:
+        with open(self.chunkPath(digest), 'rb') as file:
+            data = file.read()
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError('Chunk {} is corrupted'.format(digest))
+
+        return data
+
+    def writeManifest(self, manifest: dict) -> None:
+        path = self.manifestPath(manifest['name'])
+        temporaryPath = '{}.tmp{}'.format(path, os.getpid())
+        with open(temporaryPath, 'w') as file:
+            json.dump(manifest, file)
+        os.replace(temporaryPath, path)
+
+    def readManifest(self, name: str) -> dict:
+        with open(self.manifestPath(name)) as file:
+            return json.load(file)
+
+    def listManifests(self, database: str = None) -> list:
+        """
+        Manifests sorted from the oldest, optionally only those of one database.
+        """
+        manifests = []
+        for filename in os.listdir(self.manifestsPath):
+            if filename.endswith('.json'):
+                manifest = self.readManifest(filename[:-len('.json')])
+                if database is None or manifest['database'] == database:
+                    manifests.append(manifest)
+
+        return sorted(manifests, key=lambda manifest: manifest['created'])
+
+    def backupProcess(self, producerArgs: list, name: str, database: str, producerEnv: dict = None) -> dict:
+        """
+        Run the dump process and store its output as a new backup.
+        """
+        startedAt = time.monotonic()
+        digests = []
+        stats = {'chunks': 0, 'newChunks': 0, 'newBytes': 0}
+
+        def storeChunk(data):
+            digest, isNew = self.putChunk(data)
+            digests.append(digest)
+            stats['chunks'] += 1
+            if isNew:
+                stats['newChunks'] += 1
+                stats['newBytes'] += len(data)
+
+        with self._locked(fcntl.LOCK_SH):
+            chunker = ContentChunker(storeChunk)
+            size = readProcess(producerArgs, chunker.write, producerEnv=producerEnv)
+            chunker.flush()
+
+            manifest = {
+                'name': name,
+                'database': database,
+                'created': datetime.now().isoformat(),
+                'size': size,
+                'chunks': digests,
+            }
+            self.writeManifest(manifest)
+
+        logging.info('Stored backup "{}": {} bytes in {} chunks, {} new chunks ({} bytes) in {:.3f}s.'.format(name, size, stats['chunks'], stats['newChunks'], stats['newBytes'], time.monotonic() - startedAt))
+
+        return manifest
+
+    def restoreProcess(self, name: str, consumerArgs: list, consumerEnv: dict = None, bufferSize: int = DEFAULT_BUFFER_SIZE) -> int:
+        """
+        Stream a stored backup into stdin of the restore process.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            manifest = self.readManifest(name)
+            startedAt = time.monotonic()
+            size = feedProcess(consumerArgs, (self.readChunk(digest) for digest in manifest['chunks']), consumerEnv=consumerEnv, bufferSize=bufferSize)
+        logging.info('Restored backup "{}": {} bytes in {:.3f}s.'.format(name, size, time.monotonic() - startedAt))
+
+        return size
+
+    def prune(self, database: str, keep: int) -> list:
+        """
+        Remove all but the newest `keep` manifests of the database. Chunks are left for gc.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            manifests = self.listManifests(database)
+            removed = manifests[:max(0, len(manifests) - keep)]
+            for manifest in removed:
+                os.remove(self.manifestPath(manifest['name']))
+                logging.info('Removed backup "{}".'.format(manifest['name']))
+
+        return [manifest['name'] for manifest in removed]
+
+    def gc(self) -> tuple:
+        """
+        Remove chunks not referenced by any manifest. Returns number of removed chunks and freed bytes.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            referenced = set()
+            for manifest in self.listManifests():
+                referenced.update(manifest['chunks'])
+
+            removed = 0
+            freed = 0
+            for directory in os.listdir(self.chunksPath):
+                directoryPath = os.path.join(self.chunksPath, directory)
+                for digest in os.listdir(directoryPath):
+                    if digest not in referenced:
+                        path = os.path.join(directoryPath, digest)
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+                        removed += 1
+
+        logging.info('Removed {} unreferenced chunks, freed {} bytes.'.format(removed, freed))
+
+        return removed, freed
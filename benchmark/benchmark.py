@@ -0,0 +1,404 @@
+# Benchmark of the database manager scripts against local throwaway servers.
+#
+# run:     start fresh servers, load synthetic datasets, time the script actions and write results as JSON
+# compare: compare two result files and fail on regressions
+#
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+DATASETS = ('small_tables', 'huge_tables', 'wide_rows', 'large_objects')
+ENGINES = ('postgres', 'mysql')
+RESTORE_USER = 'bench_user'
+RESTORE_PASSWORD = 'bench_password'
+
+def initLoggers() -> None:
+    # STDOUT logger
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+
+    stdoutHandler = logging.StreamHandler(sys.stdout)
+    stdoutHandler.setLevel(logging.DEBUG)
+    stdoutFormatter = logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] - %(message)s - [%(module)s/%(filename)s::%(funcName)s:%(lineno)d]')
+    stdoutHandler.setFormatter(stdoutFormatter)
+
+    root.addHandler(stdoutHandler)
+
+def freePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run(args: list, **kwargs) -> subprocess.CompletedProcess:
+    logging.debug('Running {}'.format(' '.join(args)))
+    return subprocess.run(args, check=True, **kwargs)
+
+def waitFor(check, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return
+        time.sleep(0.5)
+
+    raise TimeoutError('Server did not start in {}s'.format(timeout))
+
+def findPostgresBin(pgBin: str) -> str:
+    """
+    Directory with initdb and pg_ctl. Debian based systems keep them out of PATH.
+    """
+    if pgBin:
+        return pgBin
+    if shutil.which('initdb'):
+        return os.path.dirname(shutil.which('initdb'))
+    candidates = sorted(glob.glob('/usr/lib/postgresql/*/bin'))
+    if candidates:
+        return candidates[-1]
+
+    raise FileNotFoundError('initdb not found, use --pg-bin')
+
+class PostgresServer:
+    """
+    Throwaway Postgres cluster in a temporary directory, trust authentication for user postgres.
+    """
+
+    engine = 'postgres'
+    user = 'postgres'
+
+    def __init__(self, workDir: str, pgBin: str):
+        self.bin = findPostgresBin(pgBin)
+        self.dataDir = os.path.join(workDir, 'postgres')
+        self.port = freePort()
+
+    def start(self) -> None:
+        run([os.path.join(self.bin, 'initdb'), '-D', self.dataDir, '-U', self.user, '--auth=trust', '-E', 'UTF8'], stdout=subprocess.DEVNULL)
+        options = '-p {} -k {} -c listen_addresses=127.0.0.1'.format(self.port, self.dataDir)
+        run([os.path.join(self.bin, 'pg_ctl'), '-D', self.dataDir, '-o', options, '-l', os.path.join(self.dataDir, 'server.log'), '-w', 'start'], stdout=subprocess.DEVNULL)
+
+    def stop(self) -> None:
+        subprocess.run([os.path.join(self.bin, 'pg_ctl'), '-D', self.dataDir, '-m', 'fast', '-w', 'stop'], stdout=subprocess.DEVNULL)
+
+    def execute(self, sql: str, database: str = 'postgres') -> None:
+        run(['psql', '-h', '127.0.0.1', '-p', str(self.port), '-U', self.user, '-d', database, '-v', 'ON_ERROR_STOP=1', '-q', '-f', '-'], input=sql.encode(), stdout=subprocess.DEVNULL)
+
+    def createDataset(self, database: str, dataset: str, scale: float) -> None:
+        self.execute('CREATE DATABASE "{}";'.format(database))
+        self.execute(postgresDatasetSql(dataset, scale), database)
+
+    def cleanup(self, databases: list) -> None:
+        for database in databases:
+            self.execute('DROP DATABASE IF EXISTS "{}" WITH (FORCE);'.format(database))
+        self.execute('DROP USER IF EXISTS "{}";'.format(RESTORE_USER))
+
+class MysqlServer:
+    """
+    Throwaway MySQL 8 server in a temporary directory, root without password.
+    """
+
+    engine = 'mysql'
+    user = 'root'
+
+    def __init__(self, workDir: str, mysqld: str):
+        self.mysqld = mysqld or shutil.which('mysqld') or '/usr/sbin/mysqld'
+        self.dataDir = os.path.join(workDir, 'mysql')
+        self.port = freePort()
+        self.process = None
+
+    def start(self) -> None:
+        os.makedirs(self.dataDir)
+        common = ['--no-defaults', '--datadir={}'.format(os.path.join(self.dataDir, 'data')), '--user={}'.format(os.environ.get('USER') or 'root')]
+        run([self.mysqld] + common + ['--initialize-insecure'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.process = subprocess.Popen([self.mysqld] + common + [
+            '--port={}'.format(self.port),
+            '--bind-address=127.0.0.1',
+            '--socket={}'.format(os.path.join(self.dataDir, 'mysql.sock')),
+            '--pid-file={}'.format(os.path.join(self.dataDir, 'mysqld.pid')),
+            '--log-error={}'.format(os.path.join(self.dataDir, 'error.log')),
+            '--mysqlx=OFF',
+        ])
+        waitFor(lambda: subprocess.run(['mysqladmin', '--host=127.0.0.1', '--port={}'.format(self.port), '--user=root', 'ping'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0)
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+    def execute(self, sql: str, database: str = None) -> None:
+        args = ['mysql', '--host=127.0.0.1', '--port={}'.format(self.port), '--user=root']
+        if database:
+            args.append('--database={}'.format(database))
+        run(args, input=sql.encode(), stdout=subprocess.DEVNULL)
+
+    def createDataset(self, database: str, dataset: str, scale: float) -> None:
+        self.execute('CREATE DATABASE `{}`;'.format(database))
+        self.execute(mysqlDatasetSql(dataset, scale), database)
+
+    def cleanup(self, databases: list) -> None:
+        # The MySQL script restores into a database named after the new user
+        for database in databases + [RESTORE_USER]:
+            self.execute('DROP DATABASE IF EXISTS `{}`;'.format(database))
+        self.execute('DROP USER IF EXISTS \'{}\';'.format(RESTORE_USER))
+
+def postgresDatasetSql(dataset: str, scale: float) -> str:
+    if dataset == 'small_tables':
+        return '''
+            DO $$
+            BEGIN
+                FOR i IN 1..{} LOOP
+                    EXECUTE format('CREATE TABLE small_%s (id serial PRIMARY KEY, name text, created timestamptz DEFAULT now())', i);
+                    EXECUTE format('INSERT INTO small_%s (name) SELECT md5(g::text) FROM generate_series(1, 100) g', i);
+                END LOOP;
+            END
+            $$;
+        '''.format(max(1, int(500 * scale)))
+    elif dataset == 'huge_tables':
+        return '''
+            CREATE TABLE huge_parent (id bigserial PRIMARY KEY, value int, payload text, created timestamptz);
+            INSERT INTO huge_parent (value, payload, created) SELECT g % 1000, md5(g::text), now() - g * interval '1 second' FROM generate_series(1, {0}) g;
+            CREATE INDEX ON huge_parent (value);
+            CREATE TABLE huge_child (id bigserial PRIMARY KEY, parent_id bigint REFERENCES huge_parent, payload text);
+            INSERT INTO huge_child (parent_id, payload) SELECT g, md5(g::text) FROM generate_series(1, {0}) g;
+            CREATE INDEX ON huge_child (parent_id);
+        '''.format(max(1, int(2000000 * scale)))
+    elif dataset == 'wide_rows':
+        columns = ', '.join('c{} text'.format(i) for i in range(100))
+        values = ', '.join('repeat(md5((g + {})::text), 6)'.format(i) for i in range(100))
+        return '''
+            CREATE TABLE wide (id serial PRIMARY KEY, {});
+            INSERT INTO wide ({}) SELECT {} FROM generate_series(1, {}) g;
+        '''.format(columns, ', '.join('c{}'.format(i) for i in range(100)), values, max(1, int(20000 * scale)))
+    elif dataset == 'large_objects':
+        count = max(1, int(100 * scale))
+        return '''
+            CREATE TABLE blobs (id serial PRIMARY KEY, data bytea, lo oid);
+            INSERT INTO blobs (data, lo)
+                SELECT decode(string_agg(md5((g * 100000 + s)::text), ''), 'hex'), lo_from_bytea(0, decode(string_agg(md5((g * 100000 + s + 1)::text), ''), 'hex'))
+                FROM generate_series(1, {}) g, generate_series(1, 65536) s GROUP BY g;
+        '''.format(count)
+
+    raise ValueError('Unknown dataset "{}"'.format(dataset))
+
+def mysqlDatasetSql(dataset: str, scale: float) -> str:
+    numbers = 'WITH RECURSIVE seq (n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {})'
+    header = 'SET SESSION cte_max_recursion_depth = 100000000;\n'
+
+    if dataset == 'small_tables':
+        statements = []
+        for i in range(1, max(1, int(500 * scale)) + 1):
+            statements.append('CREATE TABLE small_{0} (id int AUTO_INCREMENT PRIMARY KEY, name varchar(64), created timestamp DEFAULT CURRENT_TIMESTAMP);'.format(i))
+            statements.append('INSERT INTO small_{0} (name) {1} SELECT md5(n) FROM seq;'.format(i, numbers.format(100)))
+        return header + '\n'.join(statements)
+    elif dataset == 'huge_tables':
+        count = max(1, int(2000000 * scale))
+        return header + '''
+            CREATE TABLE huge_parent (id bigint AUTO_INCREMENT PRIMARY KEY, value int, payload varchar(64), created datetime, KEY (value));
+            INSERT INTO huge_parent (value, payload, created) {0} SELECT n % 1000, md5(n), NOW() - INTERVAL n SECOND FROM seq;
+            CREATE TABLE huge_child (id bigint AUTO_INCREMENT PRIMARY KEY, parent_id bigint, payload varchar(64), FOREIGN KEY (parent_id) REFERENCES huge_parent (id));
+            INSERT INTO huge_child (parent_id, payload) {0} SELECT n, md5(n) FROM seq;
+        '''.format(numbers.format(count))
+    elif dataset == 'wide_rows':
+        columns = ', '.join('c{} text'.format(i) for i in range(100))
+        values = ', '.join('repeat(md5(n + {}), 6)'.format(i) for i in range(100))
+        return header + '''
+            CREATE TABLE wide (id int AUTO_INCREMENT PRIMARY KEY, {});
+            INSERT INTO wide ({}) {} SELECT {} FROM seq;
+        '''.format(columns, ', '.join('c{}'.format(i) for i in range(100)), numbers.format(max(1, int(20000 * scale))), values)
+    elif dataset == 'large_objects':
+        return header + '''
+            CREATE TABLE blobs (id int AUTO_INCREMENT PRIMARY KEY, data longblob);
+            INSERT INTO blobs (data) {} SELECT RANDOM_BYTES(1024) FROM seq;
+            UPDATE blobs SET data = REPEAT(data, 2048);
+        '''.format(numbers.format(max(1, int(100 * scale))))
+
+    raise ValueError('Unknown dataset "{}"'.format(dataset))
+
+def writeConfig(path: str, server, database: str, restoreDatabase: str) -> None:
+    with open(path, 'w') as file:
+        file.write('[backup]\nhost=127.0.0.1\nport={}\nuser={}\npassword=\ndb={}\n\n'.format(server.port, server.user, database))
+        file.write('[restore]\nhost=127.0.0.1\nport={}\nuser={}\npassword=\nuser_new={}\npassword_new={}\ndb_new={}\n'.format(server.port, server.user, RESTORE_USER, RESTORE_PASSWORD, restoreDatabase))
+
+def runAction(script: str, workDir: str, configPath: str, action: str, extraArgs: list) -> dict:
+    """
+    Run one action of the script, return its wall time and the phases from its run report.
+    """
+    reportPath = os.path.join(workDir, 'report.json')
+    if os.path.exists(reportPath):
+        os.remove(reportPath)
+
+    args = [sys.executable, script, '--configfile={}'.format(configPath), '--action={}'.format(action), '--report-file={}'.format(reportPath), '--no-cache'] + extraArgs
+    startedAt = time.monotonic()
+    with open(os.path.join(workDir, 'script.log'), 'ab') as log:
+        process = subprocess.run(args, cwd=workDir, stdout=log, stderr=subprocess.STDOUT)
+    seconds = time.monotonic() - startedAt
+
+    phases = {}
+    if os.path.exists(reportPath):
+        with open(reportPath) as file:
+            for phase in json.load(file)['phases']:
+                phases[phase['phase']] = phases.get(phase['phase'], 0) + phase['seconds']
+
+    return {'returncode': process.returncode, 'seconds': seconds, 'phases': phases}
+
+def benchmark(args) -> dict:
+    results = {
+        'started': datetime.now().isoformat(),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+        'parameters': {'engines': args.engines, 'datasets': args.datasets, 'scale': args.scale, 'repeat': args.repeat, 'script_args': args.script_args},
+        'runs': [],
+    }
+
+    for engine in args.engines:
+        workDir = tempfile.mkdtemp(prefix='database-manager-benchmark-')
+        os.makedirs(os.path.join(workDir, 'backups'))
+        server = PostgresServer(workDir, args.pg_bin) if engine == 'postgres' else MysqlServer(workDir, args.mysqld)
+        script = os.path.join(APP_PATH, '{}-database-manager.py'.format(engine))
+        actions = ('restore', 'create', 'delete') if engine == 'postgres' else ('restore', 'create')
+
+        logging.info('Starting {} server in {}...'.format(engine, workDir))
+        server.start()
+        try:
+            for dataset in args.datasets:
+                database = 'bench_{}'.format(dataset)
+                restoreDatabase = '{}_copy'.format(database)
+                configPath = os.path.join(workDir, '{}.config'.format(dataset))
+                writeConfig(configPath, server, database, restoreDatabase)
+
+                logging.info('Generating dataset "{}" (scale {})...'.format(dataset, args.scale))
+                startedAt = time.monotonic()
+                server.createDataset(database, dataset, args.scale)
+                logging.info('Dataset generated in {:.1f}s.'.format(time.monotonic() - startedAt))
+
+                for action in actions:
+                    samples = []
+                    for _ in range(args.repeat):
+                        server.cleanup([restoreDatabase])
+                        if action == 'delete':
+                            runAction(script, workDir, configPath, 'create', args.script_args)
+                        samples.append(runAction(script, workDir, configPath, action, args.script_args))
+
+                    run = {
+                        'engine': engine,
+                        'dataset': dataset,
+                        'action': action,
+                        'failed': sum(1 for sample in samples if sample['returncode'] != 0),
+                        'seconds': statistics.median(sample['seconds'] for sample in samples),
+                        'phases': {phase: statistics.median(sample['phases'].get(phase, 0) for sample in samples) for phase in samples[-1]['phases']},
+                        'samples': samples,
+                    }
+                    results['runs'].append(run)
+                    logging.info('{} {} {}: {:.3f}s (median of {}), {} failed'.format(engine, dataset, action, run['seconds'], args.repeat, run['failed']))
+
+                server.cleanup([restoreDatabase])
+        finally:
+            server.stop()
+            if args.keep_servers is False:
+                shutil.rmtree(workDir, ignore_errors=True)
+
+    return results
+
+def compare(baselinePath: str, currentPath: str, threshold: float) -> int:
+    """
+    Print relative change of every run and phase, return number of regressions above the threshold.
+    """
+    with open(baselinePath) as file:
+        baseline = {(run['engine'], run['dataset'], run['action']): run for run in json.load(file)['runs']}
+    with open(currentPath) as file:
+        current = json.load(file)['runs']
+
+    regressions = 0
+    for run in current:
+        key = (run['engine'], run['dataset'], run['action'])
+        if key not in baseline:
+            print('{:<45} {:>10.3f}s  (new)'.format(' '.join(key), run['seconds']))
+            continue
+
+        rows = [(' '.join(key), baseline[key]['seconds'], run['seconds'])]
+        rows += [('  ' + phase, baseline[key]['phases'].get(phase), seconds) for phase, seconds in run['phases'].items()]
+        for name, before, after in rows:
+            if not before:
+                print('{:<45} {:>10.3f}s'.format(name, after))
+                continue
+            change = (after - before) / before
+            regressed = change > threshold and name == rows[0][0]
+            regressions += 1 if regressed else 0
+            print('{:<45} {:>10.3f}s -> {:>10.3f}s {:>+8.1%}{}'.format(name, before, after, change, '  REGRESSION' if regressed else ''))
+
+    return regressions
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Database manager benchmark')
+    subparsers = args_parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmark')
+    run_parser.add_argument("--engines",
+                            nargs='+',
+                            choices=ENGINES,
+                            default=list(ENGINES),
+                            help="Database engines to benchmark")
+    run_parser.add_argument("--datasets",
+                            nargs='+',
+                            choices=DATASETS,
+                            default=list(DATASETS),
+                            help="Synthetic datasets to generate")
+    run_parser.add_argument("--scale",
+                            type=float,
+                            default=1.0,
+                            help="Dataset size multiplier")
+    run_parser.add_argument("--repeat",
+                            type=int,
+                            default=3,
+                            help="Number of runs of every action, the median is reported")
+    run_parser.add_argument("--script-args",
+                            default='',
+                            help="Extra arguments passed to the scripts, e.g. \"--parallel --compress=zstd\"")
+    run_parser.add_argument("--output",
+                            default='benchmark-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')),
+                            help="Results file")
+    run_parser.add_argument("--pg-bin",
+                            default=None,
+                            help="Directory with initdb and pg_ctl")
+    run_parser.add_argument("--mysqld",
+                            default=None,
+                            help="Path to mysqld")
+    run_parser.add_argument("--keep-servers",
+                            metavar="keep_servers",
+                            default=False,
+                            action=argparse.BooleanOptionalAction,
+                            help="Keep server data directories after the run")
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results files')
+    compare_parser.add_argument("baseline", help="Results of the reference run")
+    compare_parser.add_argument("current", help="Results of the run to check")
+    compare_parser.add_argument("--threshold",
+                                type=float,
+                                default=0.1,
+                                help="Relative slowdown of an action reported as regression")
+
+    args = args_parser.parse_args()
+
+    if args.command == 'run':
+        args.script_args = args.script_args.split()
+        results = benchmark(args)
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        logging.info('Results written to "{}".'.format(args.output))
+    elif args.command == 'compare':
+        regressions = compare(args.baseline, args.current, args.threshold)
+        if regressions:
+            exit(1)
+
+if __name__ == '__main__':
+    initLoggers()
+    main()